@@ -0,0 +1,71 @@
+######################################################################
+# API documentation
+#   The Swagger spec of /v1/spec is built by flasgger from the route
+#   docstrings once, on first use (or read from SHOPCART_SPEC_FILE, see
+#   python manage.py spec), and then answered from the same bytes with
+#   an ETag. flasgger itself is only imported then, the routes of its
+#   blueprint (spec, /apidocs/ and the UI files) are registered here
+#   without it.
+######################################################################
+
+import os
+import hashlib
+from threading import Lock
+from flask import Blueprint, request, redirect, url_for
+from shopcart import app
+
+SPEC_FILE = os.getenv('SHOPCART_SPEC_FILE')
+
+# what flasgger.Swagger would register for app.config['SWAGGER']
+config = {
+    'headers': [],
+    'specs_route': '/apidocs/',
+    'static_url_path': '/flasgger_static'
+}
+config.update(app.config['SWAGGER'])
+spec_config = config['specs'][0]
+
+blueprint = Blueprint('flasgger', 'flasgger', template_folder='ui2/templates',
+                      static_folder='ui2/static', static_url_path=config['static_url_path'])
+
+_lock = Lock()
+_spec = None
+_docs = None
+
+def build_spec():
+    """ Returns the spec as JSON bytes, built by flasgger from the docstrings of the routes """
+    from flasgger.base import APISpecsView, BR_SANITIZER
+    view = APISpecsView.as_view(spec_config['endpoint'], view_args=dict(
+        config=config, spec=spec_config, sanitizer=BR_SANITIZER, template=None, definition_models=[]))
+    return view().get_data()
+
+def load_spec():
+    """ Returns (bytes, ETag) of the spec, built the first time """
+    global _spec
+    with _lock:
+        if _spec is None:
+            if SPEC_FILE and os.path.exists(SPEC_FILE):
+                with open(SPEC_FILE, 'rb') as stream:
+                    data = stream.read()
+            else:
+                data = build_spec()
+            _spec = (data, hashlib.md5(data).hexdigest())
+        return _spec
+
+def spec():
+    data, etag = load_spec()
+    response = app.response_class(data, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+def docs():
+    global _docs
+    if _docs is None:
+        from flasgger.base import APIDocsView
+        _docs = APIDocsView.as_view('apidocs', view_args=dict(config=config))
+    return _docs()
+
+blueprint.add_url_rule(spec_config['route'], spec_config['endpoint'], view_func=spec)
+blueprint.add_url_rule(config['specs_route'], 'apidocs', view_func=docs)
+blueprint.add_url_rule('/apidocs/index.html', view_func=lambda: redirect(url_for('flasgger.apidocs')))
+app.register_blueprint(blueprint)
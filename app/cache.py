@@ -0,0 +1,137 @@
+import os
+import time
+import atexit
+import socket
+import logging
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+from redis.exceptions import RedisError
+
+######################################################################
+# In-process cache of decoded carts
+#   A bounded LRU of carts by sid whose entries also expire after ttl
+#   seconds. Writers publish the sid of every cart they change on
+#   CHANNEL and every process drops it from its own cache, the ttl
+#   bounds how long a cart can be served stale if a message is lost
+#   (or raced with a read). Cached carts are shared between requests
+#   and must not be mutated.
+######################################################################
+
+CHANNEL = 'shopcarts:invalidate'
+ALL = '*'
+
+class CartCache(object):
+
+    def __init__(self, max_size=1024, ttl=5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._carts = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def from_env():
+        """ Returns the cache configured by SHOPCART_CACHE_SIZE and SHOPCART_CACHE_TTL, None if disabled """
+        max_size = int(os.getenv('SHOPCART_CACHE_SIZE', '0'))
+        if max_size <= 0:
+            return None
+        return CartCache(max_size, float(os.getenv('SHOPCART_CACHE_TTL', '5')))
+
+    def get(self, sid):
+        sid = int(sid)
+        with self._lock:
+            entry = self._carts.pop(sid, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            cart, expires = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._carts[sid] = entry  # most recently used goes last
+            self.hits += 1
+            return cart
+
+    def put(self, sid, cart):
+        sid = int(sid)
+        with self._lock:
+            self._carts.pop(sid, None)
+            self._carts[sid] = (cart, time.time() + self.ttl)
+            while len(self._carts) > self.max_size:
+                self._carts.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, sid):
+        with self._lock:
+            self.invalidations += 1
+            if sid == ALL:
+                self._carts.clear()
+            else:
+                self._carts.pop(int(sid), None)
+
+    def clear(self):
+        self.invalidate(ALL)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._carts),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+######################################################################
+# Applies the invalidations published by every process to one cache
+######################################################################
+class InvalidationListener(object):
+
+    def __init__(self, redis, cache, logger=None):
+        self.redis = redis
+        self.cache = cache
+        self.logger = logger or logging.getLogger(__name__)
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._listen, name='cart-cache-invalidation')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        # the thread notices within one get_message timeout
+        self._stopped.set()
+
+    def _listen(self):
+        pubsub = None
+        while not self._stopped.is_set():
+            try:
+                if pubsub is None:
+                    pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(CHANNEL)
+                message = pubsub.get_message(timeout=0.5)
+                if message and message['type'] == 'message':
+                    self.cache.invalidate(message['data'])
+            except (RedisError, socket.error) as err:
+                if self._stopped.is_set():
+                    break
+                # messages may have been missed while disconnected
+                self.logger.error('Cart cache invalidation lost its subscription: %s' % err)
+                self.cache.clear()
+                pubsub = None
+                self._stopped.wait(1)
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except (RedisError, socket.error):
+                pass
@@ -0,0 +1,169 @@
+import os
+import math
+import pickle
+import msgpack
+from flask import json
+
+######################################################################
+# Encoding of cart records
+#   Carts are stored as Redis hashes so that a single product can be
+#   added, replaced or removed with one field level command:
+#
+#     v          layout version (HASH_VERSION)
+#     uid        MessagePack encoded uid
+#     cents      subtotal of the products in cents, kept up to date by
+#                every product change (see cents_of)
+#     seq        last position given to a product
+#     touched    time of the last change, for the idle ttl
+#     version    bumped by every change, for ETags (0 when missing)
+#     json       the products as JSON, see render, when the storage keeps
+#                it (store_json). Every product change drops it
+#     empty      present while products is the [[]] placeholder
+#     p:<sku>    MessagePack encoded product [sku, quantity, name, unitprice]
+#     o:<sku>    position of that product in the products list
+#
+#   Products with any other shape (a product with extra keys) are
+#   stored as is. Hashes written before cents have a decimal string
+#   subtotal field instead, only updated by PUT /subtotal.
+#
+#   Before the hash layout a cart was a single string, either MAGIC, a
+#   format version byte and a MessagePack array whose positions are the
+#   cart fields ([uid, sid, subtotal, [product, ...]]), or a pickle
+#   written before that. Both are still read, so legacy carts can be
+#   converted as they are found, pickles only with SHOPCART_ALLOW_PICKLE
+#   (python manage.py migrate-encoding --allow-pickle turns it on).
+######################################################################
+
+# 0xc1 is never used by MessagePack and never starts a pickle
+MAGIC = '\xc1'
+VERSION = 1
+HASH_VERSION = 2
+
+PRODUCT_FIELDS = ('sku', 'quantity', 'name', 'unitprice')
+
+ALLOW_PICKLE = (os.getenv('SHOPCART_ALLOW_PICKLE', 'False') == 'True')
+
+class CodecError(ValueError):
+    pass
+
+def loads(data):
+    if not data.startswith(MAGIC):
+        if not ALLOW_PICKLE:
+            raise CodecError('Refusing to unpickle a legacy cart record')
+        return pickle.loads(data)
+    version = ord(data[1])
+    if version != VERSION:
+        raise CodecError('Unknown cart record version %d' % version)
+    uid, sid, subtotal, products = msgpack.unpackb(data[2:], raw=False)
+    return { 'uid': uid, 'sid': sid, 'subtotal': subtotal, 'products': [_unpack_product(product) for product in products] }
+
+def cents(price):
+    """ Returns a price in cents, rounded the same way as scripts.py """
+    return int(math.floor(price * 100 + 0.5))
+
+def line_parts(product):
+    """ Returns (unitprice, quantity) of a product line, None if it has no numeric ones """
+    if not isinstance(product, dict):
+        return None
+    price, quantity = product.get('unitprice'), product.get('quantity')
+    if not _is_number(price) or not _is_number(quantity):
+        return None
+    return price, quantity
+
+def line_cents(product):
+    parts = line_parts(product)
+    if parts is None:
+        return 0
+    return int(math.floor(cents(parts[0]) * parts[1] + 0.5))
+
+def cents_of(products):
+    """ Returns the subtotal of products in cents """
+    return sum(line_cents(product) for product in products)
+
+def to_hash(cart):
+    """ Returns the hash fields of a cart, its subtotal is computed from its products """
+    fields = { 'v': HASH_VERSION, 'uid': pack_value(cart['uid']), 'cents': cents_of(cart['products']) }
+    seq = 0
+    for product in cart['products']:
+        if product == []:
+            fields['empty'] = 1
+            continue
+        seq += 1
+        fields.update(product_fields(product, seq))
+    fields['seq'] = seq
+    return fields
+
+def from_hash(sid, fields):
+    """ Returns the cart stored in the hash fields of key sid """
+    lines = []
+    for field, value in fields.iteritems():
+        if field.startswith('p:'):
+            lines.append((int(fields['o:' + field[2:]]), unpack_product(value)))
+    lines.sort(key=lambda line: line[0])
+    products = [product for position, product in lines]
+    if not products and 'empty' in fields:
+        products = [[]]
+    return { 'uid': unpack_value(fields['uid']), 'sid': int(sid), 'subtotal': subtotal_from(fields), 'products': products }
+
+def subtotal_from(fields):
+    """ Returns the subtotal of the cart stored in the hash fields """
+    if 'cents' in fields:
+        return int(fields['cents']) / 100.0
+    return float(fields['subtotal'])
+
+def version_of(fields):
+    """ Returns the version of the cart stored in the hash fields """
+    return int(fields.get('version', 0))
+
+def render(value):
+    """ Returns value as the JSON jsonify answers with, without its final newline """
+    return json.dumps(value, separators=(',', ':'))
+
+def render_cart(sid, uid, subtotal, products_json):
+    """ Returns the JSON of a cart from the JSON of its products, the same as render(cart) """
+    return '{"products":%s,"sid":%s,"subtotal":%s,"uid":%s}' % (products_json, render(int(sid)), render(subtotal), render(uid))
+
+def product_fields(product, position):
+    """ Returns the p: and o: fields of a product at position """
+    sku = product_key(product, position)
+    return { product_field(sku): pack_product(product), order_field(sku): position }
+
+def product_key(product, position):
+    if isinstance(product, dict) and 'sku' in product:
+        return product['sku']
+    return '#%d' % position  # products without a sku are kept by position
+
+def product_field(sku):
+    return 'p:%s' % sku
+
+def order_field(sku):
+    return 'o:%s' % sku
+
+def pack_product(product):
+    # without bin types, so the cmsgpack of Redis Lua scripts can read it
+    return msgpack.packb(_pack_product(product), use_bin_type=False)
+
+def unpack_product(data):
+    return _unpack_product(msgpack.unpackb(data, raw=False))
+
+def pack_value(value):
+    return msgpack.packb(value, use_bin_type=False)
+
+def unpack_value(data):
+    return msgpack.unpackb(data, raw=False)
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def _pack_product(product):
+    if isinstance(product, dict) and len(product) == len(PRODUCT_FIELDS):
+        try:
+            return [product[field] for field in PRODUCT_FIELDS]
+        except KeyError:
+            pass
+    return product
+
+def _unpack_product(product):
+    if isinstance(product, list) and len(product) == len(PRODUCT_FIELDS):
+        return dict(zip(PRODUCT_FIELDS, product))
+    return product
@@ -0,0 +1,59 @@
+######################################################################
+# Response compression
+#   Responses of at least MIN_SIZE bytes are sent gzip or deflate
+#   compressed, whichever the client prefers in Accept-Encoding, at
+#   LEVEL (1 fastest to 9 smallest, 0 turns compression off). Streamed
+#   responses (the export) are sent as they are. A strong ETag gets the
+#   coding as a suffix ("5-gzip"), each encoding is a different set of
+#   bytes, and Vary keeps the encoded copies apart in caches. The checks
+#   of If-None-Match and If-Match take the ETag back with strip_coding.
+######################################################################
+
+import os
+import zlib
+from flask import request
+from shopcart import app
+
+MIN_SIZE = int(os.getenv('SHOPCART_COMPRESS_MIN_SIZE', '1024'))
+LEVEL = int(os.getenv('SHOPCART_COMPRESS_LEVEL', '6'))
+ENCODINGS = ['gzip', 'deflate']
+
+def compress(data, encoding, level=None):
+    """ Returns data compressed for the Content-Encoding encoding, gzip or deflate """
+    level = LEVEL if level is None else level
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+def coded_etag(etag, encoding):
+    """ Returns the ETag of the encoding content-coding of a response with ETag etag """
+    return '%s-%s' % (etag, encoding)
+
+def strip_coding(etag):
+    """ Returns the ETag of the response the ETag of one of its content-codings stands for """
+    for encoding in ENCODINGS:
+        if etag.endswith('-' + encoding):
+            return etag[:-len(encoding) - 1]
+    return etag
+
+@app.after_request
+def compress_response(response):
+    if LEVEL == 0 or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    if not 200 <= response.status_code < 300:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(coded_etag(etag, encoding))
+        # answers 304 to an If-None-Match with the coded ETag, for views that check their own
+        response.make_conditional(request)
+    return response
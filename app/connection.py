@@ -0,0 +1,151 @@
+import os
+import atexit
+import random
+import logging
+from threading import Thread, Event, Lock
+from redis import Redis, ConnectionPool, BlockingConnectionPool
+from redis.exceptions import RedisError
+
+######################################################################
+# Managed Redis connection
+#   Connects to the first reachable Redis of a list of candidates
+#   through a bounded connection pool, then checks its health in a
+#   background thread and reconnects (trying the candidates in the same
+#   order) with jittered exponential backoff when it stops answering.
+#   on_connect is called with the new client after every (re)connect.
+#   With a pool_timeout a caller waits up to that many seconds for a
+#   free connection instead of failing when all of them are in use, as
+#   the greenlets of run_gevent.py do.
+######################################################################
+
+class RedisManager(object):
+
+    def __init__(self, candidates, on_connect=None, logger=None,
+                 max_connections=None, socket_timeout=None, socket_connect_timeout=None,
+                 socket_keepalive=None, health_check_interval=None,
+                 backoff_base=None, backoff_max=None, pool_timeout=None):
+        self.candidates = candidates
+        self.on_connect = on_connect
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_connections = max_connections or int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+        self.socket_timeout = socket_timeout or float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+        self.socket_connect_timeout = socket_connect_timeout or float(os.getenv('REDIS_CONNECT_TIMEOUT', '2'))
+        if socket_keepalive is None:
+            socket_keepalive = (os.getenv('REDIS_KEEPALIVE', 'True') == 'True')
+        self.socket_keepalive = socket_keepalive
+        self.health_check_interval = health_check_interval or float(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '10'))
+        self.backoff_base = backoff_base or float(os.getenv('REDIS_BACKOFF_BASE', '0.5'))
+        self.backoff_max = backoff_max or float(os.getenv('REDIS_BACKOFF_MAX', '30'))
+        self.pool_timeout = pool_timeout or float(os.getenv('REDIS_POOL_TIMEOUT', '0'))
+        self.client = None
+        self.connected = False
+        self.pool = None
+        self.host = None
+        self.reconnects = 0
+        self.failed_checks = 0
+        self.last_error = None
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def connect(self):
+        """ Connects to the first candidate that answers a PING, returns the client or None """
+        with self._lock:
+            for hostname, port, password in self.candidates:
+                pool = self.__pool(hostname, port, password)
+                client = Redis(connection_pool=pool)
+                try:
+                    client.ping()
+                except RedisError as err:
+                    self.last_error = str(err)
+                    pool.disconnect()
+                    self.logger.info("No Redis on %s:%s" % (hostname, port))
+                    continue
+                if self.pool is not None:
+                    self.pool.disconnect()
+                self.client, self.pool, self.host = client, pool, (hostname, port)
+                self.connected = True
+                self.logger.info("Connected to Redis on host %s port %s" % (hostname, port))
+                if self.on_connect:
+                    self.on_connect(client)
+                return client
+            return None
+
+    def __pool(self, hostname, port, password):
+        options = dict(host=hostname, port=port, password=password,
+                       max_connections=self.max_connections,
+                       socket_timeout=self.socket_timeout,
+                       socket_connect_timeout=self.socket_connect_timeout,
+                       socket_keepalive=self.socket_keepalive,
+                       retry_on_timeout=True)
+        if self.pool_timeout:
+            return BlockingConnectionPool(timeout=self.pool_timeout, **options)
+        return ConnectionPool(**options)
+
+    def healthy(self):
+        if self.client is None:
+            return False
+        try:
+            self.client.ping()
+            return True
+        except RedisError as err:
+            self.last_error = str(err)
+            return False
+
+    def reconnect(self):
+        """ Tries to connect until it succeeds or the manager is stopped """
+        attempt = 0
+        while not self._stopped.is_set():
+            if self.connect():
+                self.reconnects += 1
+                return self.client
+            delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+            attempt += 1
+            self.logger.error("Could not reconnect to Redis, retrying in %.1fs" % delay)
+            self._stopped.wait(delay * random.uniform(0.5, 1.5))
+        return None
+
+    def start(self):
+        """ Starts the background health check """
+        if self._thread is None:
+            self._thread = Thread(target=self._watch, name='redis-health-check')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        # the pool is left to close its connections when it is collected,
+        # other threads (the cache invalidation listener) may still use one
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(1)
+
+    def _watch(self):
+        while not self._stopped.wait(self.health_check_interval):
+            if not self.healthy():
+                self.connected = False
+                self.failed_checks += 1
+                self.reconnect()
+
+    def stats(self):
+        stats = {
+            'connected': self.connected,
+            'host': self.host[0] if self.host else None,
+            'port': self.host[1] if self.host else None,
+            'max_connections': self.max_connections,
+            'reconnects': self.reconnects,
+            'failed_health_checks': self.failed_checks,
+            'last_error': self.last_error
+        }
+        if isinstance(self.pool, BlockingConnectionPool):
+            # a queue of max_connections slots, the free ones hold an idle connection or None
+            created = len(self.pool._connections)
+            in_use = self.pool.max_connections - self.pool.pool.qsize()
+            stats.update(created_connections=created, available_connections=created - in_use,
+                         in_use_connections=in_use)
+        elif self.pool is not None:
+            available = len(self.pool._available_connections)
+            in_use = len(self.pool._in_use_connections)
+            stats.update(created_connections=available + in_use, available_connections=available,
+                         in_use_connections=in_use)
+        return stats
@@ -2,4 +2,10 @@
 # Custom Exceptions
 ######################################################################
 class DataValidationError(ValueError):
+    pass
+
+class VersionConflict(Exception):
+    pass
+
+class ShardUnavailable(Exception):
     pass
\ No newline at end of file
@@ -2,16 +2,25 @@
 # ERROR Handling
 ######################################################################
 
-from flask import jsonify, make_response
+from flask import make_response
 from flask_api import status    # HTTP Status Codes
 from shopcart import app
-from custom_exceptions import DataValidationError
+from custom_exceptions import DataValidationError, VersionConflict, ShardUnavailable
+from media import jsonify
 import logging
 
 @app.errorhandler(DataValidationError)
 def request_validation_error(e):
     return bad_request(e)
 
+@app.errorhandler(VersionConflict)
+def precondition_failed(e):
+    return make_response(jsonify(status=412, error='Precondition Failed', message='The shopcart has changed, get it again for its current ETag'), status.HTTP_412_PRECONDITION_FAILED)
+
+@app.errorhandler(ShardUnavailable)
+def service_unavailable(e):
+    return make_response(jsonify(status=503, error='Service Unavailable', message=e.message), status.HTTP_503_SERVICE_UNAVAILABLE)
+
 @app.errorhandler(404)
 def not_found(e):
     return make_response(jsonify(status=404, error='Not Found', message=e.description), status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,54 @@
+import csv
+import json
+from StringIO import StringIO
+
+######################################################################
+# Streaming exports of shopcarts
+#   Every function takes an iterable of serialized carts (normally
+#   Shopcart.iterate()) and yields the export one chunk per cart, so
+#   the whole dataset is never held in memory
+######################################################################
+
+# Same layout as sampleShopcarts.csv: one row per product
+CSV_COLUMNS = ['uid', 'sid', 'products_sku', 'products_quantity', 'products_name', 'products_unitprice']
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+def export_ndjson(carts):
+    for cart in carts:
+        yield json.dumps(cart, separators=(',', ':')) + '\n'
+
+def export_csv(carts):
+    buf = StringIO()
+    header = csv.writer(buf, lineterminator='\n')
+    rows = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+    header.writerow(CSV_COLUMNS)
+    yield _drain(buf)
+    for cart in carts:
+        # skip the [[]] placeholder of carts created without products
+        products = [product for product in cart['products'] if product]
+        if not products:
+            header.writerow([cart['uid'], cart['sid'], '', '', '', ''])
+        for product in products:
+            rows.writerow([cart['uid'], cart['sid'], product['sku'], product['quantity'],
+                           _encode(product['name']), product['unitprice']])
+        yield _drain(buf)
+
+def export(carts, fmt):
+    if fmt == 'csv':
+        return export_csv(carts)
+    return export_ndjson(carts)
+
+def _drain(buf):
+    chunk = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return chunk
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
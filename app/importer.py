@@ -0,0 +1,155 @@
+import csv
+import json
+import time
+from models import Shopcart
+from storage import Storage
+from export import CSV_COLUMNS
+
+######################################################################
+# Bulk import of shopcarts
+#   Reads files shaped like sampleShopcarts.csv (one row per product,
+#   consecutive rows of a cart share uid/sid) or NDJSON with one cart
+#   per line, validates every cart with the same rules as the REST API
+#   and saves them with Shopcart.save_many in batches of batch_size
+######################################################################
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.carts = 0
+        self.rows = 0
+        self.rejected = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def carts_per_second(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.carts / self.elapsed
+
+    def __str__(self):
+        return 'Imported %d shopcarts from %d rows in %.2fs (%.0f carts/s), %d rejected' % (
+            self.carts, self.rows, self.elapsed, self.carts_per_second(), self.rejected)
+
+def read_csv(stream):
+    """ Yields (cart, rows) for each group of consecutive rows with the same uid/sid """
+    rows = []
+    for row in csv.DictReader(stream):
+        if rows and (row['uid'], row['sid']) != (rows[0]['uid'], rows[0]['sid']):
+            yield _cart_from_rows(rows), rows
+            rows = []
+        rows.append(row)
+    if rows:
+        yield _cart_from_rows(rows), rows
+
+def read_ndjson(stream):
+    """ Yields (cart, [line]) for every non blank line """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            cart = json.loads(line)
+        except ValueError:
+            cart = None
+        yield cart, [line]
+
+def import_carts(stream, fmt='csv', batch_size=500, keep_sids=True, rejects=None):
+    """ Imports every cart of stream and returns an ImportStats
+
+    Carts that fail validation, whose uid already has a cart or whose sid
+    holds the cart of another uid are written to the rejects file object
+    (if any) along with the reason.
+    """
+    stats = ImportStats()
+    reader = read_csv(stream) if fmt == 'csv' else read_ndjson(stream)
+    reject = _csv_rejects(rejects) if fmt == 'csv' else _ndjson_rejects(rejects)
+    batch = []
+    for cart, rows in reader:
+        stats.rows += len(rows)
+        if not keep_sids and isinstance(cart, dict):
+            cart.pop('sid', None)
+        if not _valid(cart):
+            stats.rejected += 1
+            reject(rows, 'Data is not valid')
+            continue
+        batch.append((Shopcart().deserialize(cart), rows))
+        if len(batch) >= batch_size:
+            _flush(batch, stats, reject)
+            batch = []
+    if batch:
+        _flush(batch, stats, reject)
+    stats.elapsed = time.time() - stats.started
+    return stats
+
+def _flush(batch, stats, reject):
+    shopcarts = [shopcart for shopcart, rows in batch]
+    sids = [shopcart.sid for shopcart in shopcarts if shopcart.sid]
+    # before saving, so a cart created meanwhile doesn't get one of the imported sids
+    if sids:
+        Shopcart.reserve_index(max(sids))
+    rejected = set(id(shopcart) for shopcart in Shopcart.save_many(shopcarts))
+    for shopcart, rows in batch:
+        if id(shopcart) in rejected:
+            stats.rejected += 1
+            reject(rows, _rejected_reason(shopcart))
+        else:
+            stats.carts += 1
+
+def _rejected_reason(shopcart):
+    found = Shopcart.find(shopcart.sid)
+    if found is not None and Storage.uid_name(found['uid']) != Storage.uid_name(shopcart.uid):
+        return u'Shopping Cart %d belongs to another uid' % shopcart.sid
+    return u'Shopping Cart for uid %s already exists' % shopcart.uid
+
+def _valid(cart):
+    if not isinstance(cart, dict):
+        return False
+    # sids are positive ints, a cart without one gets a new sid
+    sid = cart.get('sid')
+    if sid is not None and (isinstance(sid, bool) or not isinstance(sid, (int, long)) or sid <= 0):
+        return False
+    if cart.get('products') in (None, [], [[]]):
+        cart['products'] = [[]]  # the placeholder of a cart without products, as the API creates them
+    elif not Shopcart.validate_product(cart):
+        return False
+    if 'subtotal' not in cart:
+        cart['subtotal'] = 0.0
+    return Shopcart.validate_shopcart(cart)
+
+def _cart_from_rows(rows):
+    try:
+        cart = {'uid': int(rows[0]['uid']), 'subtotal': 0.0, 'products': []}
+        if rows[0]['sid']:
+            cart['sid'] = int(rows[0]['sid'])
+        for row in rows:
+            if not row['products_sku']:
+                continue  # the row of a cart without products
+            cart['products'].append({
+                'sku': int(row['products_sku']),
+                'quantity': int(row['products_quantity']),
+                'name': row['products_name'].decode('utf-8'),
+                'unitprice': float(row['products_unitprice'])
+            })
+    except (KeyError, TypeError, ValueError, UnicodeDecodeError):
+        return None
+    return cart
+
+def _csv_rejects(rejects):
+    if rejects is None:
+        return lambda rows, reason: None
+    writer = csv.DictWriter(rejects, CSV_COLUMNS + ['reason'], extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    def reject(rows, reason):
+        for row in rows:
+            row = dict(row)
+            row['reason'] = reason
+            writer.writerow(row)
+    return reject
+
+def _ndjson_rejects(rejects):
+    if rejects is None:
+        return lambda rows, reason: None
+    def reject(rows, reason):
+        for line in rows:
+            rejects.write(json.dumps({'reason': reason, 'line': line.rstrip('\n')}) + '\n')
+    return reject
@@ -0,0 +1,51 @@
+######################################################################
+# Content negotiation
+#   Every route answers in JSON or MessagePack (application/msgpack),
+#   whichever Accept prefers, JSON without a preference. Request bodies
+#   are read in either by their Content-Type. Both decode to the same
+#   dicts and lists, so the validators of models.py check the same
+#   payload whatever the encoding. Python 2 str and unicode are both
+#   packed as MessagePack strings, never as bin, so every client gets
+#   text keys and values.
+######################################################################
+
+from collections import OrderedDict
+import flask
+import msgpack
+from flask import request, current_app, has_request_context
+from custom_exceptions import DataValidationError
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+ENCODERS = OrderedDict([(MSGPACK, lambda value: msgpack.packb(value, use_bin_type=False))])
+DECODERS = {MSGPACK: lambda data: msgpack.unpackb(data, raw=False)}
+
+MEDIA_TYPES = [JSON] + ENCODERS.keys()
+
+def response_type():
+    """ Returns the media type of the response, the one Accept prefers """
+    if not has_request_context():
+        return JSON
+    return request.accept_mimetypes.best_match(MEDIA_TYPES, default=JSON)
+
+def wants_json():
+    return response_type() == JSON
+
+def jsonify(*args, **kwargs):
+    """ Same as flask.jsonify, in the media type Accept prefers """
+    mimetype = response_type()
+    if mimetype == JSON:
+        return flask.jsonify(*args, **kwargs)
+    value = args[0] if len(args) == 1 else dict(*args, **kwargs)
+    return current_app.response_class(ENCODERS[mimetype](value), mimetype=mimetype)
+
+def get_payload():
+    """ Returns the body of the request decoded by its Content-Type, None if it isn't a known one """
+    decode = DECODERS.get(request.mimetype)
+    if decode is None:
+        return request.get_json()
+    try:
+        return decode(request.get_data())
+    except (ValueError, msgpack.UnpackException):
+        raise DataValidationError('Data is not valid')
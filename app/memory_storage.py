@@ -0,0 +1,323 @@
+import sys
+import time
+import bisect
+from threading import RLock
+from custom_exceptions import DataValidationError, VersionConflict
+from storage import Storage, ReapStats
+import codec
+
+######################################################################
+# Carts in the memory of the process
+#   Keeps every cart as the same hash fields RedisStorage writes and
+#   changes them the way the Lua scripts do, so both backends behave
+#   alike. Readers always get a freshly decoded cart and one lock
+#   serializes every operation. Nothing is shared with other processes.
+#   Expired carts are dropped when they are next looked at or by reap().
+######################################################################
+
+class MemoryStorage(Storage):
+
+    def __init__(self):
+        self.carts = {}
+        self.expires = {}
+        self.uids = {}
+        self.index = 0
+        self._lock = RLock()
+
+    #
+    # sids
+    #
+    def next_ids(self, count=1):
+        with self._lock:
+            self.index += count
+            return self.index
+
+    def reserve_id(self, sid):
+        with self._lock:
+            self.index = max(self.index, sid)
+
+    #
+    # carts
+    #
+    def get_versioned(self, sid):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            return codec.from_hash(sid, fields), codec.version_of(fields)
+
+    def get_many_versioned(self, sids):
+        with self._lock:
+            return [self.get_versioned(sid) for sid in sids]
+
+    def get_json(self, sid):
+        if not self.store_json:
+            return Storage.get_json(self, sid)
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            if 'json' not in fields:
+                fields['json'] = codec.render(codec.from_hash(sid, fields)['products'])
+            return (codec.render_cart(sid, codec.unpack_value(fields['uid']), codec.subtotal_from(fields), fields['json']),
+                    fields['json'], codec.version_of(fields))
+
+    def version(self, sid):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            return codec.version_of(fields)
+
+    def exists(self, sid):
+        with self._lock:
+            return self.__fields(sid) is not None
+
+    def touched(self, sid):
+        with self._lock:
+            fields = self.__fields(sid)
+            return int(fields['touched']) if fields is not None else None
+
+    def put(self, cart, min_version=0, touched=None):
+        with self._lock:
+            sid, uid = cart['sid'], self.uid_name(cart['uid'])
+            owner = self.index_get(uid)
+            if owner is not None and owner != sid:
+                raise DataValidationError(u'Shopping Cart for uid %s already exists' % cart['uid'])
+            # if this sid used to belong to another uid, drop that stale index entry
+            previous = self.__fields(sid)
+            if previous is not None:
+                old_uid = self.uid_name(codec.unpack_value(previous['uid']))
+                if old_uid != uid and self.uids.get(old_uid) == sid:
+                    del self.uids[old_uid]
+            self.__write(cart, min_version, touched)
+
+    def put_many(self, carts):
+        with self._lock:
+            rejected = []
+            for i, cart in enumerate(carts):
+                owner = self.index_get(cart['uid'])
+                previous = self.__fields(cart['sid'])
+                if previous is not None and self.uid_name(codec.unpack_value(previous['uid'])) != self.uid_name(cart['uid']):
+                    owner = -1  # the sid holds the cart of another uid
+                if owner is not None and owner != cart['sid']:
+                    rejected.append(i)
+                    continue
+                self.__write(cart)
+            return rejected
+
+    def __write(self, cart, min_version=0, touched=None):
+        fields = dict((field, str(value)) for field, value in codec.to_hash(cart).items())
+        # the version goes on from the one of the cart replaced, __touch bumps it
+        previous = self.carts.get(cart['sid'])
+        fields['version'] = str(max(min_version, codec.version_of(previous) if previous else 0))
+        self.carts[cart['sid']] = fields
+        self.uids[self.uid_name(cart['uid'])] = cart['sid']
+        self.__touch(cart['sid'], fields, touched)
+        if self.store_json:
+            fields['json'] = codec.render(cart['products'])
+
+    def modify(self, sid, change, version=None):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            self.__check_version(fields, version)
+            cart = codec.from_hash(sid, fields)
+            result = change(cart)
+            self.__write(cart)
+            return result
+
+    def delete(self, sid, uid, version=None):
+        with self._lock:
+            if version is not None:
+                self.__check_version(self.__fields(sid), version)
+            self.carts.pop(int(sid), None)
+            self.expires.pop(int(sid), None)
+            if self.uids.get(self.uid_name(uid)) == int(sid):
+                del self.uids[self.uid_name(uid)]
+
+    def flush(self):
+        with self._lock:
+            self.carts.clear()
+            self.expires.clear()
+            self.uids.clear()
+            self.index = 0
+
+    def scan(self, cursor, count):
+        # the cursor is the sid the batch starts from, deleting carts doesn't move it
+        with self._lock:
+            sids = sorted(self.carts)
+            start = bisect.bisect_left(sids, cursor)
+            cursor = sids[start + count] if start + count < len(sids) else 0
+            return cursor, sids[start:start + count]
+
+    #
+    # uid index
+    #
+    def index_get(self, uid):
+        with self._lock:
+            sid = self.uids.get(self.uid_name(uid))
+            if sid is not None and self.__fields(sid) is None:
+                return None  # expired with its cart
+            return sid
+
+    def index_clear(self):
+        with self._lock:
+            self.uids.clear()
+
+    def index_add_many(self, entries):
+        with self._lock:
+            added = []
+            for uid, sid in entries:
+                added.append(self.uid_name(uid) not in self.uids)
+                self.uids.setdefault(self.uid_name(uid), int(sid))
+            return added
+
+    #
+    # products, as in scripts.py
+    #
+    def get_product(self, sid, sku):
+        with self._lock:
+            data = (self.__fields(sid) or {}).get(codec.product_field(sku))
+            if data is None:
+                return None
+            return codec.unpack_product(data)
+
+    def add_products(self, sid, products, version=None, uid=None):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            self.__check_version(fields, version)
+            delta = 0
+            for product in products:
+                position = fields.get(codec.order_field(product['sku']))
+                if position is None:
+                    fields['seq'] = str(int(fields['seq']) + 1)
+                    position = fields['seq']
+                delta += codec.line_cents(product) - self.__line_cents(fields, product['sku'])
+                fields[codec.product_field(product['sku'])] = codec.pack_product(product)
+                fields[codec.order_field(product['sku'])] = position
+            fields.pop('empty', None)
+            self.__add_cents(fields, delta)
+            self.__touch(sid, fields)
+            return codec.from_hash(sid, fields)
+
+    def update_product(self, sid, sku, product, version=None, uid=None):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            self.__check_version(fields, version)
+            position = fields.pop(codec.order_field(sku), None)
+            if position is None:
+                raise KeyError(sku)
+            delta = codec.line_cents(product) - self.__line_cents(fields, sku)
+            del fields[codec.product_field(sku)]
+            # a line that already had the new sku is replaced as well
+            delta -= self.__line_cents(fields, product['sku'])
+            fields[codec.product_field(product['sku'])] = codec.pack_product(product)
+            fields[codec.order_field(product['sku'])] = position
+            self.__add_cents(fields, delta)
+            self.__touch(sid, fields)
+            return codec.from_hash(sid, fields)
+
+    def remove_product(self, sid, sku, version=None, uid=None):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is not None:
+                self.__check_version(fields, version)
+                self.__add_cents(fields, -self.__line_cents(fields, sku))
+                fields.pop(codec.product_field(sku), None)
+                fields.pop(codec.order_field(sku), None)
+                self.__touch(sid, fields)
+
+    def update_subtotal(self, sid, version=None, uid=None):
+        with self._lock:
+            fields = self.__fields(sid)
+            if fields is None:
+                return None
+            self.__check_version(fields, version)
+            fields['cents'] = str(codec.cents_of(codec.from_hash(sid, fields)['products']))
+            self.__touch(sid, fields)
+            return codec.from_hash(sid, fields)
+
+    @staticmethod
+    def __check_version(fields, version):
+        if version is not None and (fields is None or codec.version_of(fields) != version):
+            raise VersionConflict('cart is not at version %d' % version)
+
+    @staticmethod
+    def __line_cents(fields, sku):
+        data = fields.get(codec.product_field(sku))
+        return codec.line_cents(codec.unpack_product(data)) if data is not None else 0
+
+    @staticmethod
+    def __add_cents(fields, delta):
+        fields['cents'] = str(int(fields['cents']) + delta)
+
+    def recompute_subtotals(self, compute, batch_size, dry_run=False):
+        for sids in self.scan_batches(batch_size):
+            with self._lock:
+                found = [(sid, fields) for sid, fields in [(sid, self.__fields(sid)) for sid in sids] if fields is not None]
+                changes = []
+                for (sid, fields), new in zip(found, compute([codec.from_hash(sid, fields) for sid, fields in found])):
+                    old = int(fields['cents'])
+                    if old != new:
+                        changes.append((sid, old, new))
+                        if not dry_run:
+                            fields['cents'] = str(new)
+                            fields['version'] = str(codec.version_of(fields) + 1)
+            yield len(found), changes
+
+    #
+    # expiry
+    #
+    def reap(self, batch_size=500):
+        """ Drops every expired cart and the index entries of missing carts """
+        stats = ReapStats()
+        with self._lock:
+            now = time.time()
+            for sid, expires in self.expires.items():
+                if expires <= now:
+                    fields = self.carts.get(sid)
+                    stats.carts += 1
+                    stats.placeholders += int('empty' in fields)
+                    stats.bytes += self.__size(fields)
+                    self.__expire(sid)
+            for uid, sid in self.uids.items():
+                if sid not in self.carts:
+                    del self.uids[uid]
+                    stats.index_entries += 1
+        stats.elapsed = time.time() - stats.started
+        return stats
+
+    def __fields(self, sid):
+        sid = int(sid)
+        expires = self.expires.get(sid)
+        if expires is not None and expires <= time.time():
+            self.__expire(sid)
+        return self.carts.get(sid)
+
+    def __expire(self, sid):
+        fields = self.carts.pop(sid)
+        del self.expires[sid]
+        uid = self.uid_name(codec.unpack_value(fields['uid']))
+        if self.uids.get(uid) == sid:
+            del self.uids[uid]
+
+    def __touch(self, sid, fields, touched=None):
+        now = touched or time.time()
+        fields['touched'] = str(int(now))
+        fields['version'] = str(codec.version_of(fields) + 1)
+        fields.pop('json', None)
+        ttl = self.empty_ttl if 'empty' in fields else self.idle_ttl
+        if ttl:
+            self.expires[int(sid)] = now + ttl
+        else:
+            self.expires.pop(int(sid), None)
+
+    @staticmethod
+    def __size(fields):
+        return sys.getsizeof(fields) + sum(sys.getsizeof(field) + sys.getsizeof(value) for field, value in fields.items())
@@ -1,17 +1,24 @@
-import pickle
+import base64
 from flask import url_for
 from werkzeug.exceptions import NotFound
 from custom_exceptions import DataValidationError
+from storage import Storage
+from redis_storage import RedisStorage
+import codec
+from cache import ALL
 from . import app
 
 ######################################################################
 # Shopcart Model for database
 #   This class must be initialized with use_db(redis) before using
-#   where redis is a value connection to a Redis database
+#   where redis is a value connection to a Redis database, or with
+#   use_storage(storage) and any other backend of storage.py
 ######################################################################
 
 class Shopcart(object):
-    __redis = None
+    __storage = None
+    __cache = None
+    __listener = None
 
     def __init__(self, uid=0, sid=0,subtotal=0.0,products=[]):
         self.uid = int(uid)
@@ -21,14 +28,15 @@ class Shopcart(object):
 
     def save(self):
         if self.sid == 0:
-            self.sid = self.__next_index()
-        Shopcart.__redis.set(self.sid, pickle.dumps(self.serialize()))
+            self.sid = Shopcart.__storage.next_ids()
+        self.subtotal = Shopcart.subtotal_of(self.products)
+        Shopcart.__storage.put(self.serialize())
+        Shopcart.__changed(self.sid)
 
-    def delete(self):
-        Shopcart.__redis.delete(self.sid)
-
-    def __next_index(self):
-        return Shopcart.__redis.incr('index')
+    def delete(self, version=None):
+        """ Deletes the cart, only if it is still at version unless that is None """
+        Shopcart.__storage.delete(self.sid, self.uid, version)
+        Shopcart.__changed(self.sid)
 
     def self_url(self,urltype):
         return url_for('get_shopcart', sid=self.sid, _external=True)
@@ -37,11 +45,27 @@ class Shopcart(object):
         return { "uid": self.uid, "sid": self.sid, "subtotal": self.subtotal, "products": self.products }
 
     def deserialize_products(self,data):
-        for i in range(0,len(data)):
-            if len(self.products) == 1:
-                if self.products[0] == []:
-                    self.products.remove(self.products[0])
-            self.products.append(data[i])
+        """ Adds the products of data, replacing the lines with the same sku """
+        products = [product for product in self.products if product != []]
+        index = Shopcart.product_index(products)
+        for product in data:
+            position = index.get(product['sku'])
+            if position is None:
+                index[product['sku']] = len(products)
+                products.append(product)
+            else:
+                products[position] = product
+        self.products = products
+
+    @staticmethod
+    def subtotal_of(products):
+        """ Returns the subtotal of products, summed in cents """
+        return codec.cents_of(products) / 100.0
+
+    @staticmethod
+    def product_index(products):
+        """ Returns the position of every sku in a products list """
+        return dict((product['sku'], i) for i, product in enumerate(products) if isinstance(product, dict) and 'sku' in product)
 
     def deserialize(self, data):
         if "sid" in data:
@@ -63,41 +87,300 @@ class Shopcart(object):
 
     @staticmethod
     def use_db(redis):
-        Shopcart.__redis = redis
+        Shopcart.use_storage(RedisStorage(redis) if redis else None)
+
+    @staticmethod
+    def use_storage(storage):
+        """ Keeps the carts in storage (a storage.Storage), None disconnects the model """
+        Shopcart.__storage = storage
+        Shopcart.__listen()
+
+    @staticmethod
+    def use_cache(cache):
+        """ Caches decoded carts in cache (a CartCache), None turns caching off """
+        Shopcart.__cache = cache
+        Shopcart.__listen()
+
+    @staticmethod
+    def cache_stats():
+        if Shopcart.__cache is None:
+            return None
+        return Shopcart.__cache.stats()
+
+    @staticmethod
+    def __listen():
+        if Shopcart.__listener:
+            Shopcart.__listener.stop()
+            Shopcart.__listener = None
+        if Shopcart.__cache is not None and Shopcart.__storage is not None:
+            Shopcart.__cache.clear()
+            Shopcart.__listener = Shopcart.__storage.listen(Shopcart.__cache, app.logger)
+
+    @staticmethod
+    def __changed(*sids):
+        # drop the carts from our cache now and from the other processes' through the storage
+        if Shopcart.__cache is None:
+            return
+        for sid in sids:
+            Shopcart.__cache.invalidate(sid)
+        Shopcart.__storage.publish(sids)
 
     @staticmethod
     def remove_all():
-        Shopcart.__redis.flushall()
+        Shopcart.__storage.flush()
+        Shopcart.__changed(ALL)
+
+    @staticmethod
+    def save_many(shopcarts):
+        """ Saves a batch of carts at once, returns the carts rejected for a duplicate uid """
+        new_carts = [shopcart for shopcart in shopcarts if shopcart.sid == 0]
+        if new_carts:
+            # allocate all the new sids at once
+            last = Shopcart.__storage.next_ids(len(new_carts))
+            for i, shopcart in enumerate(new_carts):
+                shopcart.sid = last - len(new_carts) + 1 + i
+        if not shopcarts:
+            return []
+        for shopcart in shopcarts:
+            shopcart.subtotal = Shopcart.subtotal_of(shopcart.products)
+        rejected = Shopcart.__storage.put_many([shopcart.serialize() for shopcart in shopcarts])
+        Shopcart.__changed(*[shopcart.sid for shopcart in shopcarts])
+        return [shopcarts[i] for i in rejected]
+
+    @staticmethod
+    def modify(sid, change, version=None):
+        """ Applies change(cart) to the cart sid and saves it atomically, see Storage.modify """
+        result = Shopcart.__storage.modify(sid, change, version)
+        if result is not None:
+            Shopcart.__changed(sid)
+        return result
+
+    @staticmethod
+    def migrate_encoding(batch_size=500, pause=0.1):
+        """ Converts carts stored in a legacy format, see RedisStorage.migrate """
+        return Shopcart.__storage.migrate(batch_size, pause)
+
+    @staticmethod
+    def check_subtotals(batch_size=500, fix=False):
+        """ Yields (sid, stored, computed) for every cart whose subtotal isn't the one of its products
+
+        With fix, the computed subtotal of every one of them is stored as
+        recompute_subtotals does: the cart is not touched, so its ttl is
+        left alone, and only the carts that changed get a new version.
+        """
+        compute = lambda carts: [codec.cents_of(cart['products']) for cart in carts]
+        for carts, changes in Shopcart.recompute_subtotals(compute, batch_size, dry_run=not fix):
+            for sid, old, new in changes:
+                yield sid, old / 100.0, new / 100.0
+
+    @staticmethod
+    def recompute_subtotals(compute, batch_size=500, dry_run=False):
+        """ Sets the subtotal of every cart to compute(carts), one batch at a time, see recompute.py """
+        for carts, changes in Shopcart.__storage.recompute_subtotals(compute, batch_size, dry_run):
+            if changes and not dry_run:
+                Shopcart.__changed(*[sid for sid, old, new in changes])
+            yield carts, changes
+
+    @staticmethod
+    def reap(batch_size=500):
+        """ Deletes the carts past their idle ttl that the storage hasn't dropped by itself, returns a ReapStats """
+        stats = Shopcart.__storage.reap(batch_size)
+        if stats.carts:
+            Shopcart.__changed(ALL)
+        return stats
+
+    @staticmethod
+    def rebalance(batch_size=500):
+        """ Moves the carts to the shard that now owns them, returns how many and the sids left, see ShardedStorage.rebalance """
+        return Shopcart.__storage.rebalance(batch_size)
+
+    @staticmethod
+    def reserve_index(sid):
+        """ Makes sure the sid counter is at least sid, for carts saved with explicit sids """
+        Shopcart.__storage.reserve_id(sid)
 
     @staticmethod
     def all():
-        results = []
-        for key in Shopcart.__redis.keys():
-            if key != 'index':  # filer out our id index
-                data = Shopcart.__redis.get(key)
-                data = pickle.loads(data)
-                results.append(data)
-        return results
+        return list(Shopcart.iterate())
+
+    @staticmethod
+    def iterate(batch_size=500):
+        """ Yields every cart, fetching one scan batch at a time """
+        for sids in Shopcart.__storage.scan_batches(batch_size):
+            for cart in Shopcart.__storage.get_many(sids):
+                if cart is not None:  # deleted since the scan
+                    yield cart
+
+    @staticmethod
+    def page(cursor=None, limit=100):
+        """ Returns up to limit carts and the cursor of the next page (None on the last one)
+
+        The cursor is the scan cursor the page started from, the last sid
+        returned from that scan batch and the scan cursor the batch ended at,
+        so a page can end in the middle of a batch. The next page scans the
+        batch again and goes on after that sid in sid order, carts deleted
+        in the meantime don't shift it. If the scan no longer ends where it
+        did, the same batch is read again with scan_until.
+        """
+        scan_cursor, last, end = Shopcart.__decode_cursor(cursor)
+        keys = []
+        next_cursor = None
+        while True:
+            next_scan, batch = Shopcart.__storage.scan(scan_cursor, limit)
+            if last and next_scan != end:
+                batch, next_scan = Shopcart.__storage.scan_until(scan_cursor, end), end
+            batch = [key for key in sorted(batch, key=int) if int(key) > last]
+            needed = limit - len(keys)
+            if len(batch) > needed:
+                keys.extend(batch[:needed])
+                next_cursor = Shopcart.__encode_cursor(scan_cursor, int(keys[-1]), next_scan)
+                break
+            keys.extend(batch)
+            last = 0
+            if next_scan == 0:
+                break
+            scan_cursor = next_scan
+            if len(keys) == limit:
+                next_cursor = Shopcart.__encode_cursor(scan_cursor, 0, 0)
+                break
+        results = [cart for cart in Shopcart.__storage.get_many(keys) if cart is not None]
+        return results, next_cursor
+
+    @staticmethod
+    def __encode_cursor(scan_cursor, last, end):
+        return base64.urlsafe_b64encode('%d:%d:%d' % (scan_cursor, last, end))
+
+    @staticmethod
+    def __decode_cursor(cursor):
+        if not cursor:
+            return 0, 0, 0
+        try:
+            scan_cursor, last, end = [int(part) for part in base64.urlsafe_b64decode(str(cursor)).split(':')]
+        except (TypeError, ValueError):
+            raise DataValidationError('Invalid cursor: %s' % cursor)
+        if scan_cursor < 0 or last < 0 or end < 0:
+            raise DataValidationError('Invalid cursor: %s' % cursor)
+        return scan_cursor, last, end
 
     @staticmethod
     def find(sid):
-        if Shopcart.__redis.exists(sid):
-            data = Shopcart.__redis.get(sid)
-            data = pickle.loads(data)
-            return data
-        else:
-            return None
+        found = Shopcart.find_versioned(sid)
+        return found[0] if found else None
 
     @staticmethod
-    def check_shopcart_exists(sid):
-        if Shopcart.__redis.exists(sid):
-            data = pickle.loads(Shopcart.__redis.get(sid))
-            shopcart = Shopcart(data['sid']).deserialize(data)
-            return shopcart
-        else:
+    def find_versioned(sid):
+        """ Returns (cart, version) of the cart sid or None
+
+        The cache keeps the version along with the cart, so both always match.
+        """
+        if Shopcart.__cache is None:
+            return Shopcart.__storage.get_versioned(sid)
+        found = Shopcart.__cache.get(sid)
+        if found is None:
+            found = Shopcart.__storage.get_versioned(sid)
+            if found is not None:
+                Shopcart.__cache.put(sid, found)
+        return found
+
+    @staticmethod
+    def find_json(sid):
+        """ Returns (JSON of the cart, JSON of its products, version) of the cart sid or None
+
+        With a storage that keeps the JSON (store_json) it is read from there,
+        otherwise the cart is found as usual and rendered.
+        """
+        if Shopcart.__cache is None or Shopcart.__storage.store_json:
+            return Shopcart.__storage.get_json(sid)
+        found = Shopcart.find_versioned(sid)
+        if found is None:
             return None
+        cart, version = found
+        products_json = codec.render(cart['products'])
+        return codec.render_cart(sid, cart['uid'], cart['subtotal'], products_json), products_json, version
 
+    @staticmethod
+    def find_many(sids):
+        """ Returns the carts of sids in the same order, None for the missing ones
 
+        Every cart not in the cache is fetched with a single storage.get_many.
+        """
+        if Shopcart.__cache is None:
+            return Shopcart.__storage.get_many(sids)
+        found = [Shopcart.__cache.get(sid) for sid in sids]
+        misses = [i for i, entry in enumerate(found) if entry is None]
+        if misses:
+            for i, entry in zip(misses, Shopcart.__storage.get_many_versioned([sids[i] for i in misses])):
+                if entry is not None:
+                    Shopcart.__cache.put(sids[i], entry)
+                    found[i] = entry
+        return [entry[0] if entry else None for entry in found]
+
+    @staticmethod
+    def version(sid):
+        """ Returns the version of the cart sid, None if there is none, without reading the cart """
+        return Shopcart.__storage.version(sid)
+
+    @staticmethod
+    def exists(sid):
+        return Shopcart.__storage.exists(sid)
+
+    @staticmethod
+    def get_product(sid, sku):
+        """ Returns the product sku of cart sid, None if the cart or the product doesn't exist
+
+        Only the line of sku is read, whatever the size of the cart.
+        """
+        return Shopcart.__storage.get_product(sid, sku)
+
+    #
+    # the product changes only change a cart still at version unless that is
+    # None, and raise VersionConflict otherwise. uid is the uid of the cart
+    # if the caller knows it, otherwise it is taken from the cache when the
+    # cart is there, so the storage doesn't have to look it up.
+    #
+    @staticmethod
+    def __uid_of(sid, uid):
+        if uid is not None or Shopcart.__cache is None:
+            return uid
+        found = Shopcart.__cache.get(sid)
+        return found[0]['uid'] if found is not None else None
+
+    @staticmethod
+    def add_products(sid, products, version=None, uid=None):
+        """ Adds products to a cart, replacing the lines with the same sku
+
+        Returns the updated cart or None if there is no cart sid
+        """
+        cart = Shopcart.__storage.add_products(sid, products, version, Shopcart.__uid_of(sid, uid))
+        Shopcart.__changed(sid)
+        return cart
+
+    @staticmethod
+    def update_product(sid, sku, product, version=None, uid=None):
+        """ Replaces the line of sku with product, which may have another sku
+
+        Returns the updated cart or None if there is no cart sid, raises
+        KeyError if the cart has no product sku
+        """
+        cart = Shopcart.__storage.update_product(sid, sku, product, version, Shopcart.__uid_of(sid, uid))
+        Shopcart.__changed(sid)
+        return cart
+
+    @staticmethod
+    def remove_product(sid, sku, version=None, uid=None):
+        Shopcart.__storage.remove_product(sid, sku, version, Shopcart.__uid_of(sid, uid))
+        Shopcart.__changed(sid)
+
+    @staticmethod
+    def update_subtotal(sid, version=None, uid=None):
+        """ Recomputes the subtotal of a cart from its products, returns the cart or None if there is no cart sid
+
+        Every product change keeps the subtotal up to date, this repairs carts
+        written before that or found by check_subtotals.
+        """
+        cart = Shopcart.__storage.update_subtotal(sid, version, Shopcart.__uid_of(sid, uid))
+        Shopcart.__changed(sid)
+        return cart
 
     @staticmethod
     def validate_shopcart(data):
@@ -136,11 +419,27 @@ class Shopcart(object):
 
     @staticmethod
     def find_by_uid(uid):
-        results = []
-        for key in Shopcart.__redis.keys():
-            if key != 'index':  # filer out our id index
-                data = Shopcart.__redis.get(key)
-                data = pickle.loads(data)
-                if data["uid"] == uid:
-                    results.append(data)
-        return results
\ No newline at end of file
+        sid = Shopcart.__storage.index_get(uid)
+        if sid is None:
+            return []
+        data = Shopcart.find(sid)
+        if data is None:
+            return []
+        if Storage.uid_name(data['uid']) != Storage.uid_name(uid):  # index entry outlived its cart
+            return []
+        return [data]
+
+    @staticmethod
+    def reindex(batch_size=500):
+        """ Rebuilds the uid -> sid index from the stored carts """
+        Shopcart.__storage.index_clear()
+        indexed = 0
+        duplicates = 0
+        for sids in Shopcart.__storage.scan_batches(batch_size):
+            entries = [(data['uid'], data['sid']) for data in Shopcart.__storage.get_many(sids) if data is not None]
+            for created in Shopcart.__storage.index_add_many(entries):
+                if created:
+                    indexed += 1
+                else:
+                    duplicates += 1
+        return indexed, duplicates
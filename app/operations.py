@@ -0,0 +1,92 @@
+from flask_api import status    # HTTP Status Codes
+from models import Shopcart
+
+######################################################################
+# Batched operations on one cart
+#   A list of operations, each shaped like the body of the route it
+#   stands for, is applied in order to one decoded cart in memory and
+#   the cart is saved once, atomically (see Storage.modify):
+#
+#     {"op": "add", "products": [...]}               POST /shopcarts/<sid>/products
+#     {"op": "update", "sku": 1, "products": [...]}  PUT /shopcarts/<sid>/products/<sku>
+#     {"op": "remove", "sku": 1}                     DELETE /shopcarts/<sid>/products/<sku>
+#     {"op": "subtotal"}                             PUT /shopcarts/<sid>/subtotal
+#
+#   Every operation gets the status and error the route would answer
+#   with, an operation that fails leaves the cart as it was and the
+#   following ones are still applied.
+######################################################################
+
+def add(cart, operation):
+    if not Shopcart.validate_product(operation):
+        return status.HTTP_400_BAD_REQUEST, 'Data is not valid'
+    products = [product for product in cart['products'] if product != []]
+    index = Shopcart.product_index(products)
+    for product in operation['products']:
+        position = index.get(product['sku'])
+        if position is None:
+            index[product['sku']] = len(products)
+            products.append(product)
+        else:
+            products[position] = product
+    cart['products'] = products
+    return status.HTTP_201_CREATED, None
+
+def update(cart, operation):
+    sku = operation.get('sku')
+    if not _is_sku(sku) or not Shopcart.validate_product(operation) or len(operation['products']) != 1:
+        return status.HTTP_400_BAD_REQUEST, 'Product data is not valid'
+    position = Shopcart.product_index(cart['products']).get(sku)
+    if position is None:
+        return status.HTTP_404_NOT_FOUND, 'Product %s was not found in shopping cart %s' % (str(sku), str(cart['sid']))
+    product = operation['products'][0]
+    product = {'sku': product['sku'], 'quantity': product['quantity'], 'name': product['name'], 'unitprice': product['unitprice']}
+    # a line that already had the new sku is replaced as well
+    cart['products'] = [product if i == position else line for i, line in enumerate(cart['products'])
+                        if i == position or not (isinstance(line, dict) and line.get('sku') == product['sku'])]
+    return status.HTTP_200_OK, None
+
+def remove(cart, operation):
+    sku = operation.get('sku')
+    if not _is_sku(sku):
+        return status.HTTP_400_BAD_REQUEST, 'Data is not valid'
+    cart['products'] = [line for line in cart['products'] if not (isinstance(line, dict) and line.get('sku') == sku)]
+    return status.HTTP_204_NO_CONTENT, None
+
+def subtotal(cart, operation):
+    return status.HTTP_200_OK, None
+
+OPERATIONS = {
+    'add': add,
+    'update': update,
+    'remove': remove,
+    'subtotal': subtotal
+}
+
+def _is_sku(sku):
+    return isinstance(sku, (int, long)) and not isinstance(sku, bool)
+
+def apply_all(cart, operations):
+    """ Applies operations to cart in order, returns the result of each one """
+    results = []
+    for i, operation in enumerate(operations):
+        name = operation.get('op') if isinstance(operation, dict) else None
+        if name not in OPERATIONS:
+            code, error = status.HTTP_400_BAD_REQUEST, 'Unknown operation'
+        else:
+            code, error = OPERATIONS[name](cart, operation)
+        result = { 'index': i, 'op': name, 'status': code }
+        if error:
+            result['error'] = error
+        elif name == 'subtotal':
+            result['subtotal'] = Shopcart.subtotal_of(cart['products'])
+        results.append(result)
+    cart['subtotal'] = Shopcart.subtotal_of(cart['products'])
+    return results
+
+def apply_operations(sid, operations, version=None):
+    """ Applies operations to the cart sid and saves it once, returns (cart, results) or None without a cart
+
+    Raises VersionConflict if version isn't None and the cart is at another one.
+    """
+    return Shopcart.modify(sid, lambda cart: (cart, apply_all(cart, operations)), version)
@@ -0,0 +1,201 @@
+import os
+import errno
+import random
+import signal
+import socket
+import logging
+import resource
+import time
+from werkzeug.serving import BaseWSGIServer
+
+######################################################################
+# Pre-forking server
+#   The master opens the listening socket and forks workers that all
+#   accept on it, each serving one request at a time with Werkzeug.
+#   A worker connects to Redis itself after the fork (initialize), and
+#   exits once it has served about max_requests requests or its peak
+#   memory passes max_memory MB, the master forks a fresh one in its
+#   place. On SIGTERM or SIGINT the master stops forking and asks the
+#   workers to finish the request they're serving, those still busy
+#   after graceful_timeout seconds are killed.
+#
+#   A worker that fails (exits with an error, say it can't import or
+#   initialize) is forked again after a delay that doubles with every
+#   failure in a row. After max_failures failures within failure_window
+#   seconds the master gives up, stops the other workers and exits 1.
+######################################################################
+
+class WorkerServer(BaseWSGIServer):
+    """ Werkzeug server on an inherited socket that counts the requests it serves """
+    served = 0
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        BaseWSGIServer.process_request(self, request, client_address)
+
+class PreforkServer(object):
+    backoff_base = 0.1
+    backoff_max = 5.0
+
+    def __init__(self, app, host, port, workers=None, backlog=None, max_requests=None,
+                 max_memory=None, graceful_timeout=None, max_failures=None, failure_window=None,
+                 initialize=None, logger=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or int(os.getenv('WORKERS', '2'))
+        self.backlog = backlog or int(os.getenv('BACKLOG', '128'))
+        self.max_requests = max_requests or int(os.getenv('MAX_REQUESTS', '0'))
+        self.max_memory = max_memory or int(os.getenv('MAX_MEMORY_MB', '0'))
+        self.graceful_timeout = graceful_timeout or float(os.getenv('GRACEFUL_TIMEOUT', '30'))
+        self.max_failures = max_failures or int(os.getenv('MAX_WORKER_FAILURES', '10'))
+        self.failure_window = failure_window or float(os.getenv('WORKER_FAILURE_WINDOW', '60'))
+        self.initialize = initialize
+        self.logger = logger or logging.getLogger(__name__)
+        self.socket = None
+        self.children = set()
+        self.failures = []
+        self.failed_in_a_row = 0
+        self._stopping = False
+
+    @staticmethod
+    def from_env(app, initialize=None, logger=None):
+        """ Returns the server configured by PORT, WORKERS, BACKLOG, MAX_REQUESTS, MAX_MEMORY_MB, GRACEFUL_TIMEOUT,
+        MAX_WORKER_FAILURES and WORKER_FAILURE_WINDOW """
+        return PreforkServer(app, '0.0.0.0', int(os.getenv('PORT', '8888')), initialize=initialize, logger=logger)
+
+    def listen(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        # every worker wakes up for a connection, the ones that lose the accept go back to waiting
+        self.socket.setblocking(0)
+        self.port = self.socket.getsockname()[1]
+
+    def serve_forever(self):
+        """ Forks the workers and keeps them running until SIGTERM or SIGINT, exits 1 if they keep failing """
+        if self.socket is None:
+            self.listen()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.logger.info('Listening on %s:%d with %d workers' % (self.host, self.port, self.workers))
+        gave_up = False
+        while not self._stopping:
+            while len(self.children) < self.workers and not self._stopping:
+                if self.failing():
+                    self.logger.error('Workers failed %d times in %ds, stopping' % (len(self.failures), self.failure_window))
+                    self._stopping = gave_up = True
+                    break
+                if self.failed_in_a_row:
+                    # interrupted by SIGTERM like the wait for a worker
+                    time.sleep(min(self.backoff_max, self.backoff_base * 2 ** (self.failed_in_a_row - 1)))
+                    if self._stopping:
+                        break
+                self.spawn()
+            if not self._stopping:
+                self.reap(block=True)
+        self.shutdown()
+        if gave_up:
+            raise SystemExit(1)
+
+    def failing(self):
+        """ Returns whether max_failures workers failed within the last failure_window seconds """
+        since = time.time() - self.failure_window
+        self.failures = [failed for failed in self.failures if failed > since]
+        return len(self.failures) >= self.max_failures
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+        # the worker
+        code = 0
+        try:
+            self.run_worker()
+        except Exception:
+            self.logger.exception('Worker %d failed' % os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self, block=False):
+        """ Forgets the workers that exited, waiting for one with block """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    return
+                if err.errno == errno.ECHILD:
+                    self.children.clear()
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self.children:
+                self.children.discard(pid)
+                if status and not self._stopping:
+                    self.logger.warning('Worker %d exited with status %d' % (pid, status))
+                    self.failures.append(time.time())
+                    self.failed_in_a_row += 1
+                elif not status:
+                    self.failed_in_a_row = 0
+            block = False
+
+    def shutdown(self):
+        for pid in list(self.children):
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in list(self.children):
+            self.logger.warning('Worker %d did not stop in time, killing it' % pid)
+            self._signal(pid, signal.SIGKILL)
+        while self.children:
+            self.reap(block=True)
+        self.socket.close()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:  # already gone
+            pass
+
+    #
+    # workers
+    #
+    def run_worker(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        # a request being served is not interrupted by SIGTERM
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.children = set()
+        random.seed()
+        if self.initialize:
+            self.initialize()
+        server = WorkerServer(self.host, self.port, self.app, fd=self.socket.fileno())
+        # wakes up every second to notice SIGTERM
+        server.timeout = 1
+        # a little jitter, so the workers started together are not all recycled together
+        limit = self.max_requests + random.randint(0, self.max_requests // 10) if self.max_requests else 0
+        served = 0
+        while not self._stopping:
+            if self.should_recycle(served, limit):
+                self.logger.info('Recycling worker %d after %d requests' % (os.getpid(), served))
+                break
+            server.handle_request()
+            served = server.served
+        server.server_close()
+
+    def should_recycle(self, served, limit):
+        if limit and served >= limit:
+            return True
+        # ru_maxrss is in KB on Linux
+        return bool(self.max_memory) and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss > self.max_memory * 1024
@@ -0,0 +1,69 @@
+import os
+import atexit
+import logging
+from threading import Thread, Event
+from models import Shopcart
+
+######################################################################
+# Background reaping of abandoned carts
+#   Every interval seconds runs Shopcart.reap(), which deletes the
+#   carts past their idle ttl that the storage didn't drop by itself
+#   and uid index entries left without a cart, and keeps the totals
+#   for /stats. Each worker may run one, reaping is idempotent.
+######################################################################
+
+class CartReaper(object):
+
+    def __init__(self, interval, batch_size=500, logger=None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.runs = 0
+        self.carts = 0
+        self.bytes = 0
+        self.last = None
+        self._stopped = Event()
+        self._thread = None
+
+    @staticmethod
+    def from_env(logger=None):
+        """ Returns the reaper configured by SHOPCART_REAP_INTERVAL, None if disabled """
+        interval = float(os.getenv('SHOPCART_REAP_INTERVAL', '0'))
+        if interval <= 0:
+            return None
+        return CartReaper(interval, logger=logger)
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='cart-reaper')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+
+    def reap(self):
+        stats = Shopcart.reap(self.batch_size)
+        self.runs += 1
+        self.carts += stats.carts
+        self.bytes += stats.bytes
+        self.last = stats
+        if stats.carts or stats.index_entries:
+            self.logger.info(str(stats))
+        return stats
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.reap()
+            except Exception as err:  # Redis down, no storage yet: try again next time
+                self.logger.error('Cart reaper failed: %s' % err)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'carts': self.carts,
+            'bytes': self.bytes,
+            'last': self.last.to_dict() if self.last else None
+        }
@@ -0,0 +1,98 @@
+import math
+import time
+from array import array
+from models import Shopcart
+import codec
+
+# imported by load_numpy when a recomputation first needs it
+numpy = None
+
+######################################################################
+# Bulk recomputation of subtotals
+#   After price corrections every subtotal is computed again from the
+#   products. Each batch of carts is turned into columns (unit price,
+#   quantity and the cart of every line) and the cents of the lines
+#   are computed and summed per cart on whole arrays, with numpy if it
+#   is installed and with the array module otherwise. Changed subtotals
+#   are written back in one transaction per batch.
+######################################################################
+
+class RecomputeStats(object):
+
+    def __init__(self):
+        self.carts = 0
+        self.changed = []
+        self.dry_run = False
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def carts_per_second(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.carts / self.elapsed
+
+    def to_dict(self):
+        return {
+            'carts': self.carts,
+            'changed': len(self.changed),
+            'dry_run': self.dry_run,
+            'elapsed': self.elapsed,
+            'carts_per_second': self.carts_per_second()
+        }
+
+    def __str__(self):
+        return '%s %d of %d shopcart subtotals in %.2fs (%.0f carts/s)' % (
+            'Would change' if self.dry_run else 'Changed', len(self.changed), self.carts, self.elapsed, self.carts_per_second())
+
+def load_numpy():
+    """ Returns numpy, imported the first time, None if it isn't installed """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+def columns(carts):
+    """ Returns the unit prices, quantities and cart positions of every line of carts """
+    prices, quantities, owners = array('d'), array('d'), array('l')
+    for i, cart in enumerate(carts):
+        for product in cart['products']:
+            parts = codec.line_parts(product)
+            if parts is not None:
+                prices.append(parts[0])
+                quantities.append(parts[1])
+                owners.append(i)
+    return prices, quantities, owners
+
+def cents_numpy(carts):
+    """ Returns the subtotal in cents of every cart, rounded like codec.line_cents """
+    load_numpy()
+    prices, quantities, owners = [numpy.frombuffer(column, dtype=dtype) for column, dtype in
+                                  zip(columns(carts), (numpy.float64, numpy.float64, numpy.dtype('l')))]
+    lines = numpy.floor(numpy.floor(prices * 100 + 0.5) * quantities + 0.5)
+    return numpy.bincount(owners, weights=lines, minlength=len(carts)).astype(numpy.int64).tolist()
+
+def cents_array(carts):
+    """ Same as cents_numpy without numpy """
+    totals = [0] * len(carts)
+    floor = math.floor
+    for price, quantity, owner in zip(*columns(carts)):
+        totals[owner] += int(floor(floor(price * 100 + 0.5) * quantity + 0.5))
+    return totals
+
+def recompute_subtotals(batch_size=500, dry_run=False, compute=None):
+    """ Recomputes the subtotal of every cart and returns a RecomputeStats
+
+    stats.changed holds the (sid, old subtotal, new subtotal) of every cart
+    whose subtotal changed, or would change with dry_run.
+    """
+    compute = compute or (cents_numpy if load_numpy() else cents_array)
+    stats = RecomputeStats()
+    stats.dry_run = dry_run
+    for carts, changes in Shopcart.recompute_subtotals(compute, batch_size, dry_run):
+        stats.carts += carts
+        stats.changed.extend((sid, old / 100.0, new / 100.0) for sid, old, new in changes)
+    stats.elapsed = time.time() - stats.started
+    return stats
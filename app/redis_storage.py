@@ -0,0 +1,536 @@
+import time
+from redis.exceptions import ResponseError
+from custom_exceptions import DataValidationError, VersionConflict
+from storage import Storage, ReapStats
+from cache import InvalidationListener, CHANNEL
+import codec
+import scripts
+
+######################################################################
+# Carts in Redis
+#   Each cart is a hash under its sid (see codec.py for its fields),
+#   uid:<uid> holds the sid of the cart of uid and index the last sid
+#   given out. Carts still stored as a single string by older versions
+#   are converted to a hash the first time they are read or changed.
+#   Every write sets the ttl of the cart and of its uid key with EXPIRE,
+#   so Redis itself drops abandoned carts.
+######################################################################
+
+class RedisStorage(Storage):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.scripts = scripts.register(redis)
+
+    @staticmethod
+    def uid_key(uid):
+        return 'uid:' + Storage.uid_name(uid)
+
+    @staticmethod
+    def is_cart_key(key):
+        # carts are stored under their sid, everything else is bookkeeping
+        return key.isdigit()
+
+    #
+    # sids
+    #
+    def next_ids(self, count=1):
+        return self.redis.incr('index', count)
+
+    def reserve_id(self, sid):
+        def bump(pipe):
+            current = pipe.get('index')
+            if current is None or int(current) < sid:
+                pipe.multi()
+                pipe.set('index', sid)
+        self.redis.transaction(bump, 'index')
+
+    #
+    # carts
+    #
+    def get_versioned(self, sid):
+        try:
+            fields = self.redis.hgetall(sid)
+        except ResponseError as err:
+            return self.__upgraded(sid, err)
+        if not fields:
+            return None
+        return codec.from_hash(sid, fields), codec.version_of(fields)
+
+    def get_many_versioned(self, sids):
+        if not sids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.hgetall(sid)
+        carts = []
+        for sid, fields in zip(sids, pipe.execute(raise_on_error=False)):
+            if isinstance(fields, ResponseError):
+                carts.append(self.__upgraded(sid, fields))
+            elif fields:
+                carts.append((codec.from_hash(sid, fields), codec.version_of(fields)))
+            else:
+                carts.append(None)
+        return carts
+
+    def get_json(self, sid):
+        if not self.store_json:
+            return Storage.get_json(self, sid)
+        names = ('json', 'uid', 'cents', 'subtotal', 'version', 'v')
+        try:
+            values = self.redis.hmget(sid, *names)
+        except ResponseError as err:
+            if self.__upgrade_or_raise(sid, err) is None:
+                return None
+            values = self.redis.hmget(sid, *names)
+        fields = dict((name, value) for name, value in zip(names, values) if value is not None)
+        if 'v' not in fields:
+            return None
+        if 'json' not in fields:
+            # dropped by a change, rendered again and kept unless the cart changed meanwhile
+            found = Storage.get_json(self, sid)
+            if found is not None:
+                self.scripts['store_json'](keys=[sid], args=[found[2], found[1]])
+            return found
+        products_json = fields['json']
+        return (codec.render_cart(sid, codec.unpack_value(fields['uid']), codec.subtotal_from(fields), products_json),
+                products_json, codec.version_of(fields))
+
+    def version(self, sid):
+        # v is in every hash, so a missing version field is version 0 of an existing cart
+        try:
+            version, layout = self.redis.hmget(sid, 'version', 'v')
+        except ResponseError as err:
+            return 0 if self.__upgrade_or_raise(sid, err) is not None else None
+        if layout is None:
+            return None
+        return int(version or 0)
+
+    def exists(self, sid):
+        return bool(self.redis.exists(sid))
+
+    def touched(self, sid):
+        try:
+            touched = self.redis.hget(sid, 'touched')
+        except ResponseError:  # legacy string cart
+            return None
+        return int(touched) if touched is not None else None
+
+    def put(self, cart, min_version=0, touched=None):
+        # the cart and its uid index entry are written in one transaction
+        sid, uid_key = cart['sid'], self.uid_key(cart['uid'])
+
+        def write(pipe):
+            owner = pipe.get(uid_key)
+            if owner is not None and int(owner) != sid:
+                raise DataValidationError(u'Shopping Cart for uid %s already exists' % cart['uid'])
+            # if this sid used to belong to another uid, drop that stale index entry
+            stale_key = None
+            previous = self.__read(pipe, sid)
+            if previous is not None and self.uid_key(previous['uid']) != uid_key:
+                pipe.watch(self.uid_key(previous['uid']))
+                if pipe.get(self.uid_key(previous['uid'])) == str(sid):
+                    stale_key = self.uid_key(previous['uid'])
+            pipe.multi()
+            if stale_key:
+                pipe.delete(stale_key)
+            self.__write(pipe, cart, uid_key, min_version, touched)
+
+        self.redis.transaction(write, uid_key, sid)
+
+    def put_many(self, carts):
+        uid_keys = [self.uid_key(cart['uid']) for cart in carts]
+        sids = [cart['sid'] for cart in carts]
+        rejected = []
+
+        def write(pipe):
+            del rejected[:]
+            owners = pipe.mget(uid_keys) if uid_keys else []
+            holders = self.__uid_keys_of(pipe, sids)
+            claimed = {}
+            writes = []
+            for i, (cart, uid_key, owner, holder) in enumerate(zip(carts, uid_keys, owners, holders)):
+                owner = int(owner) if owner is not None else claimed.get(uid_key, cart['sid'])
+                holder = claimed.get(cart['sid'], holder)
+                if owner != cart['sid'] or holder not in (None, uid_key):
+                    rejected.append(i)
+                    continue
+                claimed[uid_key] = cart['sid']
+                claimed[cart['sid']] = uid_key
+                writes.append((cart, uid_key))
+            pipe.multi()
+            for cart, uid_key in writes:
+                self.__write(pipe, cart, uid_key)
+
+        if carts:
+            self.redis.transaction(write, *(uid_keys + sids))
+        return rejected
+
+    def __uid_keys_of(self, pipe, sids):
+        # the uid key of the cart stored under each sid, None where there is no cart
+        reads = pipe.pipeline(transaction=False)
+        for sid in sids:
+            reads.hget(sid, 'uid')
+        keys = []
+        for sid, uid in zip(sids, reads.execute(raise_on_error=False)):
+            if isinstance(uid, ResponseError):  # legacy string cart
+                cart = self.__read(pipe, sid)
+                keys.append(self.uid_key(cart['uid']) if cart is not None else None)
+            else:
+                keys.append(self.uid_key(codec.unpack_value(uid)) if uid is not None else None)
+        return keys
+
+    def __write(self, pipe, cart, uid_key, min_version=0, touched=None):
+        now = int(time.time())
+        fields = codec.to_hash(cart)
+        fields['touched'] = touched or now
+        if self.store_json:
+            fields['json'] = codec.render(cart['products'])
+        args = [min_version]
+        for field, value in fields.iteritems():
+            args.extend([field, value])
+        self.scripts['write_cart'](keys=[cart['sid']], args=args, client=pipe)
+        pipe.set(uid_key, cart['sid'])
+        ttl = self.ttl(cart)
+        if ttl:
+            ttl = max(1, ttl - (now - fields['touched']))
+            pipe.expire(cart['sid'], ttl)
+            pipe.expire(uid_key, ttl)
+
+    def modify(self, sid, change, version=None):
+        # the cart is WATCHed, so change works on a fresh copy again if it changed meanwhile
+        def rewrite(pipe):
+            cart = self.__read(pipe, sid)
+            if cart is None:
+                return None
+            self.__check_version(pipe, sid, version)
+            result = change(cart)
+            pipe.multi()
+            self.__write(pipe, cart, self.uid_key(cart['uid']))
+            return result
+
+        return self.redis.transaction(rewrite, sid, value_from_callable=True)
+
+    def delete(self, sid, uid, version=None):
+        uid_key = self.uid_key(uid)
+
+        def unlink(pipe):
+            self.__check_version(pipe, sid, version)
+            owner = pipe.get(uid_key)
+            pipe.multi()
+            pipe.delete(sid)
+            if owner == str(sid):
+                pipe.delete(uid_key)
+
+        self.redis.transaction(unlink, uid_key, sid)
+
+    def flush(self):
+        # only this database, a shard may share its server with others
+        self.redis.flushdb()
+
+    def scan(self, cursor, count):
+        cursor, keys = self.redis.scan(cursor, count=count)
+        return int(cursor), [key for key in keys if self.is_cart_key(key)]
+
+    @staticmethod
+    def cursor_order(cursor):
+        # SCAN goes through the buckets in the reverse binary order of their cursor
+        return int(bin(cursor)[2:].zfill(64)[::-1], 2)
+
+    #
+    # uid index
+    #
+    def index_get(self, uid):
+        sid = self.redis.get(self.uid_key(uid))
+        return int(sid) if sid is not None else None
+
+    def index_get_many(self, uids):
+        if not uids:
+            return []
+        return [int(sid) if sid is not None else None for sid in self.redis.mget([self.uid_key(uid) for uid in uids])]
+
+    def index_clear(self):
+        for keys in self.__scan_batches('uid:*', 500):
+            self.redis.delete(*keys)
+
+    def index_add_many(self, entries):
+        if not entries:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for uid, sid in entries:
+            pipe.set(self.uid_key(uid), sid, nx=True)
+        return [bool(created) for created in pipe.execute()]
+
+    #
+    # products
+    #
+    def get_product(self, sid, sku):
+        try:
+            data = self.redis.hget(sid, codec.product_field(sku))
+        except ResponseError as err:
+            self.__upgrade_or_raise(sid, err)
+            data = self.redis.hget(sid, codec.product_field(sku))
+        if data is None:
+            return None
+        return codec.unpack_product(data)
+
+    def add_products(self, sid, products, version=None, uid=None):
+        args = []
+        for product in products:
+            args.extend([product['sku'], codec.pack_product(product)])
+        return self.__run_script('add_products', sid, args, version, uid)
+
+    def update_product(self, sid, sku, product, version=None, uid=None):
+        try:
+            return self.__run_script('update_product', sid, [sku, product['sku'], codec.pack_product(product)], version, uid)
+        except ResponseError as err:
+            if str(err).startswith('NOPRODUCT'):
+                raise KeyError(sku)
+            raise
+
+    def remove_product(self, sid, sku, version=None, uid=None):
+        self.__run_script('remove_product', sid, [sku], version, uid)
+
+    def update_subtotal(self, sid, version=None, uid=None):
+        return self.__run_script('update_subtotal', sid, [], version, uid)
+
+    def __run_script(self, name, sid, args=[], version=None, uid=None):
+        script = self.scripts[name]
+        args = [int(time.time()), self.idle_ttl, self.empty_ttl, '' if version is None else version] + args
+        try:
+            try:
+                reply = script(keys=self.__script_keys(sid, uid), args=args)
+            except ResponseError as err:
+                if not str(err).startswith('LEGACY'):
+                    raise
+                self.__upgrade(sid)
+                reply = script(keys=self.__script_keys(sid, uid), args=args)
+        except ResponseError as err:
+            if str(err).startswith('VERSION'):
+                raise VersionConflict(str(err))
+            raise
+        if not isinstance(reply, list):
+            return reply
+        return codec.from_hash(sid, dict(zip(reply[::2], reply[1::2])))
+
+    def __script_keys(self, sid, uid=None):
+        # the cart and, when it has a uid, the uid key the scripts expire along with it,
+        # looked up only if the caller doesn't know the uid and carts expire at all
+        if uid is not None:
+            return [sid, self.uid_key(uid)]
+        if not self.idle_ttl and not self.empty_ttl:
+            return [sid]
+        try:
+            uid = self.redis.hget(sid, 'uid')
+        except ResponseError:  # legacy cart, the script asks for the upgrade
+            return [sid]
+        if uid is None or codec.unpack_value(uid) is None:
+            return [sid]
+        return [sid, self.uid_key(codec.unpack_value(uid))]
+
+    #
+    # maintenance and cache invalidation
+    #
+    def migrate(self, batch_size, pause):
+        """ Converts legacy string carts (pickle or binary) to hashes, one batch at a time
+
+        Each batch is WATCHed so a cart saved by the service in the meantime
+        is left alone, and the migration sleeps pause seconds between batches.
+        """
+        migrated = 0
+        for keys in self.__scan_batches('*', batch_size):
+            keys = [key for key in keys if self.is_cart_key(key)]
+            if not keys:
+                continue
+
+            def rewrite(pipe):
+                types = pipe.pipeline(transaction=False)
+                for key in keys:
+                    types.type(key)
+                legacy = [key for key, kind in zip(keys, types.execute()) if kind == 'string']
+                carts = pipe.mget(legacy) if legacy else []
+                pipe.multi()
+                for key, data in zip(legacy, carts):
+                    pipe.delete(key)
+                    pipe.hmset(key, codec.to_hash(codec.loads(data)))
+                return len(legacy)
+
+            migrated += self.redis.transaction(rewrite, *keys, value_from_callable=True)
+            if pause:
+                time.sleep(pause)
+        return migrated
+
+    def recompute_subtotals(self, compute, batch_size, dry_run=False):
+        # each batch is WATCHed and computed again if a cart changed meanwhile
+        for sids in self.scan_batches(batch_size):
+
+            def rewrite(pipe):
+                reads = pipe.pipeline(transaction=False)
+                for sid in sids:
+                    reads.hgetall(sid)
+                found = [(sid, fields) for sid, fields in zip(sids, reads.execute(raise_on_error=False))
+                         if fields and not isinstance(fields, ResponseError)]  # legacy carts get cents from migrate
+                changes = []
+                pipe.multi()
+                for (sid, fields), new in zip(found, compute([codec.from_hash(sid, fields) for sid, fields in found])):
+                    if 'cents' in fields:
+                        old = int(fields['cents'])
+                    else:
+                        old = codec.cents(float(fields['subtotal']))
+                    if old != new:
+                        changes.append((int(sid), old, new))
+                    if not dry_run and (old != new or 'cents' not in fields):
+                        pipe.hset(sid, 'cents', new)
+                        pipe.hdel(sid, 'subtotal')
+                        pipe.hincrby(sid, 'version', 1)
+                return len(found), changes
+
+            yield self.redis.transaction(rewrite, *sids, value_from_callable=True)
+
+    def reap(self, batch_size=500):
+        """ Catches up with the carts Redis doesn't expire by itself
+
+        Carts written before the ttls were set (or with a longer ttl) get
+        the ttl left since they were touched, or are deleted if it is over,
+        and uid keys of carts that no longer exist are deleted. The bytes
+        freed are measured with MEMORY USAGE before deleting.
+        """
+        stats = ReapStats()
+        now = int(time.time())
+        for sids in self.scan_batches(batch_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for sid in sids:
+                pipe.ttl(sid)
+                pipe.hmget(sid, 'touched', 'empty', 'uid')
+            replies = pipe.execute(raise_on_error=False)
+            expire = self.redis.pipeline(transaction=False)
+            for sid, ttl, fields in zip(sids, replies[::2], replies[1::2]):
+                if isinstance(fields, ResponseError) or fields[2] is None:
+                    continue  # legacy cart (see migrate) or gone since the scan
+                touched, empty, uid = fields
+                limit = self.empty_ttl if empty is not None else self.idle_ttl
+                if not limit:
+                    continue
+                left = limit - (now - int(touched)) if touched is not None else limit
+                # TTL and touched are in whole seconds, a reap in the next second
+                # must not count the ttl it set as one to shorten again
+                if ttl is not None and 0 <= ttl <= left + 1:
+                    continue
+                uid_key = self.uid_key(codec.unpack_value(uid))
+                if left > 0:
+                    expire.expire(sid, left)
+                    expire.expire(uid_key, left)
+                    stats.expiring += 1
+                    continue
+                freed = self.__reap_cart(sid, uid_key, touched)
+                if freed is not None:
+                    stats.carts += 1
+                    stats.placeholders += int(empty is not None)
+                    stats.bytes += freed
+            expire.execute()
+        for keys in self.__scan_batches('uid:*', batch_size):
+            owners = self.redis.mget(keys)
+            pipe = self.redis.pipeline(transaction=False)
+            for owner in owners:
+                pipe.exists(owner or 0)
+            for key, owner, exists in zip(keys, owners, pipe.execute()):
+                if owner is not None and not exists:
+                    freed = self.__reap_index(key, owner)
+                    if freed is not None:
+                        stats.index_entries += 1
+                        stats.bytes += freed
+        stats.elapsed = time.time() - stats.started
+        return stats
+
+    def __memory_usage(self, client, key):
+        try:
+            return client.execute_command('MEMORY', 'USAGE', key) or 0
+        except ResponseError:  # before Redis 4
+            return 0
+
+    def __reap_cart(self, sid, uid_key, touched):
+        # returns the bytes freed, None if the cart was changed in the meantime
+        def reap(pipe):
+            if pipe.hget(sid, 'touched') != touched:
+                return None
+            owned = (pipe.get(uid_key) == str(sid))
+            freed = self.__memory_usage(pipe, sid) + (self.__memory_usage(pipe, uid_key) if owned else 0)
+            pipe.multi()
+            pipe.delete(sid)
+            if owned:
+                pipe.delete(uid_key)
+            return freed
+        return self.redis.transaction(reap, sid, uid_key, value_from_callable=True)
+
+    def __reap_index(self, key, owner):
+        def reap(pipe):
+            if pipe.get(key) != owner or pipe.exists(owner):
+                return None
+            freed = self.__memory_usage(pipe, key)
+            pipe.multi()
+            pipe.delete(key)
+            return freed
+        return self.redis.transaction(reap, key, owner, value_from_callable=True)
+
+    def publish(self, sids):
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.publish(CHANNEL, sid)
+        pipe.execute()
+
+    def listen(self, cache, logger):
+        listener = InvalidationListener(self.redis, cache, logger)
+        listener.start()
+        return listener
+
+    #
+    # legacy carts
+    #
+    def __read(self, client, sid):
+        # works on the connection and on a WATCHing pipeline
+        kind = client.type(sid)
+        if kind == 'hash':
+            return codec.from_hash(sid, client.hgetall(sid))
+        if kind == 'string':
+            return codec.loads(client.get(sid))
+        return None
+
+    def __upgraded(self, sid, err):
+        # (cart, version) of a legacy cart, which starts at version 0 once converted
+        cart = self.__upgrade_or_raise(sid, err)
+        return (cart, 0) if cart is not None else None
+
+    def __check_version(self, client, sid, version):
+        # on a WATCHing pipeline, before multi()
+        if version is None:
+            return
+        kind = client.type(sid)
+        current = int(client.hget(sid, 'version') or 0) if kind == 'hash' else 0
+        if kind == 'none' or current != version:
+            raise VersionConflict('cart is not at version %d' % version)
+
+    def __upgrade_or_raise(self, sid, err):
+        if not str(err).startswith('WRONGTYPE'):
+            raise err
+        return self.__upgrade(sid)
+
+    def __upgrade(self, sid):
+        """ Converts a cart saved as a single string to the hash layout """
+        def upgrade(pipe):
+            cart = self.__read(pipe, sid)
+            if cart is not None and pipe.type(sid) == 'string':
+                pipe.multi()
+                pipe.delete(sid)
+                pipe.hmset(sid, codec.to_hash(cart))
+            return cart
+        return self.redis.transaction(upgrade, sid, value_from_callable=True)
+
+    def __scan_batches(self, match, batch_size):
+        batch = []
+        for key in self.redis.scan_iter(match=match, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,187 @@
+######################################################################
+# Server side cart mutations
+#   Each script works on one cart hash (see codec.py for its fields),
+#   runs atomically inside Redis and returns the updated cart with
+#   HGETALL, so a mutation is a single EVALSHA round trip. They return
+#   nil when the cart does not exist and the LEGACY error when the cart
+#   is still stored as a string and has to be converted first.
+#
+#   Every script takes the current time, the idle ttl and the ttl of
+#   placeholder carts as ARGV[1..3] and touches the cart with them (and
+#   the uid key of the cart, KEYS[2] when it has a uid, if it still
+#   points at the cart), and
+#   as ARGV[4] the version the cart must be at ('' for any), answering
+#   the VERSION error otherwise. Its own arguments follow. Touching the
+#   cart bumps its version. The cents field is moved by the difference
+#   of the lines changed, with the rounding of codec.line_cents.
+######################################################################
+
+# Shared prologue: check the type of the cart key, define the helpers
+CHECK_CART = """
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'none' then
+    return false
+end
+if kind ~= 'hash' then
+    return redis.error_reply('LEGACY cart is not a hash')
+end
+if ARGV[4] ~= '' and tonumber(redis.call('HGET', KEYS[1], 'version') or '0') ~= tonumber(ARGV[4]) then
+    return redis.error_reply('VERSION cart is not at version ' .. ARGV[4])
+end
+local function touch_cart()
+    redis.call('HSET', KEYS[1], 'touched', ARGV[1])
+    redis.call('HINCRBY', KEYS[1], 'version', 1)
+    redis.call('HDEL', KEYS[1], 'json')
+    local ttl = tonumber(ARGV[2])
+    if redis.call('HEXISTS', KEYS[1], 'empty') == 1 then
+        ttl = tonumber(ARGV[3])
+    end
+    -- the uid index entry of the cart expires along with it
+    local keys = { KEYS[1] }
+    if KEYS[2] and redis.call('GET', KEYS[2]) == KEYS[1] then
+        keys[2] = KEYS[2]
+    end
+    for _, key in ipairs(keys) do
+        if ttl > 0 then
+            redis.call('EXPIRE', key, ttl)
+        else
+            redis.call('PERSIST', key)
+        end
+    end
+end
+local function line_cents(packed)
+    if not packed then
+        return 0
+    end
+    local product = cmsgpack.unpack(packed)
+    local price, quantity = product[4], product[2]
+    if price == nil then
+        price, quantity = product['unitprice'], product['quantity']
+    end
+    if type(price) ~= 'number' or type(quantity) ~= 'number' then
+        return 0
+    end
+    return math.floor(math.floor(price * 100 + 0.5) * quantity + 0.5)
+end
+local function cart_cents()
+    local fields = redis.call('HGETALL', KEYS[1])
+    local total = 0
+    for i = 1, #fields, 2 do
+        if string.sub(fields[i], 1, 2) == 'p:' then
+            total = total + line_cents(fields[i + 1])
+        end
+    end
+    return total
+end
+local function set_cents(total)
+    redis.call('HSET', KEYS[1], 'cents', string.format('%d', total))
+    redis.call('HDEL', KEYS[1], 'subtotal')
+end
+-- call after the change: a cart written before cents starts from its products
+local function add_cents(delta)
+    if redis.call('HEXISTS', KEYS[1], 'cents') == 0 then
+        set_cents(cart_cents())
+    elseif delta ~= 0 then
+        redis.call('HINCRBY', KEYS[1], 'cents', string.format('%d', delta))
+    end
+end
+"""
+
+# KEYS[1] sid, ARGV[5..] sku1, product1, sku2, product2, ...
+ADD_PRODUCTS = CHECK_CART + """
+local delta = 0
+for i = 5, #ARGV, 2 do
+    local sku = ARGV[i]
+    local position = redis.call('HGET', KEYS[1], 'o:' .. sku)
+    if not position then
+        position = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+    end
+    delta = delta - line_cents(redis.call('HGET', KEYS[1], 'p:' .. sku)) + line_cents(ARGV[i + 1])
+    redis.call('HSET', KEYS[1], 'p:' .. sku, ARGV[i + 1])
+    redis.call('HSET', KEYS[1], 'o:' .. sku, position)
+end
+redis.call('HDEL', KEYS[1], 'empty')
+add_cents(delta)
+touch_cart()
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS[1] sid, ARGV[5] sku of the line to replace, ARGV[6] new sku, ARGV[7] new product
+UPDATE_PRODUCT = CHECK_CART + """
+local position = redis.call('HGET', KEYS[1], 'o:' .. ARGV[5])
+if not position then
+    return redis.error_reply('NOPRODUCT ' .. ARGV[5])
+end
+local delta = line_cents(ARGV[7]) - line_cents(redis.call('HGET', KEYS[1], 'p:' .. ARGV[5]))
+redis.call('HDEL', KEYS[1], 'p:' .. ARGV[5], 'o:' .. ARGV[5])
+-- a line that already had the new sku is replaced as well
+delta = delta - line_cents(redis.call('HGET', KEYS[1], 'p:' .. ARGV[6]))
+redis.call('HSET', KEYS[1], 'p:' .. ARGV[6], ARGV[7])
+redis.call('HSET', KEYS[1], 'o:' .. ARGV[6], position)
+add_cents(delta)
+touch_cart()
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS[1] sid, ARGV[5] sku
+REMOVE_PRODUCT = CHECK_CART + """
+local delta = -line_cents(redis.call('HGET', KEYS[1], 'p:' .. ARGV[5]))
+redis.call('HDEL', KEYS[1], 'p:' .. ARGV[5], 'o:' .. ARGV[5])
+add_cents(delta)
+touch_cart()
+return 1
+"""
+
+# KEYS[1] sid, recomputes the cents from every product
+UPDATE_SUBTOTAL = CHECK_CART + """
+set_cents(cart_cents())
+touch_cart()
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS[1] sid, ARGV[1] version to stay above, ARGV[2..] field1, value1, ...
+# Replaces every field of the cart, its version goes on from the one it had
+WRITE_CART = """
+local version = tonumber(ARGV[1])
+if redis.call('TYPE', KEYS[1])['ok'] == 'hash' then
+    version = math.max(version, tonumber(redis.call('HGET', KEYS[1], 'version') or '0'))
+end
+redis.call('DEL', KEYS[1])
+-- in chunks, unpack() is limited by the size of the Lua stack
+for i = 2, #ARGV, 1000 do
+    redis.call('HMSET', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('HSET', KEYS[1], 'version', version + 1)
+return version + 1
+"""
+
+# KEYS[1] sid, ARGV[1] version, ARGV[2] JSON of the products
+# Stores the JSON only if the cart is still at the version it was rendered from
+STORE_JSON = """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'hash' then
+    return 0
+end
+if tonumber(redis.call('HGET', KEYS[1], 'version') or '0') ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'json', ARGV[2])
+return 1
+"""
+
+SCRIPTS = {
+    'write_cart': WRITE_CART,
+    'store_json': STORE_JSON,
+    'add_products': ADD_PRODUCTS,
+    'update_product': UPDATE_PRODUCT,
+    'remove_product': REMOVE_PRODUCT,
+    'update_subtotal': UPDATE_SUBTOTAL
+}
+
+def register(redis):
+    """ Loads every script into Redis, returns them by name, called by their SHA """
+    scripts = {}
+    for name, source in SCRIPTS.items():
+        script = redis.register_script(source)
+        redis.script_load(source)
+        scripts[name] = script
+    return scripts
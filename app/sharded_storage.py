@@ -0,0 +1,328 @@
+import os
+import time
+import logging
+import bisect
+import hashlib
+from threading import RLock
+from multiprocessing.pool import ThreadPool
+from custom_exceptions import DataValidationError, ShardUnavailable
+from storage import Storage, ReapStats
+
+######################################################################
+# Carts spread over several storages (Redis nodes)
+#   Every sid is placed on a consistent hash ring where each node owns
+#   vnodes points, so adding a node only moves the carts that fall in
+#   its share of the ring. A cart and its uid index entry live on the
+#   same node, which keeps every single cart operation on one node and
+#   atomic there. The sid counter and the cache invalidations go through
+#   the first node. Operations that need every node (listing, uid
+#   lookups, flush) fan out to all of them in parallel.
+#
+#   The uid of a cart is only unique within a node atomically, a save
+#   checks the other nodes first so duplicates need two concurrent saves
+#   of the same uid on different nodes. rebalance() leaves such a cart
+#   on its old node, where its sid no longer finds it, and reports it.
+#
+#   A node that is not connected yet (its storage is None) fails only
+#   the operations that need it with ShardUnavailable.
+######################################################################
+
+logger = logging.getLogger(__name__)
+
+class ShardedStorage(Storage):
+
+    def __init__(self, nodes, vnodes=None):
+        """ nodes is a list of (name, storage), the ring is built from the names """
+        self.vnodes = vnodes or int(os.getenv('SHOPCART_SHARD_VNODES', '128'))
+        self.names = []
+        self.nodes = {}
+        self.ring = []
+        self._lock = RLock()
+        self._pool = None
+        for name, storage in nodes:
+            self.names.append(name)
+            self.nodes[name] = storage
+        self.__build_ring()
+
+    #
+    # ring
+    #
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+    def __build_ring(self):
+        self.ring = sorted((self.hash('%s#%d' % (name, i)), name) for name in self.names for i in range(self.vnodes))
+        self._points = [point for point, name in self.ring]
+
+    def node_name(self, sid):
+        """ Returns the name of the node that owns sid """
+        i = bisect.bisect(self._points, self.hash(int(sid))) % len(self.ring)
+        return self.ring[i][1]
+
+    def node(self, sid):
+        return self.named(self.node_name(sid))
+
+    def named(self, name):
+        """ Returns the storage of a node, raises ShardUnavailable if it is not connected """
+        storage = self.nodes[name]
+        if storage is None:
+            raise ShardUnavailable(u'The shard %s is not available' % name)
+        return storage
+
+    def set_node(self, name, storage):
+        """ Replaces the storage of a node, after a reconnect """
+        self.nodes[name] = storage
+
+    def add_node(self, name, storage):
+        """ Adds a node to the ring and moves the carts it now owns there, see rebalance """
+        with self._lock:
+            self.names.append(name)
+            self.nodes[name] = storage
+            self.__build_ring()
+            self._pool = None
+        return self.rebalance()
+
+    def rebalance(self, batch_size=500):
+        """ Moves every cart that is not on the node the ring gives it
+
+        A cart is written to its new node before it is deleted from the old
+        one, so it can be seen twice by a listing but is never missing. Its
+        version goes on from the one it had on the old node and it keeps
+        its ttl. A cart whose uid has another cart is left where it was.
+        Returns how many carts were moved and the sids of the ones left.
+        """
+        moved = 0
+        conflicts = []
+        for name in list(self.names):
+            source = self.named(name)
+            for sids in source.scan_batches(batch_size):
+                for found in source.get_many_versioned([sid for sid in sids if self.node_name(sid) != name]):
+                    if found is None:
+                        continue
+                    cart, version = found
+                    try:
+                        self.put(cart, version, source.touched(cart['sid']))
+                    except DataValidationError:
+                        logger.warning('Shopping Cart %s not moved from %s, its uid %s has another cart' % (cart['sid'], name, cart['uid']))
+                        conflicts.append(cart['sid'])
+                        continue
+                    source.delete(cart['sid'], cart['uid'])
+                    moved += 1
+        return moved, conflicts
+
+    def _map(self, function, items):
+        # one thread per node, fans the calls out and returns the results in order
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self.names))
+            pool = self._pool
+        return pool.map(function, items)
+
+    def _group(self, sids):
+        groups = {}
+        for i, sid in enumerate(sids):
+            groups.setdefault(self.node_name(sid), []).append(i)
+        return groups.items()
+
+    @property
+    def first(self):
+        return self.named(self.names[0])
+
+    #
+    # sids
+    #
+    def next_ids(self, count=1):
+        return self.first.next_ids(count)
+
+    def reserve_id(self, sid):
+        self.first.reserve_id(sid)
+
+    #
+    # carts
+    #
+    def get_versioned(self, sid):
+        return self.node(sid).get_versioned(sid)
+
+    def get_many_versioned(self, sids):
+        carts = [None] * len(sids)
+
+        def fetch(group):
+            name, positions = group
+            return positions, self.named(name).get_many_versioned([sids[i] for i in positions])
+
+        for positions, found in self._map(fetch, self._group(sids)):
+            for i, cart in zip(positions, found):
+                carts[i] = cart
+        return carts
+
+    def get_json(self, sid):
+        return self.node(sid).get_json(sid)
+
+    def version(self, sid):
+        return self.node(sid).version(sid)
+
+    def exists(self, sid):
+        return self.node(sid).exists(sid)
+
+    def touched(self, sid):
+        return self.node(sid).touched(sid)
+
+    def put(self, cart, min_version=0, touched=None):
+        owner = self.index_get(cart['uid'])
+        if owner is not None and owner != cart['sid']:
+            raise DataValidationError(u'Shopping Cart for uid %s already exists' % cart['uid'])
+        self.node(cart['sid']).put(cart, min_version, touched)
+
+    def put_many(self, carts):
+        owners = self.index_get_many([cart['uid'] for cart in carts])
+        rejected = []
+        claimed = {}
+        accepted = []
+        for i, (cart, owner) in enumerate(zip(carts, owners)):
+            uid = self.uid_name(cart['uid'])
+            owner = owner if owner is not None else claimed.get(uid, cart['sid'])
+            if owner != cart['sid']:
+                rejected.append(i)
+                continue
+            claimed[uid] = cart['sid']
+            accepted.append(i)
+
+        def write(group):
+            name, positions = group
+            return [positions[i] for i in self.named(name).put_many([carts[accepted[p]] for p in positions])]
+
+        groups = self._group([carts[i]['sid'] for i in accepted])
+        for node_rejected in self._map(write, groups):
+            rejected.extend(accepted[p] for p in node_rejected)
+        return sorted(rejected)
+
+    def modify(self, sid, change, version=None):
+        return self.node(sid).modify(sid, change, version)
+
+    def delete(self, sid, uid, version=None):
+        self.node(sid).delete(sid, uid, version)
+
+    def flush(self):
+        self._map(lambda name: self.named(name).flush(), self.names)
+
+    def scan(self, cursor, count):
+        # one node after the other, the cursor is node cursor * node count + node
+        node, node_cursor = cursor % len(self.names), cursor // len(self.names)
+        node_cursor, sids = self.named(self.names[node]).scan(node_cursor, count)
+        if node_cursor == 0:
+            node += 1
+            if node == len(self.names):
+                return 0, sids
+        return node_cursor * len(self.names) + node, sids
+
+    def scan_until(self, cursor, end):
+        # a scan batch comes from a single node, end is on it or the start of the next node
+        node, node_cursor = cursor % len(self.names), cursor // len(self.names)
+        node_end = end // len(self.names) if end % len(self.names) == node else 0
+        return self.named(self.names[node]).scan_until(node_cursor, node_end)
+
+    def scan_batches(self, batch_size):
+        # every node is scanned at once, a batch merges one scan of each
+        cursors = dict((name, 0) for name in self.names)
+        while cursors:
+            results = self._map(lambda name: (name, self.named(name).scan(cursors[name], batch_size)), list(cursors))
+            batch = []
+            for name, (cursor, sids) in results:
+                batch.extend(sids)
+                if cursor == 0:
+                    del cursors[name]
+                else:
+                    cursors[name] = cursor
+            if batch:
+                yield batch
+
+    #
+    # uid index
+    #
+    def index_get(self, uid):
+        for sid in self._map(lambda name: self.named(name).index_get(uid), self.names):
+            if sid is not None:
+                return sid
+        return None
+
+    def index_get_many(self, uids):
+        sids = [None] * len(uids)
+        for found in self._map(lambda name: self.named(name).index_get_many(uids), self.names):
+            for i, sid in enumerate(found):
+                if sids[i] is None:
+                    sids[i] = sid
+        return sids
+
+    def index_clear(self):
+        self._map(lambda name: self.named(name).index_clear(), self.names)
+
+    def index_add_many(self, entries):
+        # a uid already indexed on any node, or earlier in entries, is a duplicate
+        indexed = self.index_get_many([uid for uid, sid in entries])
+        added = [False] * len(entries)
+        claimed = set()
+        fresh = []
+        for i, ((uid, sid), owner) in enumerate(zip(entries, indexed)):
+            if owner is None and self.uid_name(uid) not in claimed:
+                claimed.add(self.uid_name(uid))
+                fresh.append(i)
+
+        def write(group):
+            name, positions = group
+            return positions, self.named(name).index_add_many([entries[fresh[p]] for p in positions])
+
+        for positions, created in self._map(write, self._group([entries[i][1] for i in fresh])):
+            for p, was_added in zip(positions, created):
+                added[fresh[p]] = was_added
+        return added
+
+    #
+    # products
+    #
+    def get_product(self, sid, sku):
+        return self.node(sid).get_product(sid, sku)
+
+    def add_products(self, sid, products, version=None, uid=None):
+        return self.node(sid).add_products(sid, products, version, uid)
+
+    def update_product(self, sid, sku, product, version=None, uid=None):
+        return self.node(sid).update_product(sid, sku, product, version, uid)
+
+    def remove_product(self, sid, sku, version=None, uid=None):
+        self.node(sid).remove_product(sid, sku, version, uid)
+
+    def update_subtotal(self, sid, version=None, uid=None):
+        return self.node(sid).update_subtotal(sid, version, uid)
+
+    #
+    # maintenance and cache invalidation
+    #
+    def migrate(self, batch_size, pause):
+        return sum(self._map(lambda name: self.named(name).migrate(batch_size, pause), self.names))
+
+    def recompute_subtotals(self, compute, batch_size, dry_run=False):
+        # the nodes work in parallel, their batches come out once they are all done
+        for batches in self._map(lambda name: list(self.named(name).recompute_subtotals(compute, batch_size, dry_run)), self.names):
+            for batch in batches:
+                yield batch
+
+    def reap(self, batch_size=500):
+        stats = ReapStats()
+        for node_stats in self._map(lambda name: self.named(name).reap(batch_size), self.names):
+            stats.add(node_stats)
+        stats.elapsed = time.time() - stats.started
+        return stats
+
+    def publish(self, sids):
+        # without the first node the listeners have lost it too and cleared their caches
+        if self.nodes[self.names[0]] is not None:
+            self.first.publish(sids)
+
+    def listen(self, cache, logger):
+        # started again once the first node is connected, see initialize_shards
+        if self.nodes[self.names[0]] is None:
+            return None
+        return self.first.listen(cache, logger)
@@ -15,17 +15,29 @@
 import urllib
 import os
 import logging
-from redis import Redis
-from redis.exceptions import ConnectionError
-from threading import Lock
-from flask import Flask, Response, jsonify, request, make_response, json, url_for
-from flasgger import Swagger
+from collections import OrderedDict
+from flask import Flask, Response, request, make_response, json, url_for, stream_with_context
 from models import Shopcart
+from connection import RedisManager
+from memory_storage import MemoryStorage
+from redis_storage import RedisStorage
+from sharded_storage import ShardedStorage
+from cache import CartCache
+from reaper import CartReaper
+from custom_exceptions import DataValidationError, VersionConflict
+import export
+import recompute
+import operations
+import codec
+from media import jsonify, get_payload, wants_json
 from . import app
 import error_handlers
+import compression
 
 # Create Flask application
 app.config['LOGGING_LEVEL'] = logging.INFO
+# compact JSON, the same bytes as the JSON a storage keeps (codec.render)
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
 # Swagger set up
 # Configure Swagger before initilaizing it
@@ -42,28 +54,30 @@ app.config['SWAGGER'] = {
     ]
 }
 
-# Initialize Swagger after configuring it
-Swagger(app)
+# Register the API docs after configuring them, flasgger is imported on first use
+import apidocs
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
+HTTP_412_PRECONDITION_FAILED = 412
 
-redis = None
-
-# Lock for thread-safe counter increment
-lock = Lock()
-
-######################################################################
-# Data Store, pre-populated with sample data
-######################################################################
-shopping_carts = []
+# Paging of GET /shopcarts
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 1000
+CART_FIELDS = ('uid', 'sid', 'subtotal', 'products')
+PRODUCT_FIELDS = ('sku', 'quantity', 'name', 'unitprice')
 
-current_shopping_cart_id = 3
+redis = None
+redis_manager = None
+shard_managers = []
+cart_reaper = None
 
 ######################################################################
 # GET INDEX
@@ -98,6 +112,26 @@ def list_shopcarts():
         description: the uid of Shopcart you are looking for
         required: false
         type: string
+      - name: sid
+        in: query
+        description: comma separated sids of the Shopcarts you are looking for, answered with the found Shopcarts and the missing sids
+        required: false
+        type: string
+      - name: limit
+        in: query
+        description: maximum number of Shopcarts per page, the next page is linked in the Link header
+        required: false
+        type: integer
+      - name: cursor
+        in: query
+        description: opaque cursor of the page to return, taken from a previous Link header
+        required: false
+        type: string
+      - name: fields
+        in: query
+        description: comma separated fields to return (uid, sid, subtotal, products, or products.sku and the like for some fields of the products)
+        required: false
+        type: string
     responses:
       200:
         description: An array of Shopcarts
@@ -138,6 +172,7 @@ def list_shopcarts():
 
     '''
     results=[]
+    fields=cart_fields()
     uid=request.args.get('uid')
     if uid:
         #Extra check for query input
@@ -149,17 +184,302 @@ def list_shopcarts():
 
         results=Shopcart.find_by_uid(uid)
         if len(results)!=0:
-            results=results[0]
+            results=project_cart(results[0], fields)
             rc=HTTP_200_OK
         else:
             results={ 'error' : 'Shopping Cart under user id: %s was not found' % str(uid) }
             rc=HTTP_404_NOT_FOUND
+    elif 'sid' in request.args:
+        return lookup_shopcarts(request.args.get('sid').split(','))
+    elif 'limit' in request.args or 'cursor' in request.args:
+        return list_shopcarts_page(request.args.get('limit', DEFAULT_PAGE_SIZE), request.args.get('cursor'))
     else:
-        results=Shopcart.all()
+        results=[project_cart(cart, fields) for cart in Shopcart.all()]
         rc=HTTP_200_OK
 
     return make_response(jsonify(results), rc)
 
+def list_shopcarts_page(limit, cursor):
+    try:
+        limit = int(limit)
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError
+        results, next_cursor = Shopcart.page(cursor, limit)
+    except (ValueError, DataValidationError):
+        message={ 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+
+    fields = cart_fields()
+    response = make_response(jsonify([project_cart(cart, fields) for cart in results]), HTTP_200_OK)
+    if next_cursor:
+        next_url = url_for('list_shopcarts', limit=limit, cursor=next_cursor, _external=True)
+        response.headers['Link'] = '<%s>; rel="next"' % next_url
+    return response
+
+def lookup_shopcarts(sids):
+    try:
+        sids = [int(sid) for sid in sids]
+        if not sids or len(sids) > MAX_PAGE_SIZE:
+            raise ValueError
+    except (ValueError, TypeError):
+        message={ 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+
+    sids = OrderedDict.fromkeys(sids).keys()
+    fields = cart_fields()
+    carts = Shopcart.find_many(sids)
+    message = {
+        'shopcarts': [project_cart(cart, fields) for cart in carts if cart is not None],
+        'missing': [sid for sid, cart in zip(sids, carts) if cart is None]
+    }
+    return make_response(jsonify(message), HTTP_200_OK)
+
+######################################################################
+# RETRIEVE MANY SHOPCARTS BY SID
+######################################################################
+# USAGE: /shopcarts/lookup with {"sids": [1, 2, 3]}
+@app.route('/shopcarts/lookup', methods=['POST'])
+def lookup_shopcarts_body():
+
+    """
+    Retrieve many Shopcarts
+    This endpoint returns the Shopcarts of the posted sids at once, like GET /shopcarts?sid=1,2,3 for lists too long for a url
+    ---
+    tags:
+      - Shopcarts
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          required:
+            - sids
+          properties:
+            sids:
+              type: array
+              items:
+                type: integer
+              description: sids of the Shopcarts (up to 1000)
+    responses:
+      200:
+        description: The Shopcarts found, in the order of the sids, and the sids of the missing ones
+        schema:
+          properties:
+            shopcarts:
+              type: array
+              items:
+                schema:
+                  id: Shopcart
+            missing:
+              type: array
+              items:
+                type: integer
+      400:
+        description: Bad Request (no sids, more than 1000 or not integers)
+    """
+
+    payload = get_payload()
+    if not isinstance(payload, dict) or not isinstance(payload.get('sids'), list):
+        message={ 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+    return lookup_shopcarts(payload['sids'])
+
+######################################################################
+# EXPORT ALL SHOPCARTS
+######################################################################
+# USAGE: /shopcarts/export or /shopcarts/export?format=csv
+@app.route('/shopcarts/export', methods=['GET'])
+def export_shopcarts():
+
+    """
+    Export all shopcarts
+    This endpoint streams every Shopcart as newline delimited JSON or as CSV with one row per product
+    ---
+    tags:
+      - Shopcarts
+    produces:
+      - application/x-ndjson
+      - text/csv
+    parameters:
+      - name: format
+        in: query
+        description: ndjson (default) or csv, the csv columns are the same as sampleShopcarts.csv
+        required: false
+        type: string
+    responses:
+      200:
+        description: The exported Shopcarts
+      400:
+        description: Unknown export format
+    """
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        message={ 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+
+    body = export.export(Shopcart.iterate(), fmt)
+    response = Response(stream_with_context(body), mimetype=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=shopcarts.%s' % fmt
+    return response
+
+######################################################################
+# RECOMPUTE THE SUBTOTAL OF EVERY SHOPCART
+######################################################################
+# USAGE: /shopcarts/subtotals or /shopcarts/subtotals?dry_run=true
+@app.route('/shopcarts/subtotals', methods=['POST'])
+def recompute_subtotals():
+
+    """
+    Recompute every subtotal
+    This endpoint recomputes the subtotal of every Shopcart from its products, after price corrections
+    ---
+    tags:
+      - Shopcarts
+    produces:
+      - application/json
+    parameters:
+      - name: dry_run
+        in: query
+        description: true to only report the shopcarts whose subtotal would change
+        required: false
+        type: boolean
+      - name: batch_size
+        in: query
+        description: shopcarts computed and written at a time (500)
+        required: false
+        type: integer
+    responses:
+      200:
+        description: The number of shopcarts checked, the changed ones and the throughput
+      400:
+        description: Invalid batch size
+    """
+
+    dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+    try:
+        batch_size = int(request.args.get('batch_size', 500))
+    except ValueError:
+        batch_size = 0
+    if batch_size < 1:
+        message={ 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+
+    stats = recompute.recompute_subtotals(batch_size, dry_run)
+    message = stats.to_dict()
+    message['changed_carts'] = [{ 'sid': sid, 'subtotal': old, 'recomputed': new } for sid, old, new in stats.changed]
+    return make_response(jsonify(message), HTTP_200_OK)
+
+######################################################################
+# CONDITIONAL REQUESTS
+#   The ETag of a shopcart is its version, bumped by every change. A
+#   GET with If-None-Match reads only the version to answer 304, and
+#   the changes given If-Match only apply to the version it names.
+#   Compressed responses carry the coding in their ETag (see
+#   compression.py), which names the same version.
+######################################################################
+def etag(version):
+    return str(version)
+
+def none_match_tags(version):
+    """ Returns the ETags of If-None-Match that name version, whatever their coding """
+    return [tag for tag in request.if_none_match.as_set(include_weak=True) if compression.strip_coding(tag) == etag(version)]
+
+def unmodified_version(sid):
+    """ Returns the version of the cart sid if If-None-Match names it, None otherwise """
+    if not request.if_none_match:
+        return None
+    version = Shopcart.version(sid)
+    if version is None or not (request.if_none_match.star_tag or none_match_tags(version)):
+        return None
+    return version
+
+def not_modified(version):
+    response = make_response('', HTTP_304_NOT_MODIFIED)
+    # the ETag of the copy the client has
+    tags = none_match_tags(version)
+    response.set_etag(tags[0] if tags else etag(version))
+    if tags and tags[0] != etag(version):
+        response.vary.add('Accept-Encoding')
+    return response
+
+def versioned_response(message, version):
+    response = make_response(jsonify(message), HTTP_200_OK)
+    response.set_etag(etag(version))
+    return response
+
+def json_response(body, version):
+    """ Answers with JSON already rendered by codec.render, as jsonify would """
+    response = app.response_class((body, '\n'), mimetype=app.config['JSONIFY_MIMETYPE'])
+    response.set_etag(etag(version))
+    return response
+
+def if_match_version():
+    """ Returns the version If-Match asks for, None without one (or *), -1 if no version can match it """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    tags = request.if_match.as_set()  # If-Match compares strong ETags only
+    if len(tags) != 1:
+        return -1
+    tag = compression.strip_coding(list(tags)[0])
+    if not tag.isdigit():
+        return -1
+    return int(tag)
+
+######################################################################
+# SPARSE FIELDSETS
+#   fields= keeps only the named fields of the carts (or products) in a
+#   response, before it is serialized: fields=subtotal,products.sku
+#   answers with the subtotal and the sku of every product.
+######################################################################
+def cart_fields():
+    """ Returns what fields= keeps of a cart as {field: product fields, None for whole products}, None for all """
+    names = request.args.get('fields')
+    if names is None:
+        return None
+    fields = {}
+    for name in names.split(','):
+        field, _, sub = name.strip().partition('.')
+        if field not in CART_FIELDS or (sub and (field != 'products' or sub not in PRODUCT_FIELDS)):
+            raise DataValidationError('Unknown field: %s' % name)
+        if not sub:
+            fields[field] = None
+        elif field not in fields:
+            fields[field] = [sub]
+        elif fields[field] is not None:
+            fields[field].append(sub)
+    return fields
+
+def product_fields():
+    """ Returns the product fields fields= keeps, None for all """
+    names = request.args.get('fields')
+    if names is None:
+        return None
+    fields = [name.strip() for name in names.split(',')]
+    for name in fields:
+        if name not in PRODUCT_FIELDS:
+            raise DataValidationError('Unknown field: %s' % name)
+    return fields
+
+def project_product(product, fields):
+    if fields is None or not isinstance(product, dict):
+        return product
+    return dict((field, product[field]) for field in fields)
+
+def project_cart(cart, fields):
+    if fields is None:
+        return cart
+    projected = {}
+    for field, sub in fields.items():
+        projected[field] = cart[field]
+        if field == 'products' and sub is not None:
+            projected[field] = [project_product(product, sub) for product in cart[field]]
+    return projected
+
 ######################################################################
 # RETRIEVE A USER'S CART
 ######################################################################
@@ -176,11 +496,21 @@ def get_shopcart(sid):
     produces:
       - application/json
     parameters:
+      - name: If-None-Match
+        in: header
+        description: ETag of the copy the client has, answered with 304 Not Modified while the Shopcart is still at that version
+        required: false
+        type: string
       - name: sid
         in: path
         description: sid of the shopcart to retrieve
         type: integer
         required: true
+      - name: fields
+        in: query
+        description: comma separated fields to return (uid, sid, subtotal, products, or products.sku and the like for some fields of the products)
+        required: false
+        type: string
     responses:
       200:
         description: Shopcart returned
@@ -218,18 +548,26 @@ def get_shopcart(sid):
 
       404:
         description: Shopcart not found
+      304:
+        description: Not Modified (the Shopcart is still at the version of If-None-Match)
     """
 
 
-    cart = Shopcart.find(sid)
-    if cart:
-        message = cart
-        rc = HTTP_200_OK
+    version = unmodified_version(sid)
+    if version is not None:
+        return not_modified(version)
+    fields = cart_fields()
+    if fields is None and wants_json():
+        found = Shopcart.find_json(sid)
+        if found:
+            cart_json, products_json, version = found
+            return json_response(cart_json, version)
     else:
-        message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
-        rc = HTTP_404_NOT_FOUND
-
-    return make_response(jsonify(message), rc)
+        cart, version = Shopcart.find_versioned(sid) or (None, None)
+        if cart:
+            return versioned_response(project_cart(cart, fields), version)
+    message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
+    return make_response(jsonify(message), HTTP_404_NOT_FOUND)
 
 ######################################################################
 # RETRIEVE USER'S PRODUCTS LIST IN THE CART
@@ -246,6 +584,11 @@ def get_products(sid):
       - Shopcarts
     description: The Products endpoint allows you to query products
     parameters:
+      - name: If-None-Match
+        in: header
+        description: ETag of the copy the client has, answered with 304 Not Modified while the Shopcart is still at that version
+        required: false
+        type: string
       - name: sid
         in: path
         description: the sid of the shopcart you are looking for
@@ -256,6 +599,11 @@ def get_products(sid):
         description: the name of the product you are looking for
         required: false
         type: string
+      - name: fields
+        in: query
+        description: comma separated fields of the products to return (sku, quantity, name, unitprice)
+        required: false
+        type: string
     responses:
       200:
         description: An array of Products
@@ -277,10 +625,21 @@ def get_products(sid):
                 unitprice:
                    type: number
                    description: price of the particular product
+      304:
+        description: Not Modified (the Shopcart is still at the version of If-None-Match)
     """
 
-    cart = Shopcart.find(sid)
+    version = unmodified_version(sid)
+    if version is not None:
+        return not_modified(version)
     name = request.args.get('name')
+    fields = product_fields()
+    if not name and fields is None and wants_json():
+        found = Shopcart.find_json(sid)
+        if found and found[1] != '[]':
+            cart_json, products_json, version = found
+            return json_response(products_json, version)
+    cart, version = Shopcart.find_versioned(sid) or (None, None)
     if cart:
         products = cart['products']
         if(len(products)==0):
@@ -300,15 +659,17 @@ def get_products(sid):
                     message={ 'error' : 'Product with name: %s was not found' % urllib.unquote(name) }
                     rc=HTTP_404_NOT_FOUND
                 else:
-                    message=message[0]
+                    message=project_product(message[0], fields)
                     rc = HTTP_200_OK
             else:
-                message=products
+                message=[project_product(product, fields) for product in products]
                 rc = HTTP_200_OK
     else:
         message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
         rc = HTTP_404_NOT_FOUND
 
+    if rc == HTTP_200_OK:
+        return versioned_response(message, version)
     return make_response(jsonify(message), rc)
 
 ######################################################################
@@ -361,17 +722,15 @@ def get_product(sid,sku):
     """
 
 
-    cart = Shopcart.find(sid)
-    if not cart:
+    product = Shopcart.get_product(sid, sku)
+    if product:
+        return make_response(jsonify(product), HTTP_200_OK)
+    elif not Shopcart.exists(sid):
         message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
         return make_response(jsonify(message),HTTP_404_NOT_FOUND)
     else:
-        products=[product for product in cart['products'] if product['sku']==sku]
-        if(len(products)==0):
-            message = { 'error' : 'Product with sku: %s was not found in the cart for user %s' % (str(sku), str(sid))}
-            return make_response(jsonify(message),HTTP_404_NOT_FOUND)
-        else:
-            return make_response(jsonify(products[0]), HTTP_200_OK)
+        message = { 'error' : 'Product with sku: %s was not found in the cart for user %s' % (str(sku), str(sid))}
+        return make_response(jsonify(message),HTTP_404_NOT_FOUND)
 
 
 ######################################################################
@@ -465,7 +824,7 @@ def create_shopcarts():
         description: Bad Request (the posted data was not valid)
     """
 
-    payload = request.get_json()
+    payload = get_payload()
     if Shopcart.validate_shopcart(payload):
         valid_product = False
         shopping_cart_exists = False
@@ -473,7 +832,7 @@ def create_shopcarts():
         shopcart_found = Shopcart.find_by_uid(payload['uid'])
 
         if len(shopcart_found) > 0:
-            message = { 'error' : 'Shopping Cart for uid %s already exists' %str(payload['uid']) }
+            message = { 'error' : u'Shopping Cart for uid %s already exists' % payload['uid'] }
             rc = HTTP_400_BAD_REQUEST
             shopping_cart_exists = True
 
@@ -494,10 +853,15 @@ def create_shopcarts():
             if valid_product == True:
                 shopcart = Shopcart()
                 shopcart.deserialize(payload)
-                shopcart.save()
-                message = shopcart.serialize()
-                headerLocation = shopcart.self_url("shopcart")
-                rc = HTTP_201_CREATED
+                try:
+                    shopcart.save()
+                    message = shopcart.serialize()
+                    headerLocation = shopcart.self_url("shopcart")
+                    rc = HTTP_201_CREATED
+                except DataValidationError:
+                    # another request claimed this uid since we checked
+                    message = { 'error' : u'Shopping Cart for uid %s already exists' % payload['uid'] }
+                    rc = HTTP_400_BAD_REQUEST
     else:
         message = { 'error' : 'Data is not valid' }
         rc = HTTP_400_BAD_REQUEST
@@ -508,6 +872,101 @@ def create_shopcarts():
         response.headers['Location'] = headerLocation
     return response
 
+######################################################################
+# ADD MANY NEW SHOPPING CARTS AT ONCE
+######################################################################
+@app.route('/shopcarts/batch', methods=['POST'])
+def create_shopcarts_batch():
+
+    """
+    Creates many Shopcarts
+    This endpoint creates every Shopcart of the posted array at once, with the same rules as POST /shopcarts, and reports each one
+    ---
+    tags:
+      - Shopcarts
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: data
+    responses:
+      200:
+        description: The status of every posted shopcart (created, duplicate uid or invalid) in the order they were posted
+        schema:
+          properties:
+            created:
+              type: integer
+              description: number of shopcarts created
+            results:
+              type: array
+              items:
+                schema:
+                  properties:
+                    index:
+                      type: integer
+                      description: position of the shopcart in the posted array
+                    status:
+                      type: string
+                      description: created, duplicate uid or invalid
+                    sid:
+                      type: integer
+                      description: sid of the created shopcart
+                    location:
+                      type: string
+                      description: url of the created shopcart
+                    error:
+                      type: string
+                      description: why the shopcart wasn't created
+      400:
+        description: Bad Request (the posted data was not an array, or an array longer than 1000)
+    """
+
+    payloads = get_payload()
+    if not isinstance(payloads, list) or len(payloads) > MAX_BATCH_SIZE:
+        message = { 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+
+    results = []
+    shopcarts = []
+    for i, payload in enumerate(payloads):
+        if not isinstance(payload, dict) or not Shopcart.validate_shopcart(payload) or \
+           ('products' in payload and not Shopcart.validate_product(payload)):
+            results.append({ 'index': i, 'status': 'invalid', 'error': 'Data is not valid' })
+            continue
+        payload.pop('sid', None)  # sids are allocated here
+        payload.setdefault('products', [[]])
+        payload.setdefault('subtotal', 0.0)
+        shopcart = Shopcart().deserialize(payload)
+        results.append({ 'index': i, 'shopcart': shopcart })
+        shopcarts.append(shopcart)
+
+    # one sid allocation and one transaction for the whole batch
+    rejected = set(id(shopcart) for shopcart in Shopcart.save_many(shopcarts))
+    created = 0
+    for result in results:
+        shopcart = result.pop('shopcart', None)
+        if shopcart is None:
+            continue
+        if id(shopcart) in rejected:
+            result['status'] = 'duplicate uid'
+            result['error'] = u'Shopping Cart for uid %s already exists' % shopcart.uid
+        else:
+            result['status'] = 'created'
+            result['sid'] = shopcart.sid
+            result['location'] = shopcart.self_url("shopcart")
+            created += 1
+
+    message = { 'created': created, 'results': results }
+    return make_response(jsonify(message), HTTP_200_OK)
+
 ######################################################################
 # ADD A NEW PRODUCT IN A SHOPPING CART
 ######################################################################
@@ -525,6 +984,11 @@ def create_products(sid):
     produces:
       - application/json
     parameters:
+      - name: If-Match
+        in: header
+        description: ETag the Shopcart must still have, answered with 412 Precondition Failed if it changed since
+        required: false
+        type: string
       - name: sid
         in: path
         description: the sid of the shopcart to which you want to add products
@@ -584,28 +1048,27 @@ def create_products(sid):
                             description: price of the particular product
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: Precondition Failed (the Shopcart is not at the version of If-Match)
     """
 
-    existing_shopcart = Shopcart.check_shopcart_exists(sid)
-
-    if existing_shopcart:
-        payload = request.get_json()
-        if Shopcart.validate_product(payload):
-            existing_shopcart.deserialize_products(payload['products'])
-            existing_shopcart.save()
-            message = existing_shopcart.serialize()
-            headerLocation = existing_shopcart.self_url("product")
+    payload = get_payload()
+    if Shopcart.validate_product(payload):
+        cart = Shopcart.add_products(sid, payload['products'], if_match_version())
+        if cart:
+            message = cart
             rc = HTTP_201_CREATED
         else:
-            message = { 'error' : 'Data is not valid' }
-            rc = HTTP_400_BAD_REQUEST
-
-        response = make_response(jsonify(message), rc)
-        return response
+            message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
+            rc = HTTP_404_NOT_FOUND
+    elif Shopcart.exists(sid):
+        message = { 'error' : 'Data is not valid' }
+        rc = HTTP_400_BAD_REQUEST
     else:
         message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
         rc = HTTP_404_NOT_FOUND
-        return make_response(jsonify(message), rc)
+
+    return make_response(jsonify(message), rc)
 
 ######################################################################
 # UPDATE product in a shopping cart
@@ -624,6 +1087,11 @@ def put_product(sid, sku):
     produces:
       - application/json
     parameters:
+      - name: If-Match
+        in: header
+        description: ETag the Shopcart must still have, answered with 412 Precondition Failed if it changed since
+        required: false
+        type: string
       - name: sid
         in: path
         description: the sid of the shopcart whose product you want to update
@@ -677,43 +1145,33 @@ def put_product(sid, sku):
                 description: price of the particular product
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: Precondition Failed (the Shopcart is not at the version of If-Match)
     """
 
-    cart = Shopcart.find(sid)
-    if cart:
-        payload = request.get_json()
-        products = payload['products']
-        if Shopcart.validate_product(payload) and len(products) == 1:
-            updated_product = {'sku': products[0]['sku'], 'quantity': products[0]['quantity'], 'name': products[0]['name'], 'unitprice': products[0]['unitprice']}
-
-            found_product = False
-            for i in range(len(cart['products'])):
-                product = cart['products'][i]
-                if product['sku'] == sku:
-                    cart['products'][i] = updated_product
-                    found_product = True
-                    break
-                
-            if found_product:
-                s = Shopcart()
-                s.deserialize(cart).save()
+    payload = get_payload()
+    if Shopcart.validate_product(payload) and len(payload['products']) == 1:
+        product = payload['products'][0]
+        updated_product = {'sku': product['sku'], 'quantity': product['quantity'], 'name': product['name'], 'unitprice': product['unitprice']}
+        try:
+            cart = Shopcart.update_product(sid, sku, updated_product, if_match_version())
+            if cart:
                 message = cart
                 rc = HTTP_200_OK
             else:
-                message = { 'error' : 'Product %s was not found in shopping cart %s' % (str(sku), str(sid)) }
+                message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
                 rc = HTTP_404_NOT_FOUND
-        else:
-            message = { 'error' : 'Product data is not valid' }
-            rc = HTTP_400_BAD_REQUEST
-
-        response = make_response(jsonify(message), rc)
-
+        except KeyError:
+            message = { 'error' : 'Product %s was not found in shopping cart %s' % (str(sku), str(sid)) }
+            rc = HTTP_404_NOT_FOUND
+    elif Shopcart.exists(sid):
+        message = { 'error' : 'Product data is not valid' }
+        rc = HTTP_400_BAD_REQUEST
     else:
         message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
         rc = HTTP_404_NOT_FOUND
-        response = make_response(jsonify(message), rc)
 
-    return response
+    return make_response(jsonify(message), rc)
 
 ######################################################################
 # DELETE A SHOPPING CART
@@ -729,6 +1187,11 @@ def delete_shopcarts(sid):
       - Shopcarts
     description: Deletes a Shopcart from the database
     parameters:
+      - name: If-Match
+        in: header
+        description: ETag the Shopcart must still have, answered with 412 Precondition Failed if it changed since
+        required: false
+        type: string
       - name: sid
         in: path
         description: sid of shopcart to delete
@@ -737,14 +1200,17 @@ def delete_shopcarts(sid):
     responses:
       204:
         description: Shopcart deleted
+      412:
+        description: Precondition Failed (the Shopcart is not at the version of If-Match)
     """
 
 
+    version = if_match_version()
     cart = Shopcart.find(sid)
     if cart:
-        s = Shopcart()
-        s.deserialize(cart).save()
-        s.delete()
+        Shopcart().deserialize(cart).delete(version)
+    elif version is not None:
+        raise VersionConflict('no shopcart %s' % str(sid))
     return make_response('', HTTP_204_NO_CONTENT)
 
 ######################################################################
@@ -761,6 +1227,11 @@ def delete_products(sid,sku):
       - Shopcarts
     description: Deletes a product from a shopcart from the database
     parameters:
+      - name: If-Match
+        in: header
+        description: ETag the Shopcart must still have, answered with 412 Precondition Failed if it changed since
+        required: false
+        type: string
       - name: sid
         in: path
         description: sid of shopcart from which product needs to be deleted
@@ -774,16 +1245,11 @@ def delete_products(sid,sku):
     responses:
       204:
         description: Product deleted
+      412:
+        description: Precondition Failed (the Shopcart is not at the version of If-Match)
     """
 
-    cart = Shopcart.find(sid)
-    if cart:
-        for j in range(len(cart['products'])):
-            if cart['products'][j]['sku'] == sku:
-                del cart['products'][j]
-                break
-        s = Shopcart()
-        s.deserialize(cart).save()
+    Shopcart.remove_product(sid, sku, if_match_version())
     return '', HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -800,6 +1266,11 @@ def subtotal_shopcart(sid):
       - Shopcarts
     description: Calculates subtotal of a shopcart
     parameters:
+      - name: If-Match
+        in: header
+        description: ETag the Shopcart must still have, answered with 412 Precondition Failed if it changed since
+        required: false
+        type: string
       - name: sid
         in: path
         description: sid of shopcart whose subtotal you want to calculate
@@ -808,26 +1279,142 @@ def subtotal_shopcart(sid):
     responses:
       200:
         description: Subtotal calculated
+      412:
+        description: Precondition Failed (the Shopcart is not at the version of If-Match)
     """
 
-    cart = Shopcart.find(sid)
-
+    cart = Shopcart.update_subtotal(sid, if_match_version())
     if cart:
-        subtotal = 0.0
-        for product in cart['products']:
-            subtotal += product['unitprice'] * product['quantity']
-        cart['subtotal'] = float("{0:.2f}".format(subtotal))
-        shopcart = Shopcart()
-        shopcart.deserialize(cart).save()
         message = cart
         rc = HTTP_200_OK
-
-    if not 'rc' in locals():
+    else:
         message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
         rc = HTTP_404_NOT_FOUND
 
     return make_response(jsonify(message), rc)
 
+######################################################################
+# APPLY MANY OPERATIONS TO A SHOPPING CART AT ONCE
+######################################################################
+@app.route('/shopcarts/<int:sid>/batch', methods=['POST'])
+def batch_shopcart(sid):
+
+    """
+    Applies many operations to a Shopcart
+    This endpoint applies the posted operations in order to the Shopcart and saves it once, see operations.py
+    ---
+    tags:
+      - Shopcarts
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: If-Match
+        in: header
+        description: ETag the Shopcart must still have, answered with 412 Precondition Failed if it changed since
+        required: false
+        type: string
+      - name: sid
+        in: path
+        description: the sid of the shopcart to change
+        required: true
+        type: integer
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: Operation
+              required:
+                - op
+              properties:
+                op:
+                  type: string
+                  description: add, update, remove or subtotal
+                sku:
+                  type: integer
+                  description: sku of the product to update or remove
+                products:
+                  type: array
+                  description: products to add, or the single new product of an update
+    responses:
+      200:
+        description: The Shopcart after every operation and the status of each one (as the route it stands for would answer)
+        schema:
+          properties:
+            shopcart:
+              schema:
+                id: Shopcart
+            results:
+              type: array
+              items:
+                schema:
+                  properties:
+                    index:
+                      type: integer
+                      description: position of the operation in the posted array
+                    op:
+                      type: string
+                    status:
+                      type: integer
+                      description: HTTP status of the operation
+                    error:
+                      type: string
+                      description: why the operation was not applied
+      400:
+        description: Bad Request (the posted data was not an array, or an array longer than 1000)
+      404:
+        description: Shopcart not found
+      412:
+        description: Precondition Failed (the Shopcart is not at the version of If-Match)
+    """
+
+    payload = get_payload()
+    if not isinstance(payload, list) or len(payload) > MAX_BATCH_SIZE:
+        message = { 'error' : 'Data is not valid' }
+        return make_response(jsonify(message), HTTP_400_BAD_REQUEST)
+
+    applied = operations.apply_operations(sid, payload, if_match_version())
+    if applied is None:
+        message = { 'error' : 'Shopping Cart with id: %s was not found' % str(sid) }
+        return make_response(jsonify(message), HTTP_404_NOT_FOUND)
+    cart, results = applied
+    message = { 'shopcart': cart, 'results': results }
+    return make_response(jsonify(message), HTTP_200_OK)
+
+######################################################################
+# SERVICE STATISTICS
+######################################################################
+@app.route('/stats', methods=['GET'])
+def get_stats():
+
+    """
+    Retrieve service statistics
+    This endpoint will return the state of the Redis connection pools, of the cart cache and of the cart reaper
+    ---
+    tags:
+      - Service
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Service statistics
+    """
+
+    stats = {}
+    if redis_manager:
+        stats['redis'] = redis_manager.stats()
+    if shard_managers:
+        stats['shards'] = [manager.stats() for manager in shard_managers]
+    if Shopcart.cache_stats():
+        stats['cache'] = Shopcart.cache_stats()
+    if cart_reaper:
+        stats['reaper'] = cart_reaper.stats()
+    return make_response(jsonify(stats), HTTP_200_OK)
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -845,15 +1432,48 @@ def setup_logging():
         app.logger.addHandler(handler)
 
 ######################################################################
-# Connect to Redis and catch connection exceptions
+# Connect to Redis
 ######################################################################
-def connect_to_redis(hostname, port, password):
-    redis = Redis(host=hostname, port=port, password=password)
-    try:
-        redis.ping()
-    except ConnectionError:
-        redis = None
-    return redis
+def use_redis(client):
+    global redis
+    redis = client
+    Shopcart.use_db(client)
+
+def parse_shards(spec):
+    """ Returns the (hostname, port, password) of SHOPCART_REDIS_SHARDS, host:port[:password] separated by commas """
+    shards = []
+    for node in spec.split(','):
+        parts = node.strip().split(':', 2)
+        if len(parts) < 2:
+            raise ValueError('Invalid Redis shard %s, expected host:port' % node)
+        shards.append((parts[0], int(parts[1]), parts[2] if len(parts) > 2 else None))
+    return shards
+
+def initialize_shards(spec):
+    """ Connects to every Redis shard, each one with its own manager
+
+    The carts on the shards that are connected are served right away, a
+    shard that is down at startup is connected by its manager later on and
+    until then the requests that need it get a 503.
+    """
+    global shard_managers
+    storage = ShardedStorage([('%s:%d' % (hostname, port), None) for hostname, port, password in parse_shards(spec)])
+    Shopcart.use_storage(storage)
+
+    def use_shard(name):
+        def connected(client):
+            storage.set_node(name, RedisStorage(client))
+            if name == storage.names[0]:
+                Shopcart.use_storage(storage)  # listens to the cache invalidations on it
+        return connected
+
+    for hostname, port, password in parse_shards(spec):
+        name = '%s:%d' % (hostname, port)
+        manager = RedisManager([(hostname, port, password)], on_connect=use_shard(name), logger=app.logger)
+        if not manager.connect():
+            app.logger.error('*** FATAL ERROR: Could not connect to the Redis shard %s' % name)
+        manager.start()
+        shard_managers.append(manager)
 
 ######################################################################
 # INITIALIZE Redis
@@ -861,10 +1481,43 @@ def connect_to_redis(hostname, port, password):
 #   1) In Bluemix with Redis bound through VCAP_SERVICES
 #   2) With Redis running on the local server as with Travis CI
 #   3) With Redis --link ed in a Docker container called 'redis'
+# The connection is checked in the background and re-established,
+# in the same order, whenever Redis stops answering.
+# With SHOPCART_REAP_INTERVAL set, abandoned carts are reaped every
+# that many seconds (see reaper.py).
+# With SHOPCART_STORAGE=memory (in the app config or the environment)
+# the carts are kept in the process instead and Redis is not used, with
+# SHOPCART_STORAGE=sharded they are spread over the Redis nodes listed
+# in SHOPCART_REDIS_SHARDS.
 ######################################################################
 def inititalize_redis():
-    global redis
+    global redis, redis_manager, shard_managers, cart_reaper
     redis = None
+    if cart_reaper:
+        cart_reaper.stop()
+    cart_reaper = CartReaper.from_env(app.logger)
+    if cart_reaper:
+        cart_reaper.start()
+    if redis_manager or shard_managers:
+        Shopcart.use_db(None)
+    if redis_manager:
+        redis_manager.stop()
+        redis_manager = None
+    for manager in shard_managers:
+        manager.stop()
+    shard_managers = []
+    Shopcart.use_cache(CartCache.from_env())
+    backend = app.config.get('SHOPCART_STORAGE') or os.getenv('SHOPCART_STORAGE', 'redis')
+    if backend == 'memory':
+        app.logger.info("Keeping the shopping carts in memory")
+        Shopcart.use_storage(MemoryStorage())
+        return
+    if backend == 'sharded':
+        app.logger.info("Sharding the shopping carts over Redis nodes")
+        initialize_shards(app.config.get('SHOPCART_REDIS_SHARDS') or os.getenv('SHOPCART_REDIS_SHARDS', ''))
+        return
+    if backend != 'redis':
+        raise ValueError('Unknown SHOPCART_STORAGE %s' % backend)
     # Get the crdentials from the Bluemix environment
     if 'VCAP_SERVICES' in os.environ:
         app.logger.info("Using VCAP_SERVICES...")
@@ -872,14 +1525,13 @@ def inititalize_redis():
         services = json.loads(VCAP_SERVICES)
         creds = services['rediscloud'][0]['credentials']
         app.logger.info("Conecting to Redis on host %s port %s" % (creds['hostname'], creds['port']))
-        redis = connect_to_redis(creds['hostname'], creds['port'], creds['password'])
+        candidates = [(creds['hostname'], creds['port'], creds['password'])]
     else:
-        app.logger.info("VCAP_SERVICES not found, checking localhost for Redis")
-        redis = connect_to_redis('127.0.0.1', 6379, None)
-        if not redis:
-            app.logger.info("No Redis on localhost, using: redis")
-            redis = connect_to_redis('redis', 6379, None)
-    if not redis:
+        app.logger.info("VCAP_SERVICES not found, checking localhost for Redis, then: redis")
+        candidates = [('127.0.0.1', 6379, None), ('redis', 6379, None)]
+    redis_manager = RedisManager(candidates, on_connect=use_redis, logger=app.logger)
+    if not redis_manager.connect():
         # if you end up here, redis instance is down.
         app.logger.error('*** FATAL ERROR: Could not connect to the Redis Service')
-    Shopcart.use_db(redis)
\ No newline at end of file
+        Shopcart.use_db(None)
+    redis_manager.start()
@@ -0,0 +1,266 @@
+import os
+import time
+import codec
+
+######################################################################
+# Cart storage backends
+#   Shopcart keeps its carts in one of these. Carts go in and out as
+#   the serialized dicts of Shopcart.serialize(), the uid index maps
+#   every uid to the sid of its (single) cart. RedisStorage is the one
+#   used in production, MemoryStorage keeps everything in the process
+#   for tests and benchmarks without a network round trip.
+#
+#   Every change of a cart bumps its version, a counter that goes on
+#   from the version the cart had when it is saved again. The methods
+#   that take a version only change a cart still at that version and
+#   raise VersionConflict otherwise, None changes it at any version.
+#
+#   Carts that are not changed for idle_ttl seconds expire with their
+#   uid index entry, placeholder carts (products [[]], created without
+#   products) after empty_ttl seconds, 0 keeps them for ever.
+#
+#   With store_json the JSON of the products is kept in the cart when
+#   it is written, so get_json answers without decoding the cart. Any
+#   change of the products drops it, the next get_json renders it again.
+######################################################################
+
+class Storage(object):
+    idle_ttl = int(os.getenv('SHOPCART_IDLE_TTL', '0'))
+    empty_ttl = int(os.getenv('SHOPCART_EMPTY_TTL', '0')) or idle_ttl
+    store_json = os.getenv('SHOPCART_STORE_JSON', 'False') == 'True'
+
+    def ttl(self, cart):
+        """ Returns the seconds cart is kept without being changed, 0 for ever """
+        if cart['products'] == [[]]:
+            return self.empty_ttl
+        return self.idle_ttl
+
+    #
+    # sids
+    #
+    def next_ids(self, count=1):
+        """ Allocates count new sids, returns the last one """
+        raise NotImplementedError
+
+    def reserve_id(self, sid):
+        """ Makes sure sid is never allocated again """
+        raise NotImplementedError
+
+    #
+    # carts
+    #
+    def get(self, sid):
+        """ Returns the cart sid or None """
+        found = self.get_versioned(sid)
+        return found[0] if found else None
+
+    def get_many(self, sids):
+        """ Returns the carts of sids in the same order, None for the missing ones """
+        return [found[0] if found else None for found in self.get_many_versioned(sids)]
+
+    def get_versioned(self, sid):
+        """ Returns (cart, version) of the cart sid or None """
+        raise NotImplementedError
+
+    def get_many_versioned(self, sids):
+        """ Returns (cart, version) of the carts of sids in the same order, None for the missing ones """
+        raise NotImplementedError
+
+    def get_json(self, sid):
+        """ Returns (JSON of the cart, JSON of its products, version) of the cart sid or None
+
+        The JSON is what jsonify answers with for them, see codec.render.
+        """
+        found = self.get_versioned(sid)
+        if found is None:
+            return None
+        cart, version = found
+        products_json = codec.render(cart['products'])
+        return codec.render_cart(sid, cart['uid'], cart['subtotal'], products_json), products_json, version
+
+    def version(self, sid):
+        """ Returns the version of the cart sid without reading the cart, None if there is none """
+        raise NotImplementedError
+
+    def exists(self, sid):
+        raise NotImplementedError
+
+    def touched(self, sid):
+        """ Returns when the cart sid was last changed (seconds since the epoch), None if there is none """
+        raise NotImplementedError
+
+    def put(self, cart, min_version=0, touched=None):
+        """ Saves a cart and indexes its uid, raises DataValidationError if the uid has another cart
+
+        The saved cart is at a version above both the one it had and min_version.
+        With touched it keeps that time of its last change and the ttl left
+        since then, as when it is moved to another node.
+        """
+        raise NotImplementedError
+
+    def put_many(self, carts):
+        """ Saves a batch of carts at once, returns the positions of the carts rejected
+
+        A cart is rejected if its uid has another cart or its sid holds the
+        cart of another uid, which is never overwritten.
+        """
+        raise NotImplementedError
+
+    def modify(self, sid, change, version=None):
+        """ Calls change(cart) on the cart sid and saves what it changed atomically
+
+        change may be called again on a fresh copy if the cart changed
+        meanwhile. Returns what change returned, None if there is no cart sid.
+        """
+        raise NotImplementedError
+
+    def delete(self, sid, uid, version=None):
+        """ Deletes a cart and its uid index entry """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Deletes every cart, index and counter """
+        raise NotImplementedError
+
+    def scan(self, cursor, count):
+        """ Returns (next cursor, sids) of about count carts from cursor, the next cursor is 0 at the end """
+        raise NotImplementedError
+
+    def scan_until(self, cursor, end):
+        """ Returns the sids from cursor up to the cursor end (0 for the end), one small scan at a time """
+        sids = []
+        while True:
+            cursor, found = self.scan(cursor, 1)
+            sids.extend(found)
+            if cursor == 0 or self.cursor_order(cursor) >= self.cursor_order(end) > 0:
+                return sids
+
+    @staticmethod
+    def cursor_order(cursor):
+        """ Returns a key that sorts cursors in the order scan reaches them """
+        return cursor
+
+    def scan_batches(self, batch_size):
+        """ Yields the sids of every cart, about batch_size at a time """
+        cursor = 0
+        while True:
+            cursor, sids = self.scan(cursor, batch_size)
+            if sids:
+                yield sids
+            if cursor == 0:
+                break
+
+    #
+    # uid index
+    #
+    @staticmethod
+    def uid_name(uid):
+        """ Returns the name uid is indexed under (utf-8), equal numbers like 5 and 5.0 share it """
+        if isinstance(uid, float) and uid.is_integer():
+            uid = int(uid)
+        if isinstance(uid, unicode):
+            return uid.encode('utf-8')
+        return str(uid)
+
+    def index_get(self, uid):
+        """ Returns the sid indexed for uid or None """
+        raise NotImplementedError
+
+    def index_get_many(self, uids):
+        """ Returns the sids indexed for uids in the same order """
+        return [self.index_get(uid) for uid in uids]
+
+    def index_clear(self):
+        raise NotImplementedError
+
+    def index_add_many(self, entries):
+        """ Indexes (uid, sid) pairs whose uid isn't indexed yet, returns whether each one was added """
+        raise NotImplementedError
+
+    #
+    # products, each returns the updated cart or None if there is no cart sid,
+    # uid is the uid of the cart when the caller knows it, which saves the
+    # storage looking it up to refresh the ttl of its index entry
+    #
+    def get_product(self, sid, sku):
+        """ Returns the product sku of cart sid without reading its other lines, None if there is none """
+        raise NotImplementedError
+
+    def add_products(self, sid, products, version=None, uid=None):
+        """ Adds products, replacing the lines with the same sku """
+        raise NotImplementedError
+
+    def update_product(self, sid, sku, product, version=None, uid=None):
+        """ Replaces the line of sku, raises KeyError if there is none """
+        raise NotImplementedError
+
+    def remove_product(self, sid, sku, version=None, uid=None):
+        raise NotImplementedError
+
+    def update_subtotal(self, sid, version=None, uid=None):
+        raise NotImplementedError
+
+    #
+    # maintenance and cache invalidation, only meaningful for some backends
+    #
+    def migrate(self, batch_size, pause):
+        """ Converts carts stored in a legacy format, returns how many """
+        return 0
+
+    def recompute_subtotals(self, compute, batch_size, dry_run=False):
+        """ Yields (carts, changes) for each batch of carts, with compute(carts) returning their cents
+
+        changes are the (sid, old cents, new cents) of the carts whose cents
+        differ, stored unless dry_run without losing concurrent changes
+        """
+        raise NotImplementedError
+
+    def reap(self, batch_size):
+        """ Deletes the carts past their ttl and the index entries of missing carts, returns a ReapStats """
+        return ReapStats()
+
+    def rebalance(self, batch_size):
+        """ Moves the carts stored on the wrong node after the nodes changed
+
+        Returns how many were moved and the sids of the ones left where they
+        were because their uid has another cart on the new node.
+        """
+        return 0, []
+
+    def publish(self, sids):
+        """ Tells the other processes that carts changed """
+        pass
+
+    def listen(self, cache, logger):
+        """ Starts applying the changes published by other processes to cache, returns the listener """
+        return None
+
+class ReapStats(object):
+
+    def __init__(self):
+        self.carts = 0
+        self.placeholders = 0
+        self.index_entries = 0
+        self.expiring = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def add(self, other):
+        for name in ('carts', 'placeholders', 'index_entries', 'expiring', 'bytes'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def to_dict(self):
+        return {
+            'carts': self.carts,
+            'placeholders': self.placeholders,
+            'index_entries': self.index_entries,
+            'expiring': self.expiring,
+            'bytes': self.bytes,
+            'elapsed': self.elapsed
+        }
+
+    def __str__(self):
+        return 'Reclaimed %d shopcarts (%d placeholders) and %d uid index entries, %d bytes freed in %.2fs, %d more set to expire' % (
+            self.carts, self.placeholders, self.index_entries, self.bytes, self.elapsed, self.expiring)
@@ -0,0 +1,39 @@
+######################################################################
+# Cart record formats compared: pickle (what save() used to store) vs
+# the hash fields of codec.to_hash, what the carts are stored as now
+#   python benchmarks/bench_codec.py
+######################################################################
+import os
+import sys
+import pickle
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app import codec
+
+def make_cart(lines):
+    products = [{ 'sku': 100000000 + i, 'quantity': i % 7 + 1, 'name': u'Product %d' % i, 'unitprice': 9.99 + i } for i in range(lines)]
+    return { 'uid': 42, 'sid': 4242, 'subtotal': 0.0, 'products': products or [[]] }
+
+def hash_dumps(cart):
+    # Redis hands the fields back as strings
+    return dict((field, str(value)) for field, value in codec.to_hash(cart).iteritems())
+
+def hash_size(fields):
+    return sum(len(field) + len(value) for field, value in fields.iteritems())
+
+def bench(name, dumps, loads, cart, number, size=len):
+    data = dumps(cart)
+    encode = timeit.timeit(lambda: dumps(cart), number=number) / number * 1e6
+    decode = timeit.timeit(lambda: loads(data), number=number) / number * 1e6
+    print '%-10s %8d %12.1f %12.1f' % (name, size(data), encode, decode)
+
+if __name__ == '__main__':
+    for lines in (0, 1, 10, 100, 1000):
+        cart = make_cart(lines)
+        number = max(10, 20000 // (lines + 1))
+        print '\n%d product lines' % lines
+        print '%-10s %8s %12s %12s' % ('format', 'bytes', 'encode (us)', 'decode (us)')
+        bench('pickle', pickle.dumps, pickle.loads, cart, number)
+        bench('pickle-2', lambda c: pickle.dumps(c, 2), pickle.loads, cart, number)
+        bench('hash', hash_dumps, lambda fields: codec.from_hash(cart['sid'], fields), cart, number, hash_size)
@@ -0,0 +1,66 @@
+######################################################################
+# Bytes on the wire and latency of cart responses
+#   python benchmarks/bench_compression.py [redis]
+#   GET /shopcarts/<sid> as carts grow, in full and with fields=, sent
+#   as is and gzip compressed at a few levels. Prints the body size and
+#   the median and p99 latency through the Flask test client. In memory
+#   unless "redis" is given (local Redis on 6379, whose data is
+#   flushed).
+######################################################################
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app import shopcart as server
+from app import compression
+from app.models import Shopcart
+from app.memory_storage import MemoryStorage
+
+CASES = [
+    ('full', '', None),
+    ('full, gzip 1', '', 1),
+    ('full, gzip 6', '', 6),
+    ('full, gzip 9', '', 9),
+    ('fields=subtotal', '?fields=subtotal', None),
+    ('fields=products.sku', '?fields=products.sku', None),
+    ('products.sku, gzip 6', '?fields=products.sku', 6)
+]
+
+def use_storage():
+    if 'redis' in sys.argv[1:]:
+        from redis import Redis
+        from app.redis_storage import RedisStorage
+        Shopcart.use_storage(RedisStorage(Redis()))
+    else:
+        Shopcart.use_storage(MemoryStorage())
+    Shopcart.remove_all()
+
+def make_cart(lines):
+    products = [{ 'sku': 100000000 + i, 'quantity': i % 7 + 1, 'name': u'Product %d' % i, 'unitprice': 9.99 + i } for i in range(lines)]
+    cart = Shopcart(uid=lines, products=products)
+    cart.save()
+    return cart.sid
+
+def measure(client, url, level, number):
+    compression.LEVEL = level or 0
+    headers = { 'Accept-Encoding': 'gzip' } if level else {}
+    timings = []
+    for i in range(number):
+        started = time.time()
+        resp = client.get(url, headers=headers)
+        timings.append(time.time() - started)
+    timings.sort()
+    return len(resp.data), timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6
+
+if __name__ == '__main__':
+    use_storage()
+    compression.MIN_SIZE = 0
+    client = server.app.test_client()
+    print '%8s %-22s %10s %12s %12s' % ('lines', 'response', 'bytes', 'p50 (us)', 'p99 (us)')
+    for lines in (10, 100, 1000):
+        sid = make_cart(lines)
+        number = max(100, 20000 // lines)
+        for name, query, level in CASES:
+            size, p50, p99 = measure(client, '/shopcarts/%d%s' % (sid, query), level, number)
+            print '%8d %-22s %10d %12.1f %12.1f' % (lines, name, size, p50, p99)
@@ -0,0 +1,47 @@
+######################################################################
+# Latency of GET /shopcarts/<sid> as carts grow
+#   python benchmarks/bench_json.py [redis]
+#   Times the whole request through the Flask test client and the read
+#   alone, with the cart decoded and rendered on every GET vs the JSON
+#   the storage keeps from the time the cart is written (store_json).
+#   In memory unless "redis" is given (local Redis on 6379, whose data
+#   is flushed).
+######################################################################
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app import shopcart as server
+from app.models import Shopcart
+from app.memory_storage import MemoryStorage
+
+def make_storage(store_json):
+    if 'redis' in sys.argv[1:]:
+        from redis import Redis
+        from app.redis_storage import RedisStorage
+        storage = RedisStorage(Redis())
+    else:
+        storage = MemoryStorage()
+    storage.store_json = store_json
+    Shopcart.use_storage(storage)
+    Shopcart.remove_all()
+
+def make_cart(lines):
+    products = [{ 'sku': 100000000 + i, 'quantity': i % 7 + 1, 'name': u'Product %d' % i, 'unitprice': 9.99 + i } for i in range(lines)]
+    cart = Shopcart(uid=lines, products=products)
+    cart.save()
+    return cart.sid
+
+if __name__ == '__main__':
+    client = server.app.test_client()
+    print '%8s %10s %14s %14s' % ('lines', 'stored', 'GET (us)', 'read (us)')
+    for lines in (10, 100, 1000, 10000):
+        number = max(20, 20000 // lines)
+        for store_json in (False, True):
+            make_storage(store_json)
+            sid = make_cart(lines)
+            url = '/shopcarts/%d' % sid
+            get = timeit.timeit(lambda: client.get(url), number=number) / number * 1e6
+            read = timeit.timeit(lambda: Shopcart.find_json(sid), number=number) / number * 1e6
+            print '%8d %10s %14.1f %14.1f' % (lines, store_json, get, read)
@@ -0,0 +1,32 @@
+######################################################################
+# Encode/decode cost and size of a cart per media type
+#   python benchmarks/bench_media.py
+#   A cart of 1, 50 and 1000 lines as the API sends it, in JSON and in
+#   the binary media types of app/media.py.
+######################################################################
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app import codec
+from app import media
+
+def make_cart(lines):
+    products = [{ 'sku': 100000000 + i, 'quantity': i % 7 + 1, 'name': u'Product %d' % i, 'unitprice': 9.99 + i } for i in range(lines)]
+    return { 'uid': lines, 'sid': lines, 'subtotal': 1234.56, 'products': products }
+
+if __name__ == '__main__':
+    encodings = [(media.JSON, codec.render, json.loads)]
+    encodings.extend((mimetype, media.ENCODERS[mimetype], media.DECODERS[mimetype]) for mimetype in media.ENCODERS)
+    print '%8s %-20s %10s %14s %14s' % ('lines', 'media type', 'bytes', 'encode (us)', 'decode (us)')
+    for lines in (1, 50, 1000):
+        cart = make_cart(lines)
+        number = max(20, 50000 // lines)
+        for mimetype, encode, decode in encodings:
+            data = encode(cart)
+            assert decode(data) == cart
+            encoding = timeit.timeit(lambda: encode(cart), number=number) / number * 1e6
+            decoding = timeit.timeit(lambda: decode(data), number=number) / number * 1e6
+            print '%8d %-20s %10d %14.1f %14.1f' % (lines, mimetype, len(data), encoding, decoding)
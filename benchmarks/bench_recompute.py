@@ -0,0 +1,53 @@
+######################################################################
+# Throughput of recomputing every subtotal
+#   python benchmarks/bench_recompute.py [redis] [carts] [lines]
+#   One update_subtotal per cart (what a PUT /subtotal per cart does)
+#   vs the batched job of recompute.py, with and without numpy. In
+#   memory unless "redis" is given (local Redis on 6379, whose data is
+#   flushed).
+######################################################################
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app.models import Shopcart
+from app.memory_storage import MemoryStorage
+from app import recompute
+
+def use_storage(args):
+    if 'redis' in args:
+        from redis import Redis
+        from app.redis_storage import RedisStorage
+        Shopcart.use_storage(RedisStorage(Redis()))
+    else:
+        Shopcart.use_storage(MemoryStorage())
+    Shopcart.remove_all()
+
+def make_carts(count, lines):
+    for first in range(0, count, 1000):
+        Shopcart.save_many([Shopcart(uid=uid, products=[{ 'sku': 100000000 + i, 'quantity': i % 7 + 1, 'name': u'Product %d' % i, 'unitprice': 9.99 + i }
+                                                        for i in range(lines)]) for uid in range(first, min(first + 1000, count))])
+
+def report(name, count, elapsed):
+    print '%-24s %10.2f %12.0f' % (name, elapsed, count / elapsed)
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != 'redis']
+    count = int(args[0]) if args else 20000
+    lines = int(args[1]) if len(args) > 1 else 10
+    use_storage(sys.argv[1:])
+    make_carts(count, lines)
+    print '%d carts of %d lines' % (count, lines)
+    print '%-24s %10s %12s' % ('method', 'seconds', 'carts/s')
+    started = time.time()
+    for cart in Shopcart.iterate():
+        Shopcart.update_subtotal(cart['sid'])
+    report('update_subtotal per cart', count, time.time() - started)
+    stats = recompute.recompute_subtotals(compute=recompute.cents_array)
+    report('batches, array', stats.carts, stats.elapsed)
+    if recompute.load_numpy():
+        stats = recompute.recompute_subtotals(compute=recompute.cents_numpy)
+        report('batches, numpy', stats.carts, stats.elapsed)
+        stats = recompute.recompute_subtotals(compute=recompute.cents_numpy, dry_run=True)
+        report('batches, numpy, dry run', stats.carts, stats.elapsed)
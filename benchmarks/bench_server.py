@@ -0,0 +1,78 @@
+######################################################################
+# Requests per second of one server process
+#   python benchmarks/bench_server.py [concurrency] [seconds]
+#   Starts run.py (the blocking Werkzeug server, with WORKERS=1 so it
+#   is one process too) and run_gevent.py on local ports, each with the
+#   local Redis on 6379, and keeps concurrency clients sending
+#   GET /shopcarts/<sid> to each for the given seconds. run_gevent.py
+#   is skipped without gevent.
+######################################################################
+import os
+import sys
+import json
+import time
+import urllib2
+import threading
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVERS = [('run.py', 8901), ('run_gevent.py', 8902)]
+
+def start(script, port):
+    env = dict(os.environ, PORT=str(port), WORKERS='1')
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, script)], env=env, stdout=devnull, stderr=devnull)
+    for i in range(100):
+        try:
+            urllib2.urlopen('http://127.0.0.1:%d/shopcarts?limit=1' % port).read()
+            return process
+        except Exception:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('%s did not start' % script)
+
+def make_cart(port):
+    products = [{ 'sku': 100000000 + i, 'quantity': 1, 'name': 'Product %d' % i, 'unitprice': 9.99 } for i in range(10)]
+    body = json.dumps({ 'uid': int(time.time() * 1000), 'products': products })
+    request = urllib2.Request('http://127.0.0.1:%d/shopcarts' % port, body, { 'Content-Type': 'application/json' })
+    return json.loads(urllib2.urlopen(request).read())['sid']
+
+def load(url, concurrency, seconds):
+    counts, errors = [0] * concurrency, [0]
+    deadline = time.time() + seconds
+
+    def client(i):
+        while time.time() < deadline:
+            try:
+                urllib2.urlopen(url).read()
+                counts[i] += 1
+            except Exception:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / float(seconds), errors[0]
+
+if __name__ == '__main__':
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print '%d clients for %.0fs' % (concurrency, seconds)
+    print '%-16s %12s %8s' % ('server', 'requests/s', 'errors')
+    for script, port in SERVERS:
+        if script == 'run_gevent.py':
+            try:
+                import gevent
+            except ImportError:
+                print '%-16s %12s' % (script, 'no gevent')
+                continue
+        process = start(script, port)
+        try:
+            sid = make_cart(port)
+            rps, errors = load('http://127.0.0.1:%d/shopcarts/%d' % (port, sid), concurrency, seconds)
+            print '%-16s %12.0f %8d' % (script, rps, errors)
+        finally:
+            process.terminate()
+            process.wait()
@@ -0,0 +1,51 @@
+######################################################################
+# Product get/update/delete latency as carts grow
+#   python benchmarks/bench_sku_index.py [redis]
+#   Compares reading a product by walking the decoded cart (what
+#   GET /shopcarts/<sid>/products/<sku> used to do) with the field level
+#   lookup by sku, and times removing a line. Updates return the whole
+#   cart (PUT answers with it), so they grow with it. In memory unless
+#   "redis" is given (local Redis on 6379, whose data is flushed).
+######################################################################
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app.models import Shopcart
+from app.memory_storage import MemoryStorage
+
+def use_storage():
+    if 'redis' in sys.argv[1:]:
+        from redis import Redis
+        from app.redis_storage import RedisStorage
+        Shopcart.use_storage(RedisStorage(Redis()))
+    else:
+        Shopcart.use_storage(MemoryStorage())
+    Shopcart.remove_all()
+
+def make_cart(lines):
+    products = [{ 'sku': 100000000 + i, 'quantity': i % 7 + 1, 'name': u'Product %d' % i, 'unitprice': 9.99 + i } for i in range(lines)]
+    cart = Shopcart(uid=lines, products=products)
+    cart.save()
+    return cart.sid, products[lines // 2]
+
+def walk(sid, sku):
+    return [product for product in Shopcart.find(sid)['products'] if product['sku'] == sku][0]
+
+if __name__ == '__main__':
+    use_storage()
+    print '%8s %12s %12s %12s %16s' % ('lines', 'walk (us)', 'get (us)', 'delete (us)', 'update+cart (us)')
+    for lines in (10, 100, 1000, 10000):
+        sid, product = make_cart(lines)
+        sku = product['sku']
+        number = max(20, 20000 // lines)
+        scan = timeit.timeit(lambda: walk(sid, sku), number=number) / number * 1e6
+        get = timeit.timeit(lambda: Shopcart.get_product(sid, sku), number=number) / number * 1e6
+        update = timeit.timeit(lambda: Shopcart.update_product(sid, sku, product), number=number) / number * 1e6
+        # every round removes one of number extra lines
+        extra = iter(range(900000000, 900000000 + number))
+        for i in range(900000000, 900000000 + number, 1000):
+            Shopcart.add_products(sid, [dict(product, sku=j) for j in range(i, min(i + 1000, 900000000 + number))])
+        delete = timeit.timeit(lambda: Shopcart.remove_product(sid, next(extra)), number=number) / number * 1e6
+        print '%8d %12.1f %12.1f %12.1f %16.1f' % (lines, scan, get, delete, update)
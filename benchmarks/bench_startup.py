@@ -0,0 +1,54 @@
+######################################################################
+# Cold start time
+#   python benchmarks/bench_startup.py [runs]
+#   In fresh processes, the milliseconds from before "import app" to
+#   the app imported, to its first response (GET /shopcarts, carts in
+#   memory) and to the first and second GET /v1/spec, built from the
+#   docstrings and read from a spec file made by manage.py spec.
+#   Medians over the runs.
+######################################################################
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROBE = '''
+import sys, time, json
+started = time.time()
+sys.path.insert(0, %r)
+import app
+from app import shopcart as server
+imported = time.time()
+server.inititalize_redis()
+client = server.app.test_client()
+client.get('/shopcarts')
+answered = time.time()
+client.get('/v1/spec')
+spec = time.time()
+client.get('/v1/spec')
+again = time.time()
+print json.dumps([(t - started) * 1000 for t in (imported, answered, spec, again)])
+''' % ROOT
+
+STEPS = ['import', 'first response', 'first spec', 'second spec']
+
+def probe(env):
+    with open(os.devnull, 'w') as devnull:
+        return json.loads(subprocess.check_output([sys.executable, '-c', PROBE], env=env, stderr=devnull))
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+    spec_file = os.path.join(tempfile.mkdtemp(), 'spec.json')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'manage.py'), 'spec', '--output', spec_file], stdout=devnull, stderr=devnull)
+    env = dict(os.environ, SHOPCART_STORAGE='memory')
+    print '%-12s %s' % ('spec', ' '.join('%16s' % step for step in STEPS))
+    for name, extra in (('docstrings', {}), ('spec file', { 'SHOPCART_SPEC_FILE': spec_file })):
+        timings = [probe(dict(env, **extra)) for i in range(runs)]
+        print '%-12s %s' % (name, ' '.join('%13.1f ms' % median(column) for column in zip(*timings)))
@@ -0,0 +1,129 @@
+import sys
+import argparse
+from app import shopcart as server
+from app.models import Shopcart
+from app import export as exporter
+from app import importer
+from app import recompute
+from app import codec
+from app import apidocs
+
+######################################################################
+# Maintenance commands, run with: python manage.py <command>
+######################################################################
+
+def reindex(args):
+    indexed, duplicates = Shopcart.reindex(args.batch_size)
+    print "Indexed %d shopcarts by uid (%d duplicate uids skipped)" % (indexed, duplicates)
+
+def export(args):
+    out = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for chunk in exporter.export(Shopcart.iterate(args.batch_size), args.format):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+def load(args):
+    rejects = open(args.rejects, 'wb') if args.rejects else None
+    try:
+        with open(args.file, 'rb') as stream:
+            stats = importer.import_carts(stream, args.format, args.batch_size, not args.new_sids, rejects)
+    finally:
+        if rejects:
+            rejects.close()
+    print stats
+
+def migrate_encoding(args):
+    if args.allow_pickle:
+        codec.ALLOW_PICKLE = True
+    migrated = Shopcart.migrate_encoding(args.batch_size, args.pause)
+    print "Converted %d legacy shopcarts to hashes" % migrated
+
+def check_subtotals(args):
+    drifted = 0
+    for sid, stored, computed in Shopcart.check_subtotals(args.batch_size, args.fix):
+        drifted += 1
+        print "Shopcart %d: subtotal %.2f, products add up to %.2f%s" % (sid, stored, computed, ' (fixed)' if args.fix else '')
+    print "%d shopcarts with a drifted subtotal" % drifted
+
+def recompute_subtotals(args):
+    stats = recompute.recompute_subtotals(args.batch_size, args.dry_run)
+    for sid, old, new in stats.changed:
+        print "Shopcart %d: subtotal %.2f -> %.2f" % (sid, old, new)
+    print stats
+
+def reap(args):
+    print Shopcart.reap(args.batch_size)
+
+def rebalance(args):
+    moved, conflicts = Shopcart.rebalance(args.batch_size)
+    print "Moved %d shopcarts to the shard that owns them" % moved
+    if conflicts:
+        print "Left %d shopcarts whose uid has another cart: %s" % (len(conflicts), ', '.join(str(sid) for sid in conflicts))
+
+def spec(args):
+    with server.app.test_request_context():
+        data = apidocs.build_spec()
+    with open(args.output, 'wb') as out:
+        out.write(data)
+    print "Wrote the API spec to %s (%d bytes), serve it with SHOPCART_SPEC_FILE=%s" % (args.output, len(data), args.output)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Shopcart Service maintenance commands')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('reindex', help='rebuild the uid -> sid index from the stored carts')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.set_defaults(func=reindex)
+
+    command = commands.add_parser('export', help='stream every shopcart as NDJSON or CSV')
+    command.add_argument('--format', choices=sorted(exporter.FORMATS), default='ndjson')
+    command.add_argument('--output', help='file to write, defaults to stdout')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('import', help='load shopcarts from a CSV (like sampleShopcarts.csv) or NDJSON file')
+    command.add_argument('file')
+    command.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--rejects', help='file to write the rejected rows to')
+    command.add_argument('--new-sids', action='store_true', help='allocate new sids instead of keeping the ones in the file')
+    command.set_defaults(func=load)
+
+    command = commands.add_parser('migrate-encoding', help='convert shopcarts stored as pickle or binary strings to hashes')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--pause', type=float, default=0.1, help='seconds to sleep between batches')
+    command.add_argument('--allow-pickle', action='store_true', help='also convert carts stored as pickles (only trust them from your own Redis)')
+    command.set_defaults(func=migrate_encoding)
+
+    command = commands.add_parser('check-subtotals', help='recompute the subtotal of every shopcart and report the ones that drifted')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--fix', action='store_true', help='store the recomputed subtotals')
+    command.set_defaults(func=check_subtotals)
+
+    command = commands.add_parser('recompute-subtotals', help='recompute every subtotal from the products in vectorized batches, after price corrections')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--dry-run', action='store_true', help='only report the shopcarts whose subtotal would change')
+    command.set_defaults(func=recompute_subtotals)
+
+    command = commands.add_parser('reap', help='delete the shopcarts past their idle ttl and the uid index entries left without a cart')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.set_defaults(func=reap)
+
+    command = commands.add_parser('rebalance', help='move shopcarts to their shard after a node was added to SHOPCART_REDIS_SHARDS')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.set_defaults(func=rebalance)
+
+    command = commands.add_parser('spec', help='build the Swagger spec of /v1/spec ahead of time, no Redis needed')
+    command.add_argument('--output', default='spec.json')
+    command.set_defaults(func=spec, offline=True)
+
+    args = parser.parse_args()
+    if not getattr(args, 'offline', False):
+        server.inititalize_redis()
+    args.func(args)
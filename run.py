@@ -1,6 +1,7 @@
 import os
 from app import app
 from app import shopcart as server
+from app.prefork import PreforkServer
 
 # Pull options from environment
 debug = (os.getenv('DEBUG', 'False') == 'True')
@@ -8,8 +9,14 @@ port = os.getenv('PORT', '8888')
 
 ######################################################################
 #   M A I N
+#   Serves with WORKERS pre-forked processes (see app/prefork.py), or
+#   with the Werkzeug development server and its reloader in DEBUG.
 ######################################################################
 if __name__ == "__main__":
     print "Shopcart Service Starting..."
-    server.inititalize_redis()
-    app.run(host='0.0.0.0', port=int(port), debug=debug)
+    if debug:
+        server.inititalize_redis()
+        app.run(host='0.0.0.0', port=int(port), debug=debug)
+    else:
+        # every worker connects to Redis after it is forked
+        PreforkServer.from_env(app, initialize=server.inititalize_redis, logger=app.logger).serve_forever()
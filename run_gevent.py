@@ -0,0 +1,32 @@
+######################################################################
+# Cooperative entry point: python run_gevent.py
+#   Serves the same app as run.py from a gevent loop. Sockets, Redis
+#   ones included, are patched to yield while they wait, so a process
+#   keeps up to CONCURRENCY requests in flight instead of one, and the
+#   shards of a sharded storage are queried at the same time. Needs
+#   gevent (pip install gevent).
+######################################################################
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+# requests wait for a free Redis connection rather than fail
+os.environ.setdefault('REDIS_POOL_TIMEOUT', '5')
+
+from app import app
+from app import shopcart as server
+
+# Pull options from environment
+port = os.getenv('PORT', '8888')
+concurrency = os.getenv('CONCURRENCY', '1000')
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    print "Shopcart Service Starting (gevent)..."
+    server.inititalize_redis()
+    WSGIServer(('0.0.0.0', int(port)), app, spawn=Pool(int(concurrency))).serve_forever()
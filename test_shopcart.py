@@ -2,12 +2,46 @@
 # coverage run test_shopcart.py
 # coverage report -m --include=shopcart.py
 
+import os
+import sys
 import unittest
+import subprocess
 import json
 import logging
+import time
+import threading
+from threading import Timer
+import pickle
+import zlib
+import signal
+import urllib2
+import msgpack
+from StringIO import StringIO
 from flask_api import status    # HTTP Status Codes
 from app import shopcart as server
 from app.models import Shopcart
+from app import importer
+from app import codec
+from app import recompute
+from app.connection import RedisManager
+from app.prefork import PreforkServer
+from app import cache
+from app import compression
+from app.cache import CartCache
+from app.memory_storage import MemoryStorage
+from app.sharded_storage import ShardedStorage
+from app.redis_storage import RedisStorage
+from app.custom_exceptions import DataValidationError, VersionConflict
+from redis.exceptions import ConnectionError
+
+# the whole suite runs against MemoryStorage with SHOPCART_STORAGE=memory
+redis_only = unittest.skipIf(os.getenv('SHOPCART_STORAGE', 'redis') != 'redis', 'needs Redis')
+
+def binary_record(cart):
+    """ Returns a cart the way it was stored before the hashes, MAGIC, VERSION and a MessagePack array """
+    products = [[product['sku'], product['quantity'], product['name'], product['unitprice']] if product else product
+                for product in cart['products']]
+    return codec.MAGIC + chr(codec.VERSION) + msgpack.packb([cart['uid'], cart['sid'], cart['subtotal'], products], use_bin_type=True)
 
 ######################################################################
 #  T E S T   C A S E S
@@ -68,6 +102,22 @@ class TestShopcartServer(unittest.TestCase):
         self.assertEqual( resp.status_code, status.HTTP_200_OK )
         self.assertTrue ('Shopcart Demo REST API Service' in resp.data)
 
+    def test_spec(self):
+        resp = self.app.get('/v1/spec')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        self.assertIn( '/shopcarts/{sid}', json.loads(resp.data)['paths'] )
+        etag = resp.headers['ETag']
+        resp = self.app.get('/v1/spec', headers={ 'If-None-Match': etag })
+        self.assertEqual( (resp.status_code, resp.data), (status.HTTP_304_NOT_MODIFIED, '') )
+        self.assertEqual( self.app.get('/apidocs/').status_code, status.HTTP_200_OK )
+        self.assertEqual( self.app.get('/apidocs/?json=1').data.count('/v1/spec'), 1 )
+
+    def test_lazy_imports(self):
+        # the app starts without flasgger and numpy, they're imported when first needed
+        script = 'import sys, app; print sorted(name for name in ("flasgger", "numpy") if name in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual( output.strip(), '[]' )
+
     def test_list_shopcarts(self):
         resp = self.app.get('/shopcarts')
         self.assertEqual( resp.status_code, status.HTTP_200_OK )
@@ -87,6 +137,27 @@ class TestShopcartServer(unittest.TestCase):
         self.assertTrue(len(data) == 1)
         self.assertEqual(data['error'], 'Data is not valid')
 
+    def test_list_shopcarts_sid_param(self):
+        resp = self.app.get('/shopcarts?sid=3,47,1,3')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( [cart['sid'] for cart in data['shopcarts']], [3, 1] )
+        self.assertEqual( data['shopcarts'][0]['products'][0]['name'], 'Game of Life' )
+        self.assertEqual( data['missing'], [47] )
+        resp = self.app.post('/shopcarts/lookup', data=json.dumps({ 'sids': [2, 0] }), content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual( ([cart['uid'] for cart in data['shopcarts']], data['missing']), ([2], [0]) )
+        for resp in (self.app.get('/shopcarts?sid=1,abc'), self.app.get('/shopcarts?sid='),
+                     self.app.post('/shopcarts/lookup', data=json.dumps([1]), content_type='application/json'),
+                     self.app.post('/shopcarts/lookup', data=json.dumps({ 'sids': range(server.MAX_PAGE_SIZE + 1) }), content_type='application/json')):
+            self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+
+    def test_find_many(self):
+        carts = Shopcart.find_many([1, 47, 3])
+        self.assertEqual( (carts[0]['uid'], carts[1], carts[2]['uid']), (1, None, 3) )
+        self.assertEqual( carts[2], Shopcart.find(3) )
+        self.assertEqual( Shopcart.find_many([]), [] )
+
     def test_list_shopcarts_uid_nonexist(self):
         resp = self.app.get('/shopcarts?uid=10')
         self.assertEqual( resp.status_code, status.HTTP_404_NOT_FOUND)
@@ -188,16 +259,16 @@ class TestShopcartServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual (new_json['uid'], 15)
         # check that list of shopcarts has been updated and has a new shopcart
-        resp = self.app.get('/shopcarts/'+str(server.current_shopping_cart_id))
+        resp = self.app.get('/shopcarts/'+str(new_json['sid']))
         data = json.loads(resp.data)
         self.assertEqual( resp.status_code, status.HTTP_200_OK )
 
         # save the current number of products for later comparrison
-        initial_product_count = self.get_product_count_by_shopcart(server.current_shopping_cart_id)
+        initial_product_count = self.get_product_count_by_shopcart(new_json['sid'])
         # add a new valid product to an valid shopcart
         new_product = { "products": [{"sku" : 114672050, "quantity" : 665555, "name" : "Lego" , "unitprice" : 43.12}, {"sku" : 114342051, "quantity" : 4, "name" : "Taboo" , "unitprice" : 3.76}] }
         data = json.dumps(new_product)
-        resp = self.app.post('/shopcarts/'+str(server.current_shopping_cart_id)+'/products', data=data, content_type='application/json')
+        resp = self.app.post('/shopcarts/'+str(new_json['sid'])+'/products', data=data, content_type='application/json')
         self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
         new_json = json.loads(resp.data)
 
@@ -212,7 +283,7 @@ class TestShopcartServer(unittest.TestCase):
                 self.assertEqual (new_json['products'][i]['unitprice'], 3.76)
 
         # check that list of products has been updated and has the new product
-        resp = self.app.get('/shopcarts/'+str(server.current_shopping_cart_id)+'/products')
+        resp = self.app.get('/shopcarts/'+str(new_json['sid'])+'/products')
         product_count = self.check_product_quantity(resp)
         self.assertEqual( resp.status_code, status.HTTP_200_OK )
         self.assertEqual( product_count, initial_product_count + 2)
@@ -310,6 +381,42 @@ class TestShopcartServer(unittest.TestCase):
         self.assertEqual( len(data), shopcart_count + 1 )
         self.assertIn( new_json, data )
 
+    def test_create_shopcarts_batch(self):
+        shopcart_count = self.get_shopcart_count()
+        new_shopcarts = [
+            { "uid": 6, "products": [{"sku" : 114672050, "quantity" : 2, "name" : "Lego" , "unitprice" : 43.12}] },
+            { "uid": 1 },
+            { "products": [] },
+            { "uid": 7, "sid": 1 },
+            { "uid": 6 },
+            { "uid": 8, "products": [{"sku" : 114342051}] }
+        ]
+        resp = self.app.post('/shopcarts/batch', data=json.dumps(new_shopcarts), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( data['created'], 2 )
+        results = data['results']
+        self.assertEqual( [result['index'] for result in results], range(6) )
+        self.assertEqual( [result['status'] for result in results],
+                          ['created', 'duplicate uid', 'invalid', 'created', 'duplicate uid', 'invalid'] )
+        self.assertEqual( results[1]['error'], 'Shopping Cart for uid 1 already exists' )
+        # sids are allocated by the service, never taken from the payload
+        self.assertNotIn( results[3]['sid'], (1, 2, 3) )
+        self.assertEqual( Shopcart.find(1)['uid'], 1 )
+        resp = self.app.get(results[0]['location'])
+        new_json = json.loads(resp.data)
+        self.assertEqual( (new_json['uid'], new_json['subtotal']), (6, 86.24) )
+        self.assertEqual( Shopcart.find(results[3]['sid'])['uid'], 7 )
+        self.assertEqual( self.get_shopcart_count(), shopcart_count + 2 )
+
+    def test_create_shopcarts_batch_invalid(self):
+        resp = self.app.post('/shopcarts/batch', data=json.dumps({ "uid": 6 }), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        resp = self.app.post('/shopcarts/batch', data=json.dumps([{ "uid": i } for i in range(server.MAX_BATCH_SIZE + 1)]), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        resp = self.app.post('/shopcarts/batch', data='[]', content_type='application/json')
+        self.assertEqual( json.loads(resp.data), { 'created': 0, 'results': [] } )
+
     def test_create_products_empty_json(self):
         # save the current number of products for later comparrison
         initial_product_count = self.get_product_count_by_shopcart(2)
@@ -533,6 +640,808 @@ class TestShopcartServer(unittest.TestCase):
         self.assertTrue( len(resp.data) > 0)
         self.assertTrue("Product data is not valid" in resp.data)
 
+    def test_batch_operations(self):
+        batch = [
+            { "op": "add", "products": [{"sku" : 114672050, "quantity" : 1, "name" : "Game of Life" , "unitprice" : 13.99}] },
+            { "op": "update", "sku": 123456780, "products": [{"sku" : 123456780, "quantity" : 3, "name" : "Settlers of Catan" , "unitprice" : 27.99}] },
+            { "op": "update", "sku": 999, "products": [{"sku" : 999, "quantity" : 3, "name" : "Taboo" , "unitprice" : 1.99}] },
+            { "op": "remove", "sku": 876543210 },
+            { "op": "explode" },
+            { "op": "add", "products": [{"sku" : 114342051}] },
+            { "op": "subtotal" }
+        ]
+        resp = self.app.post('/shopcarts/1/batch', data=json.dumps(batch), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( [result['status'] for result in data['results']], [201, 200, 404, 204, 400, 400, 200] )
+        self.assertEqual( data['results'][2]['error'], 'Product 999 was not found in shopping cart 1' )
+        self.assertEqual( data['results'][6]['subtotal'], 97.96 )
+        self.assertEqual( [product['sku'] for product in data['shopcart']['products']], [123456780, 114672050] )
+        self.assertEqual( data['shopcart'], Shopcart.find(1) )
+        self.assertEqual( Shopcart.find(1)['subtotal'], 97.96 )
+        self.assertEqual( list(Shopcart.check_subtotals()), [] )
+
+    def test_batch_operations_invalid(self):
+        resp = self.app.post('/shopcarts/47/batch', data=json.dumps([{ "op": "subtotal" }]), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_404_NOT_FOUND )
+        resp = self.app.post('/shopcarts/1/batch', data=json.dumps({ "op": "subtotal" }), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        # the placeholder of a cart created without products goes with its first product
+        shopcart = Shopcart(uid=9, products=[[]])
+        shopcart.save()
+        batch = [{ "op": "add", "products": [{"sku" : 114342051, "quantity" : 4, "name" : "Taboo" , "unitprice" : 3.76}] }]
+        resp = self.app.post('/shopcarts/%d/batch' % shopcart.sid, data=json.dumps(batch), content_type='application/json')
+        self.assertEqual( json.loads(resp.data)['shopcart']['products'], batch[0]['products'] )
+        self.assertEqual( Shopcart.modify(47, lambda cart: cart), None )
+
+    def test_etag(self):
+        resp = self.app.get('/shopcarts/1')
+        etag = resp.headers['ETag']
+        self.assertEqual( etag, '"%d"' % Shopcart.version(1) )
+        for url in ('/shopcarts/1', '/shopcarts/1/products'):
+            resp = self.app.get(url, headers={ 'If-None-Match': etag })
+            self.assertEqual( resp.status_code, status.HTTP_304_NOT_MODIFIED )
+            self.assertEqual( (resp.data, resp.headers['ETag']), ('', etag) )
+        self.assertEqual( self.app.get('/shopcarts/1', headers={ 'If-None-Match': '"0"' }).status_code, status.HTTP_200_OK )
+        # changes given If-Match only apply to that version
+        new_product = { "products": [{"sku" : 114672050, "quantity" : 1, "name" : "Lego" , "unitprice" : 43.12}] }
+        resp = self.app.post('/shopcarts/1/products', data=json.dumps(new_product), content_type='application/json', headers={ 'If-Match': etag })
+        self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+        resp = self.app.get('/shopcarts/1', headers={ 'If-None-Match': etag })
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        self.assertNotEqual( resp.headers['ETag'], etag )
+        resp = self.app.put('/shopcarts/1/products/114672050', data=json.dumps(new_product), content_type='application/json', headers={ 'If-Match': etag })
+        self.assertEqual( resp.status_code, status.HTTP_412_PRECONDITION_FAILED )
+        for headers in ({ 'If-Match': etag }, { 'If-Match': 'W/"%d"' % Shopcart.version(1) }, { 'If-Match': '"abc"' }):
+            resp = self.app.delete('/shopcarts/1', headers=headers)
+            self.assertEqual( resp.status_code, status.HTTP_412_PRECONDITION_FAILED )
+        self.assertEqual( self.app.delete('/shopcarts/47', headers={ 'If-Match': '*' }).status_code, status.HTTP_204_NO_CONTENT )
+        self.assertEqual( self.app.delete('/shopcarts/47', headers={ 'If-Match': etag }).status_code, status.HTTP_412_PRECONDITION_FAILED )
+        self.assertTrue( Shopcart.exists(1) )
+        resp = self.app.delete('/shopcarts/1', headers={ 'If-Match': '"%d"' % Shopcart.version(1) })
+        self.assertEqual( resp.status_code, status.HTTP_204_NO_CONTENT )
+        self.assertFalse( Shopcart.exists(1) )
+
+    def test_json_body(self):
+        # the cart and its products as rendered JSON, the same bytes as jsonify
+        cart_json, products_json, version = Shopcart.find_json(1)
+        self.assertEqual( json.loads(cart_json), Shopcart.find(1) )
+        self.assertEqual( json.loads(products_json), Shopcart.find(1)['products'] )
+        self.assertEqual( version, Shopcart.version(1) )
+        with server.app.app_context():
+            self.assertEqual( self.app.get('/shopcarts/1').data, server.jsonify(Shopcart.find(1)).data )
+            self.assertEqual( self.app.get('/shopcarts/1/products').data, server.jsonify(Shopcart.find(1)['products']).data )
+        self.assertIsNone( Shopcart.find_json(47) )
+
+    def test_compression(self):
+        plain = self.app.get('/shopcarts')
+        self.assertNotIn( 'Content-Encoding', plain.headers )
+        self.assertEqual( self.app.get('/shopcarts/1', headers={ 'Accept-Encoding': 'gzip' }).headers.get('Content-Encoding'), None )
+        compression.MIN_SIZE = 100
+        try:
+            resp = self.app.get('/shopcarts', headers={ 'Accept-Encoding': 'gzip' })
+            self.assertEqual( (resp.headers['Content-Encoding'], resp.headers['Vary']), ('gzip', 'Accept-Encoding') )
+            self.assertEqual( zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data )
+            self.assertTrue( int(resp.headers['Content-Length']) < len(plain.data) )
+            resp = self.app.get('/shopcarts', headers={ 'Accept-Encoding': 'gzip;q=0, deflate' })
+            self.assertEqual( (resp.headers['Content-Encoding'], zlib.decompress(resp.data)), ('deflate', plain.data) )
+            resp = self.app.get('/shopcarts', headers={ 'Accept-Encoding': 'br' })
+            self.assertEqual( (resp.headers.get('Content-Encoding'), resp.headers['Vary'], resp.data), (None, 'Accept-Encoding', plain.data) )
+            # the ETag names the version of the cart and the coding
+            version = Shopcart.version(1)
+            resp = self.app.get('/shopcarts/1/products', headers={ 'Accept-Encoding': 'gzip' })
+            self.assertEqual( (resp.headers['ETag'], resp.headers['Vary']), ('"%d-gzip"' % version, 'Accept-Encoding') )
+            self.assertEqual( self.app.get('/shopcarts/1/products').headers['ETag'], '"%d"' % version )
+            resp = self.app.get('/shopcarts/1', headers={ 'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag'] })
+            self.assertEqual( (resp.status_code, resp.headers.get('Content-Encoding')), (status.HTTP_304_NOT_MODIFIED, None) )
+            self.assertEqual( (resp.headers['ETag'], resp.headers['Vary']), ('"%d-gzip"' % version, 'Accept-Encoding') )
+            resp = self.app.put('/shopcarts/1/subtotal', headers={ 'If-Match': '"%d-gzip"' % version })
+            self.assertEqual( resp.status_code, status.HTTP_200_OK )
+            resp = self.app.put('/shopcarts/1/subtotal', headers={ 'If-Match': '"%d-gzip"' % version })
+            self.assertEqual( resp.status_code, status.HTTP_412_PRECONDITION_FAILED )
+            # the spec answers 304 to its coded ETag
+            resp = self.app.get('/v1/spec', headers={ 'Accept-Encoding': 'gzip' })
+            self.assertTrue( resp.headers['ETag'].endswith('-gzip"') )
+            resp = self.app.get('/v1/spec', headers={ 'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag'] })
+            self.assertEqual( resp.status_code, status.HTTP_304_NOT_MODIFIED )
+            resp = self.app.get('/shopcarts/export', headers={ 'Accept-Encoding': 'gzip' })
+            self.assertNotIn( 'Content-Encoding', resp.headers )
+        finally:
+            compression.MIN_SIZE = 1024
+
+    def test_fields(self):
+        resp = self.app.get('/shopcarts/1?fields=subtotal,products.sku')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        cart = Shopcart.find(1)
+        self.assertEqual( json.loads(resp.data), { 'subtotal': cart['subtotal'], 'products': [{ 'sku': product['sku'] } for product in cart['products']] } )
+        self.assertEqual( resp.headers['ETag'], '"%d"' % Shopcart.version(1) )
+        self.assertEqual( json.loads(self.app.get('/shopcarts/1?fields=products.sku,products').data), { 'products': cart['products'] } )
+        resp = self.app.get('/shopcarts?fields=sid')
+        self.assertEqual( json.loads(resp.data), [{ 'sid': found['sid'] } for found in Shopcart.all()] )
+        self.assertEqual( json.loads(self.app.get('/shopcarts?uid=1&fields=uid').data), { 'uid': 1 } )
+        first = json.loads(self.app.get('/shopcarts?limit=1').data)[0]
+        self.assertEqual( json.loads(self.app.get('/shopcarts?limit=1&fields=sid').data), [{ 'sid': first['sid'] }] )
+        self.assertEqual( json.loads(self.app.get('/shopcarts?sid=1,47&fields=sid').data), { 'shopcarts': [{ 'sid': 1 }], 'missing': [47] } )
+        resp = self.app.get('/shopcarts/1/products?fields=sku,quantity')
+        self.assertEqual( json.loads(resp.data), [{ 'sku': product['sku'], 'quantity': product['quantity'] } for product in cart['products']] )
+        name = cart['products'][0]['name']
+        resp = self.app.get('/shopcarts/1/products?fields=sku&name=%s' % name)
+        self.assertEqual( json.loads(resp.data), { 'sku': cart['products'][0]['sku'] } )
+        for url in ('/shopcarts/1?fields=total', '/shopcarts?fields=uid.sku', '/shopcarts/1/products?fields=products'):
+            self.assertEqual( self.app.get(url).status_code, status.HTTP_400_BAD_REQUEST )
+
+    def test_msgpack(self):
+        accept = { 'Accept': 'application/msgpack' }
+        resp = self.app.get('/shopcarts/1', headers=accept)
+        self.assertEqual( resp.content_type, 'application/msgpack' )
+        self.assertEqual( msgpack.unpackb(resp.data, raw=False), Shopcart.find(1) )
+        # a map whose first key is a str (fixstr 0xa0-0xbf), never bin (0xc4), for clients in any language
+        self.assertTrue( '\x80' <= resp.data[0] <= '\x8f' )
+        self.assertTrue( '\xa0' <= resp.data[1] <= '\xbf' )
+        self.assertEqual( resp.headers['ETag'], '"%d"' % Shopcart.version(1) )
+        resp = self.app.get('/shopcarts/1/products?fields=sku', headers=accept)
+        self.assertEqual( msgpack.unpackb(resp.data, raw=False), [{ 'sku': product['sku'] } for product in Shopcart.find(1)['products']] )
+        resp = self.app.get('/shopcarts/47', headers=accept)
+        self.assertEqual( resp.status_code, status.HTTP_404_NOT_FOUND )
+        self.assertIn( 'error', msgpack.unpackb(resp.data, raw=False) )
+        # bodies are read by their Content-Type and validated the same way
+        new_shopcart = { "uid": 6, "products": [{"sku" : 114672050, "quantity" : 2, "name" : "Lego" , "unitprice" : 43.12}] }
+        resp = self.app.post('/shopcarts', data=msgpack.packb(new_shopcart), content_type='application/msgpack', headers=accept)
+        self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+        sid = msgpack.unpackb(resp.data, raw=False)['sid']
+        self.assertEqual( json.loads(self.app.get('/shopcarts/%d' % sid).data)['products'], new_shopcart['products'] )
+        resp = self.app.post('/shopcarts/%d/products' % sid, data=msgpack.packb({ "products": [{"sku": 5, "quantity": "two"}] }), content_type='application/msgpack')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        resp = self.app.post('/shopcarts', data='\xc1', content_type='application/msgpack')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        # JSON unless msgpack is preferred
+        for headers in ({}, { 'Accept': '*/*' }, { 'Accept': 'application/json, application/msgpack;q=0.5' }):
+            self.assertEqual( self.app.get('/shopcarts/1', headers=headers).content_type, 'application/json' )
+
+    def test_cart_versions(self):
+        version = Shopcart.version(3)
+        self.assertEqual( Shopcart.find_versioned(3), (Shopcart.find(3), version) )
+        product = { 'sku': 5, 'quantity': 3, 'name': 'Uno', 'unitprice': 0.1 }
+        Shopcart.add_products(3, [product], version)
+        Shopcart.update_subtotal(3)
+        # saving the whole cart goes on from its version
+        Shopcart().deserialize(Shopcart.find(3)).save()
+        self.assertEqual( Shopcart.version(3), version + 3 )
+        self.assertRaises( VersionConflict, Shopcart.update_product, 3, 5, product, version )
+        self.assertRaises( VersionConflict, Shopcart.remove_product, 3, 5, version )
+        self.assertRaises( VersionConflict, Shopcart.modify, 3, lambda cart: cart, version )
+        self.assertEqual( Shopcart.find(3)['products'][1], product )
+        self.assertIsNone( Shopcart.version(47) )
+        self.assertIsNone( Shopcart.find_versioned(47) )
+
+    def test_find_by_uid_after_delete(self):
+        self.assertEqual( len(Shopcart.find_by_uid(2)), 1 )
+        resp = self.app.delete('/shopcarts/2', content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_204_NO_CONTENT )
+        self.assertEqual( Shopcart.find_by_uid(2), [] )
+        # the uid is free again once its cart is gone
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": 2}), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+
+    def test_save_duplicate_uid(self):
+        shopcart = Shopcart()
+        shopcart.deserialize({'uid': 1, 'subtotal': 0.0, 'products': [[]]})
+        self.assertRaises(DataValidationError, shopcart.save)
+        self.assertEqual( Shopcart.find_by_uid(1)[0]['sid'], 1 )
+
+    def test_uid_index_names(self):
+        # non-ASCII uids are indexed too, and 5.0 is the same uid as 5
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": u"caf\u00e9"}), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+        self.assertEqual( Shopcart.find_by_uid(u"caf\u00e9")[0]['uid'], u"caf\u00e9" )
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": u"caf\u00e9"}), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": 5.0}), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+        resp = self.app.get('/shopcarts?uid=5')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        self.assertEqual( json.loads(resp.data)['uid'], 5.0 )
+
+    def test_reindex(self):
+        indexed, duplicates = Shopcart.reindex()
+        self.assertEqual( indexed, 3 )
+        self.assertEqual( duplicates, 0 )
+        self.assertEqual( Shopcart.find_by_uid(3)[0]['sid'], 3 )
+
+    def test_list_shopcarts_paged(self):
+        resp = self.app.get('/shopcarts?limit=2')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        first_page = json.loads(resp.data)
+        self.assertEqual( len(first_page), 2 )
+        link = resp.headers.get('Link')
+        self.assertTrue( link and 'rel="next"' in link )
+        next_url = link[link.index('<') + 1:link.index('>')]
+        resp = self.app.get(next_url)
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        second_page = json.loads(resp.data)
+        self.assertEqual( len(second_page), 1 )
+        self.assertIsNone( resp.headers.get('Link') )
+        sids = sorted(cart['sid'] for cart in first_page + second_page)
+        self.assertEqual( sids, [1, 2, 3] )
+
+    def test_list_shopcarts_paged_delete(self):
+        # carts deleted between pages don't make the next page skip live ones
+        for uid in range(10, 110):
+            self.app.post('/shopcarts', data=json.dumps({"uid": uid}), content_type='application/json')
+        seen = []
+        deleted = []
+        cursor = None
+        while True:
+            carts, cursor = Shopcart.page(cursor, limit=7)
+            seen.extend(cart['sid'] for cart in carts)
+            if carts:
+                deleted.append(carts[-1]['sid'])
+                self.app.delete('/shopcarts/%d' % carts[-1]['sid'])
+            if cursor is None:
+                break
+        live = set(cart['sid'] for cart in Shopcart.all())
+        self.assertEqual( live - set(seen), set() )
+        self.assertEqual( len(live) + len(deleted), 103 )
+
+    def test_list_shopcarts_paged_invalid(self):
+        resp = self.app.get('/shopcarts?limit=0')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+        resp = self.app.get('/shopcarts?cursor=not-a-cursor')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+
+    def test_iterate_shopcarts(self):
+        sids = sorted(cart['sid'] for cart in Shopcart.iterate(batch_size=1))
+        self.assertEqual( sids, [1, 2, 3] )
+
+    def test_export_ndjson(self):
+        resp = self.app.get('/shopcarts/export')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        self.assertEqual( resp.mimetype, 'application/x-ndjson' )
+        carts = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual( sorted(cart['uid'] for cart in carts), [1, 2, 3] )
+
+    def test_export_csv(self):
+        resp = self.app.get('/shopcarts/export?format=csv')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        lines = resp.data.splitlines()
+        self.assertEqual( lines[0], 'uid,sid,products_sku,products_quantity,products_name,products_unitprice' )
+        self.assertIn( '1,1,123456780,2,"Settlers of Catan",27.99', lines )
+        self.assertIn( '2,2,,,,', lines )
+        self.assertEqual( len(lines), 5 )
+
+    def test_export_invalid_format(self):
+        resp = self.app.get('/shopcarts/export?format=xml')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+
+    def test_import_csv(self):
+        Shopcart.remove_all()
+        rejects = StringIO()
+        with open('sampleShopcarts.csv', 'rb') as stream:
+            stats = importer.import_carts(stream, batch_size=4, rejects=rejects)
+        self.assertEqual( stats.carts, 6 )
+        self.assertEqual( stats.rejected, 0 )
+        self.assertEqual( len(Shopcart.find(3)['products']), 2 )
+        self.assertEqual( Shopcart.find_by_uid(6)[0]['sid'], 6 )
+        # new carts are allocated after the imported sids
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": 7}), content_type='application/json')
+        self.assertEqual( json.loads(resp.data)['sid'], 7 )
+
+    def test_import_rejects(self):
+        stream = StringIO('{"uid": 1}\n{"uid": 20, "products": [{"sku": 1}]}\n{"uid": 21}\n')
+        rejects = StringIO()
+        stats = importer.import_carts(stream, fmt='ndjson', rejects=rejects)
+        self.assertEqual( stats.carts, 1 )
+        self.assertEqual( stats.rejected, 2 )
+        reasons = [json.loads(line)['reason'] for line in rejects.getvalue().splitlines()]
+        self.assertEqual( reasons, ['Data is not valid', 'Shopping Cart for uid 1 already exists'] )
+        self.assertEqual( len(Shopcart.find_by_uid(21)), 1 )
+
+    def test_import_sids(self):
+        # only positive int sids are imported, carts without products get the placeholder of the API
+        stream = StringIO('{"uid": 20, "sid": "x"}\n{"uid": 21, "sid": 1.5}\n{"uid": 22, "sid": -4}\n'
+                          '{"uid": 23, "sid": 0}\n{"uid": 24, "sid": true}\n{"uid": 25, "sid": 40, "products": []}\n')
+        rejects = StringIO()
+        stats = importer.import_carts(stream, fmt='ndjson', rejects=rejects)
+        self.assertEqual( (stats.carts, stats.rejected), (1, 5) )
+        self.assertEqual( Shopcart.find(40)['products'], [[]] )
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": 26}), content_type='application/json')
+        self.assertEqual( Shopcart.find(json.loads(resp.data)['sid'])['products'], Shopcart.find(40)['products'] )
+
+    def test_import_existing_sid(self):
+        # a row whose sid holds the cart of another uid doesn't overwrite it
+        stream = StringIO('{"uid": 20, "sid": 2}\n{"uid": 2, "sid": 2}\n')
+        rejects = StringIO()
+        stats = importer.import_carts(stream, fmt='ndjson', rejects=rejects)
+        self.assertEqual( (stats.carts, stats.rejected), (1, 1) )
+        reasons = [json.loads(line)['reason'] for line in rejects.getvalue().splitlines()]
+        self.assertEqual( reasons, ['Shopping Cart 2 belongs to another uid'] )
+        self.assertEqual( Shopcart.find(2)['uid'], 2 )
+        self.assertEqual( Shopcart.find_by_uid(20), [] )
+        resp = self.app.post('/shopcarts', data=json.dumps({"uid": 20}), content_type='application/json')
+        self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+
+    def test_codec_round_trip(self):
+        cart = Shopcart.find(1)
+        empty = { 'uid': 9, 'sid': 9, 'subtotal': 0.0, 'products': [[]] }
+        for found in (cart, empty):
+            fields = dict((field, str(value)) for field, value in codec.to_hash(found).items())
+            self.assertEqual( codec.from_hash(found['sid'], fields), found )
+        # carts stored as binary strings before the hashes are still read, pickles only when allowed
+        self.assertEqual( codec.loads(binary_record(empty)), empty )
+        self.assertRaises( codec.CodecError, codec.loads, pickle.dumps(empty) )
+
+    @redis_only
+    def test_migrate_pickled_carts(self):
+        legacy = { 'uid': 9, 'sid': 9, 'subtotal': 0.0, 'products': [{ 'sku': 1, 'quantity': 1, 'name': 'Risk', 'unitprice': 27.99 }] }
+        server.redis.set(9, pickle.dumps(legacy))
+        server.redis.set(10, binary_record(dict(legacy, uid=10, sid=10)))
+        self.assertRaises( codec.CodecError, Shopcart.migrate_encoding, pause=0 )
+        codec.ALLOW_PICKLE = True
+        try:
+            self.assertEqual( Shopcart.migrate_encoding(pause=0), 2 )
+        finally:
+            codec.ALLOW_PICKLE = False
+        self.assertEqual( server.redis.type(9), 'hash' )
+        # the subtotal is the one of the products from now on
+        self.assertEqual( Shopcart.find(9), dict(legacy, subtotal=27.99) )
+        self.assertEqual( Shopcart.migrate_encoding(pause=0), 0 )
+
+    @redis_only
+    def test_legacy_cart_upgraded_on_read(self):
+        legacy = { 'uid': 9, 'sid': 9, 'subtotal': 0.0, 'products': [[]] }
+        server.redis.set(9, binary_record(legacy))
+        self.assertEqual( Shopcart.find(9), legacy )
+        self.assertEqual( server.redis.type(9), 'hash' )
+        # product mutations upgrade the cart before touching its fields
+        server.redis.set(10, binary_record(dict(legacy, uid=10, sid=10)))
+        product = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        self.assertEqual( Shopcart.add_products(10, [product])['products'], [product] )
+        # legacy carts start at version 0
+        server.redis.set(11, binary_record(dict(legacy, uid=11, sid=11)))
+        self.assertEqual( Shopcart.version(11), 0 )
+        self.assertEqual( Shopcart.version(10), 1 )
+
+    @redis_only
+    def test_product_fields(self):
+        fields = server.redis.hgetall(1)
+        self.assertIn( 'p:123456780', fields )
+        self.assertIn( 'p:876543210', fields )
+        Shopcart.remove_product(1, 123456780)
+        self.assertNotIn( 'p:123456780', server.redis.hgetall(1) )
+        self.assertEqual( len(Shopcart.find(1)['products']), 1 )
+
+    def test_incremental_subtotal(self):
+        # 2 x 27.99 + 1 x 27.99, kept up to date without PUT /subtotal
+        self.assertEqual( Shopcart.find(1)['subtotal'], 83.97 )
+        product = { 'sku': 5, 'quantity': 3, 'name': 'Uno', 'unitprice': 0.1 }
+        self.assertEqual( Shopcart.add_products(1, [product])['subtotal'], 84.27 )
+        self.assertEqual( Shopcart.add_products(1, [dict(product, quantity=1)])['subtotal'], 84.07 )
+        # replacing a line by the sku of another line drops both old lines
+        self.assertEqual( Shopcart.update_product(1, 123456780, dict(product, quantity=7))['subtotal'], 28.69 )
+        Shopcart.remove_product(1, 5)
+        self.assertEqual( Shopcart.find(1)['subtotal'], 27.99 )
+        Shopcart.remove_product(1, 876543210)
+        self.assertEqual( Shopcart.find(1)['subtotal'], 0.0 )
+        self.assertEqual( list(Shopcart.check_subtotals()), [] )
+
+    @redis_only
+    def test_check_subtotals(self):
+        # a cart written before cents, with the subtotal of the old PUT /subtotal
+        server.redis.hdel(3, 'cents')
+        server.redis.hset(3, 'subtotal', '0.0')
+        server.redis.hset(3, 'touched', 1000)
+        version = Shopcart.version(3)
+        self.assertEqual( list(Shopcart.check_subtotals(fix=True)), [(3, 0.0, 13.99)] )
+        self.assertEqual( list(Shopcart.check_subtotals()), [] )
+        # the fix leaves the cart untouched and only the carts it changed get a new version
+        self.assertEqual( server.redis.hget(3, 'touched'), '1000' )
+        self.assertEqual( Shopcart.version(3), version + 1 )
+        self.assertEqual( list(Shopcart.check_subtotals(fix=True)), [] )
+        self.assertEqual( Shopcart.version(3), version + 1 )
+        server.redis.hdel(3, 'cents')
+        product = { 'sku': 5, 'quantity': 3, 'name': 'Uno', 'unitprice': 0.1 }
+        self.assertEqual( Shopcart.add_products(3, [product])['subtotal'], 14.29 )
+
+    def test_recompute_subtotals(self):
+        storage = MemoryStorage()
+        Shopcart.use_storage(storage)
+        risk = { 'sku': 876543210, 'quantity': 3, 'name': 'Risk', 'unitprice': 27.99 }
+        Shopcart.save_many([Shopcart(uid=1, products=[risk]), Shopcart(uid=2, products=[[]]), Shopcart(uid=3, products=[])])
+        storage.carts[1]['cents'] = '100'
+        stats = recompute.recompute_subtotals(batch_size=2, dry_run=True)
+        self.assertEqual( (stats.carts, stats.changed), (3, [(1, 1.0, 83.97)]) )
+        self.assertEqual( Shopcart.find(1)['subtotal'], 1.0 )
+        stats = recompute.recompute_subtotals(batch_size=2)
+        self.assertEqual( stats.changed, [(1, 1.0, 83.97)] )
+        self.assertEqual( Shopcart.find(1)['subtotal'], 83.97 )
+        self.assertEqual( recompute.recompute_subtotals().changed, [] )
+
+    def test_recompute_columns(self):
+        carts = [{ 'products': [{ 'sku': i * 10 + j, 'quantity': j + 1, 'name': 'P', 'unitprice': 0.01 * (i * 37 + j * 11) + 0.005 } for j in range(i % 5)] } for i in range(200)]
+        carts.append({ 'products': [[]] })
+        expected = [codec.cents_of(cart['products']) for cart in carts]
+        self.assertEqual( recompute.cents_array(carts), expected )
+        if recompute.load_numpy():
+            self.assertEqual( recompute.cents_numpy(carts), expected )
+
+    @redis_only
+    def test_recompute_subtotals_endpoint(self):
+        server.redis.hset(3, 'cents', 1000)
+        resp = self.app.post('/shopcarts/subtotals?dry_run=true')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertEqual( (data['carts'], data['changed'], data['dry_run']), (3, 1, True) )
+        self.assertEqual( data['changed_carts'], [{ 'sid': 3, 'subtotal': 10.0, 'recomputed': 13.99 }] )
+        resp = self.app.post('/shopcarts/subtotals?batch_size=1')
+        self.assertEqual( json.loads(resp.data)['changed'], 1 )
+        self.assertEqual( Shopcart.find(3)['subtotal'], 13.99 )
+        resp = self.app.post('/shopcarts/subtotals?batch_size=0')
+        self.assertEqual( resp.status_code, status.HTTP_400_BAD_REQUEST )
+
+    def test_product_index(self):
+        self.assertEqual( Shopcart.get_product(1, 876543210)['name'], 'Risk' )
+        self.assertIsNone( Shopcart.get_product(1, 42) )
+        self.assertIsNone( Shopcart.get_product(42, 876543210) )
+        shopcart = Shopcart(uid=9, products=[[]])
+        risk = { 'sku': 876543210, 'quantity': 1, 'name': 'Risk', 'unitprice': 27.99 }
+        uno = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        shopcart.deserialize_products([risk, uno, dict(risk, quantity=3)])
+        self.assertEqual( shopcart.products, [dict(risk, quantity=3), uno] )
+        self.assertEqual( Shopcart.product_index(shopcart.products), { 876543210: 0, 5: 1 } )
+
+    def test_concurrent_product_mutations(self):
+        # every worker adds its own products to cart 2 and updates one of cart 1's lines
+        def work(worker):
+            client = server.app.test_client()
+            for i in range(25):
+                product = { "sku": worker * 1000 + i, "quantity": 1, "name": "Product %d" % i, "unitprice": 1.25 }
+                resp = client.post('/shopcarts/2/products', data=json.dumps({ "products": [product] }), content_type='application/json')
+                self.assertEqual( resp.status_code, status.HTTP_201_CREATED )
+            product = { "sku": 876543210, "quantity": worker, "name": "Risk", "unitprice": 27.99 }
+            client.put('/shopcarts/1/products/876543210', data=json.dumps({ "products": [product] }), content_type='application/json')
+        workers = [threading.Thread(target=work, args=(worker,)) for worker in range(1, 9)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual( len(Shopcart.find(2)['products']), 8 * 25 )
+        self.assertEqual( Shopcart.update_subtotal(2)['subtotal'], 250.0 )
+        self.assertEqual( len(Shopcart.find(1)['products']), 2 )
+
+    @redis_only
+    def test_stats(self):
+        resp = self.app.get('/stats')
+        self.assertEqual( resp.status_code, status.HTTP_200_OK )
+        data = json.loads(resp.data)
+        self.assertTrue( data['redis']['connected'] )
+        self.assertEqual( data['redis']['host'], '127.0.0.1' )
+        self.assertTrue( data['redis']['created_connections'] >= 1 )
+        # the blocking pool of a pool timeout keeps its connections its own way
+        os.environ['REDIS_POOL_TIMEOUT'] = '5'
+        try:
+            server.inititalize_redis()
+            resp = self.app.get('/stats')
+            self.assertEqual( resp.status_code, status.HTTP_200_OK )
+            data = json.loads(resp.data)['redis']
+            self.assertTrue( data['created_connections'] >= 1 )
+            self.assertEqual( data['available_connections'], data['created_connections'] - data['in_use_connections'] )
+        finally:
+            del os.environ['REDIS_POOL_TIMEOUT']
+
+    @redis_only
+    def test_redis_reconnect(self):
+        # the first candidate is down, the manager falls through to the next one
+        manager = RedisManager([('127.0.0.1', 1, None), ('127.0.0.1', 6379, None)], socket_connect_timeout=0.2)
+        self.assertIsNotNone( manager.connect() )
+        self.assertEqual( manager.stats()['port'], 6379 )
+        manager.pool.disconnect()
+        manager.candidates = [('127.0.0.1', 1, None)]
+        manager.backoff_base = 0.01
+        # a manager that can't reach any candidate keeps retrying until it is stopped
+        Timer(0.1, manager.stop).start()
+        self.assertIsNone( manager.reconnect() )
+        self.assertEqual( manager.reconnects, 0 )
+
+    @redis_only
+    def test_redis_pool_timeout(self):
+        # with a pool timeout callers wait for a free connection instead of failing at once
+        manager = RedisManager([('127.0.0.1', 6379, None)], max_connections=1, pool_timeout=0.2)
+        self.assertIsNotNone( manager.connect() )
+        connection = manager.pool.get_connection('PING')
+        Timer(0.05, manager.pool.release, [connection]).start()
+        self.assertTrue( manager.client.ping() )
+        connection = manager.pool.get_connection('PING')
+        self.assertEqual( (manager.stats()['created_connections'], manager.stats()['in_use_connections']), (1, 1) )
+        started = time.time()
+        self.assertRaises( ConnectionError, manager.client.ping )
+        self.assertTrue( time.time() - started >= 0.2 )
+        manager.pool.release(connection)
+        manager.pool.disconnect()
+
+    def test_prefork_server(self):
+        prefork = PreforkServer(server.app, '127.0.0.1', 0, workers=2, max_requests=2, graceful_timeout=5)
+        prefork.listen()
+        master = os.fork()
+        if master == 0:
+            try:
+                prefork.serve_forever()
+            finally:
+                os._exit(0)
+        try:
+            # workers are replaced as they are recycled, every request is answered
+            for i in range(10):
+                resp = urllib2.urlopen('http://127.0.0.1:%d/shopcarts/1' % prefork.port, timeout=5)
+                self.assertEqual( json.loads(resp.read())['sid'], 1 )
+        finally:
+            os.kill(master, signal.SIGTERM)
+            self.assertEqual( os.waitpid(master, 0)[1], 0 )
+            prefork.socket.close()
+        # workers that fail at once are forked again with a growing delay, until the master gives up
+        def fail():
+            raise RuntimeError('bad config')
+        failing = PreforkServer(server.app, '127.0.0.1', 0, workers=2, max_failures=4, initialize=fail)
+        failing.backoff_base = 0.01
+        master = os.fork()
+        if master == 0:
+            code = 0
+            try:
+                failing.serve_forever()
+            except SystemExit as err:
+                code = err.code
+            finally:
+                os._exit(code)
+        started = time.time()
+        self.assertEqual( os.waitpid(master, 0)[1] >> 8, 1 )
+        self.assertTrue( time.time() - started < 5 )
+        self.assertTrue( prefork.should_recycle(2, 2) )
+        self.assertFalse( prefork.should_recycle(1, 2) )
+        prefork.max_memory = 1
+        self.assertTrue( prefork.should_recycle(0, 0) )
+
+    def test_cart_cache(self):
+        Shopcart.use_cache(CartCache(max_size=2, ttl=60))
+        try:
+            Shopcart.find(1)
+            Shopcart.find(1)
+            self.assertEqual( Shopcart.cache_stats()['hits'], 1 )
+            self.assertEqual( Shopcart.cache_stats()['misses'], 1 )
+            # a mutation through the API is seen by the next read
+            resp = self.app.delete('/shopcarts/1/products/123456780', content_type='application/json')
+            self.assertEqual( len(Shopcart.find(1)['products']), 1 )
+            # the least recently used cart is evicted past max_size
+            Shopcart.find(2)
+            Shopcart.find(3)
+            self.assertEqual( Shopcart.cache_stats()['evictions'], 1 )
+            resp = self.app.get('/stats')
+            self.assertEqual( json.loads(resp.data)['cache']['size'], 2 )
+        finally:
+            Shopcart.use_cache(None)
+
+    @redis_only
+    def test_cart_cache_invalidation_from_other_process(self):
+        Shopcart.use_cache(CartCache(max_size=10, ttl=60))
+        try:
+            self.assertEqual( Shopcart.find(3)['subtotal'], 13.99 )
+            # another worker changes the cart and publishes the invalidation
+            server.redis.hset(3, 'cents', 1000)
+            server.redis.publish(cache.CHANNEL, 3)
+            for i in range(50):
+                if Shopcart.find(3)['subtotal'] == 10.0:
+                    break
+                time.sleep(0.02)
+            self.assertEqual( Shopcart.find(3)['subtotal'], 10.0 )
+        finally:
+            Shopcart.use_cache(None)
+
+    def test_cart_cache_ttl(self):
+        cart_cache = CartCache(max_size=10, ttl=0)
+        cart_cache.put(1, Shopcart.find(1))
+        self.assertIsNone( cart_cache.get(1) )
+        self.assertEqual( cart_cache.stats()['expirations'], 1 )
+
+    def test_memory_storage(self):
+        storage = MemoryStorage()
+        Shopcart.use_storage(storage)
+        Shopcart(uid=1, products=[[]]).save()
+        self.assertRaises( DataValidationError, Shopcart(uid=1).save )
+        product = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        self.assertEqual( Shopcart.add_products(1, [product])['products'], [product] )
+        self.assertEqual( Shopcart.update_subtotal(1)['subtotal'], 9.98 )
+        self.assertRaises( KeyError, Shopcart.update_product, 1, 6, product )
+        self.assertIsNone( Shopcart.add_products(2, [product]) )
+        # readers get their own copy of the cart
+        storage.get(1)['products'].append(product)
+        self.assertEqual( len(storage.get(1)['products']), 1 )
+        # the rejected save above used up sid 2
+        Shopcart.save_many([Shopcart(uid=uid) for uid in range(2, 7)])
+        results, cursor = Shopcart.page(limit=4)
+        self.assertEqual( [cart['sid'] for cart in results], [1, 3, 4, 5] )
+        results, cursor = Shopcart.page(cursor, limit=4)
+        self.assertEqual( [cart['sid'] for cart in results], [6, 7] )
+        self.assertIsNone( cursor )
+        self.assertEqual( Shopcart.find_by_uid(6)[0]['sid'], 7 )
+
+    def test_sharded_storage(self):
+        storage = ShardedStorage([('a', MemoryStorage()), ('b', MemoryStorage())], vnodes=64)
+        Shopcart.use_storage(storage)
+        Shopcart.save_many([Shopcart(uid=uid) for uid in range(1, 101)])
+        self.assertEqual( sorted(len(node.carts) for node in storage.nodes.values()), [48, 52] )
+        # every cart and its index entry are on the node the ring gives its sid
+        for name, node in storage.nodes.items():
+            for sid in node.carts:
+                self.assertEqual( storage.node_name(sid), name )
+                self.assertEqual( node.index_get(node.get(sid)['uid']), sid )
+        self.assertEqual( len(Shopcart.all()), 100 )
+        self.assertEqual( Shopcart.find_by_uid(42)[0]['sid'], 42 )
+        # a uid is unique across the nodes
+        self.assertRaises( DataValidationError, Shopcart(uid=42).save )
+        self.assertEqual( len(Shopcart.save_many([Shopcart(uid=7), Shopcart(uid=200)])), 1 )
+        self.assertEqual( Shopcart.reindex(), (101, 0) )
+        # a new node takes over its share of the carts
+        Shopcart.add_products(50, [{ 'sku': 5, 'quantity': 3, 'name': 'Uno', 'unitprice': 0.1 }])
+        version = Shopcart.version(50)
+        moved, conflicts = storage.add_node('c', MemoryStorage())
+        self.assertEqual( conflicts, [] )
+        self.assertEqual( moved, len(storage.nodes['c'].carts) )
+        self.assertTrue( 0 < moved < 101 )
+        self.assertEqual( sorted(cart['sid'] for cart in Shopcart.all()), sorted(range(1, 101) + [103]) )
+        self.assertEqual( Shopcart.find_by_uid(200)[0]['sid'], 103 )
+        # moved carts keep counting their versions, so their ETags are never reused
+        self.assertTrue( Shopcart.version(50) >= version )
+        Shopcart.remove_all()
+        self.assertEqual( Shopcart.all(), [] )
+
+    def test_rebalance(self):
+        a, b = MemoryStorage(), MemoryStorage()
+        a.idle_ttl = a.empty_ttl = b.idle_ttl = b.empty_ttl = 600
+        storage = ShardedStorage([('a', a)], vnodes=64)
+        Shopcart.use_storage(storage)
+        Shopcart.save_many([Shopcart(uid=uid) for uid in range(1, 21)])
+        ring = ShardedStorage([('a', None), ('b', None)], vnodes=64)
+        moving = [sid for sid in range(1, 21) if ring.node_name(sid) == 'b']
+        # the uid of the first cart also got a cart on b, as two concurrent saves can do
+        duplicate = [sid for sid in range(21, 100) if ring.node_name(sid) == 'b'][0]
+        b.put({ 'uid': moving[0], 'sid': duplicate, 'subtotal': 0.0, 'products': [[]] })
+        touched = int(time.time()) - 300
+        a.carts[moving[1]]['touched'] = str(touched)
+        moved, conflicts = storage.add_node('b', b)
+        # the duplicate is left on its old node and reported, the others are moved
+        self.assertEqual( (moved, conflicts), (len(moving) - 1, [moving[0]]) )
+        self.assertIn( moving[0], a.carts )
+        self.assertEqual( sorted(b.carts), sorted(moving[1:] + [duplicate]) )
+        # a moved cart keeps the ttl it had left
+        self.assertEqual( b.touched(moving[1]), touched )
+        self.assertTrue( b.expires[moving[1]] <= time.time() + 300 )
+
+    def test_shard_unavailable(self):
+        a = MemoryStorage()
+        storage = ShardedStorage([('a', a), ('b', None)], vnodes=64)
+        Shopcart.use_storage(storage)
+        on_a = [sid for sid in range(1, 100) if storage.node_name(sid) == 'a'][0]
+        on_b = [sid for sid in range(1, 100) if storage.node_name(sid) == 'b'][0]
+        a.put({ 'uid': 1, 'sid': on_a, 'subtotal': 0.0, 'products': [[]] })
+        # the carts of the connected node are served, the others and the listing wait for b
+        self.assertEqual( self.app.get('/shopcarts/%d' % on_a).status_code, status.HTTP_200_OK )
+        resp = self.app.get('/shopcarts/%d' % on_b)
+        self.assertEqual( resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE )
+        self.assertEqual( json.loads(resp.data)['error'], 'Service Unavailable' )
+        self.assertEqual( self.app.get('/shopcarts').status_code, status.HTTP_503_SERVICE_UNAVAILABLE )
+        storage.set_node('b', MemoryStorage())
+        self.assertEqual( self.app.get('/shopcarts/%d' % on_b).status_code, status.HTTP_404_NOT_FOUND )
+        self.assertEqual( self.app.get('/shopcarts').status_code, status.HTTP_200_OK )
+
+    @redis_only
+    def test_shard_down_at_startup(self):
+        server.initialize_shards('127.0.0.1:6379,127.0.0.1:1')
+        ring = ShardedStorage([('127.0.0.1:6379', None), ('127.0.0.1:1', None)])
+        up = [sid for sid in range(1000, 1100) if ring.node_name(sid) == '127.0.0.1:6379'][0]
+        down = [sid for sid in range(1000, 1100) if ring.node_name(sid) == '127.0.0.1:1'][0]
+        self.assertEqual( self.app.get('/shopcarts/%d' % up).status_code, status.HTTP_404_NOT_FOUND )
+        self.assertEqual( self.app.get('/shopcarts/%d' % down).status_code, status.HTTP_503_SERVICE_UNAVAILABLE )
+        # the shard comes back
+        manager = server.shard_managers[1]
+        manager.candidates = [('127.0.0.1', 6379, None)]
+        self.assertIsNotNone( manager.connect() )
+        self.assertEqual( self.app.get('/shopcarts/%d' % down).status_code, status.HTTP_404_NOT_FOUND )
+
+    def test_idle_ttl(self):
+        storage = MemoryStorage()
+        storage.idle_ttl, storage.empty_ttl = 60, 1
+        Shopcart.use_storage(storage)
+        Shopcart(uid=1, products=[[]]).save()
+        Shopcart(uid=2, products=[[]]).save()
+        product = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        Shopcart.add_products(2, [product])
+        # placeholder carts go first, with their uid index entry
+        storage.expires[1] = time.time() - 1
+        self.assertEqual( Shopcart.reap().placeholders, 1 )
+        self.assertIsNone( Shopcart.find(1) )
+        self.assertEqual( Shopcart.find_by_uid(1), [] )
+        Shopcart(uid=1).save()
+        self.assertTrue( storage.expires[2] > time.time() + 50 )
+        # an expired cart is gone even before the reaper runs
+        storage.expires[2] = time.time() - 1
+        self.assertEqual( Shopcart.find_by_uid(2), [] )
+        self.assertEqual( len(Shopcart.all()), 1 )
+
+    @redis_only
+    def test_idle_ttl_redis(self):
+        storage = RedisStorage(server.redis)
+        storage.idle_ttl, storage.empty_ttl = 600, 60
+        Shopcart.use_storage(storage)
+        Shopcart(uid=9, products=[[]]).save()
+        sid = Shopcart.find_by_uid(9)[0]['sid']
+        self.assertTrue( 0 < server.redis.ttl(sid) <= 60 )
+        self.assertTrue( 0 < server.redis.ttl('uid:9') <= 60 )
+        product = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        Shopcart.add_products(sid, [product])
+        self.assertTrue( 60 < server.redis.ttl(sid) <= 600 )
+        self.assertTrue( 60 < server.redis.ttl('uid:9') <= 600 )
+        # the scripts get the uid key from the cart, whatever the type of its uid
+        for uid in (10.0, None):
+            Shopcart().deserialize({ 'uid': uid, 'subtotal': 0.0, 'products': [[]] }).save()
+        Shopcart.add_products(sid + 1, [product])
+        self.assertTrue( 60 < server.redis.ttl('uid:10') <= 600 )
+        self.assertEqual( len(Shopcart.add_products(sid + 2, [product])['products']), 1 )
+        # a caller that knows the uid saves the lookup, the change is a single EVALSHA
+        server.redis.config_resetstat()
+        server.redis.expire('uid:9', 100)
+        Shopcart.update_subtotal(sid, uid=9)
+        self.assertNotIn( 'cmdstat_hget', server.redis.info('commandstats') )
+        self.assertTrue( 100 < server.redis.ttl('uid:9') <= 600 )
+        # carts saved before the ttls get one, or go if they're older than it
+        for old in (1, 2, 3):
+            server.redis.persist(old)
+        server.redis.hset(1, 'touched', int(time.time()) - 3600)
+        server.redis.set('uid:42', 4242)
+        stats = Shopcart.reap()
+        self.assertEqual( (stats.carts, stats.index_entries, stats.expiring), (1, 1, 2) )
+        self.assertTrue( stats.bytes > 0 )
+        self.assertIsNone( Shopcart.find(1) )
+        self.assertEqual( Shopcart.find_by_uid(1), [] )
+        self.assertTrue( 0 < server.redis.ttl(2) <= 600 )
+        self.assertEqual( Shopcart.reap().expiring, 0 )
+
+    def test_stored_json(self):
+        storage = MemoryStorage()
+        storage.store_json = True
+        Shopcart.use_storage(storage)
+        product = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        Shopcart(uid=1, products=[product]).save()
+        self.assertEqual( storage.carts[1]['json'], codec.render([product]) )
+        # a change drops the JSON, the next read renders it again
+        Shopcart.add_products(1, [dict(product, sku=6)])
+        self.assertNotIn( 'json', storage.carts[1] )
+        resp = self.app.get('/shopcarts/1/products')
+        self.assertEqual( json.loads(resp.data), Shopcart.find(1)['products'] )
+        self.assertEqual( storage.carts[1]['json'], resp.data.strip() )
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual( (json.loads(resp.data), resp.headers['ETag']), (Shopcart.find(1), '"%d"' % Shopcart.version(1)) )
+        Shopcart.remove_product(1, 5)
+        self.assertEqual( json.loads(self.app.get('/shopcarts/1').data)['products'], [dict(product, sku=6)] )
+
+    @redis_only
+    def test_stored_json_redis(self):
+        storage = RedisStorage(server.redis)
+        storage.store_json = True
+        Shopcart.use_storage(storage)
+        Shopcart.remove_all()
+        product = { 'sku': 5, 'quantity': 2, 'name': 'Uno', 'unitprice': 4.99 }
+        Shopcart(uid=1, products=[product]).save()
+        self.assertEqual( server.redis.hget(1, 'json'), codec.render([product]) )
+        Shopcart.update_product(1, 5, dict(product, quantity=3))
+        self.assertIsNone( server.redis.hget(1, 'json') )
+        resp = self.app.get('/shopcarts/1')
+        self.assertEqual( json.loads(resp.data), Shopcart.find(1) )
+        self.assertEqual( json.loads(server.redis.hget(1, 'json'))[0]['quantity'], 3 )
+        # JSON rendered from an older version is not kept
+        server.redis.hdel(1, 'json')
+        storage.scripts['store_json'](keys=[1], args=[Shopcart.version(1) - 1, '[]'])
+        self.assertIsNone( server.redis.hget(1, 'json') )
+        # legacy carts are upgraded first
+        server.redis.set(9, binary_record({ 'uid': 9, 'sid': 9, 'subtotal': 0.0, 'products': [[]] }))
+        self.assertEqual( json.loads(Shopcart.find_json(9)[0])['uid'], 9 )
+
 ######################################################################
 # Utility functions
 ######################################################################